@@ -0,0 +1,370 @@
+"""JSON API, version 1: /api/v1.
+
+Timeline, profiles, follow lists, likes and the DM inbox for the mobile
+clients and the SPA, plus idempotent like and follow endpoints (PUT to do
+it, DELETE to undo it, POST to toggle). Requests are authenticated by the
+same session cookie as the site.
+
+Lists are pages of `{"data": [...], "older": cursor, "newer": cursor}`.
+Fetch further back with `?before=<older>`, and poll for anything new with
+`?after=<newer>`. `?limit=` works as it does on the HTML feeds.
+
+Rows are selected as plain columns and dumped straight to dicts, so no ORM
+objects are built. Each endpoint's `Fields` lists what it can return, and
+`?fields=id,text` selects only those columns. Responses over
+API_COMPRESS_MIN_SIZE bytes are compressed: brotli if the client accepts it
+and the `brotli` package is installed, otherwise gzip.
+"""
+
+import gzip
+
+from flask import Blueprint, current_app, g, jsonify, request, abort
+from sqlalchemy import DateTime, exists, select
+from sqlalchemy.orm import aliased
+from werkzeug.exceptions import HTTPException
+
+from models import db, User, Message, Likes, Follows, TimelineEntry, ConversationParticipant
+from pagination import Page, page_size, paginate
+import follows
+import likes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# set by init_app: the app's blocking.BlockList
+block_list = None
+
+
+def init_app(app, blocks):
+    global block_list
+    block_list = blocks
+    app.register_blueprint(api)
+
+
+##############################################################################
+# Serializers
+
+
+class Fields:
+    """What an endpoint can return: field name -> column.
+
+    `always` fields (ids and paging keys) are sent whatever `?fields=`
+    asks for; `extra` names fields the view fills in itself.
+    """
+
+    def __init__(self, always, extra=(), **columns):
+        self.always = tuple(always)
+        self.extra = tuple(extra)
+        self.columns = columns
+        self.dates = {name for name, column in columns.items()
+                      if isinstance(column.type, DateTime)}
+
+    def requested(self):
+        """The field names this request wants, in a stable order."""
+
+        asked = request.args.get('fields')
+        if not asked:
+            return list(self.columns) + list(self.extra)
+
+        names = set(asked.split(','))
+        unknown = names - set(self.columns) - set(self.extra)
+        if unknown:
+            abort(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+        return [name for name in (*self.columns, *self.extra)
+                if name in names or name in self.always]
+
+    def select(self, names):
+        """Labelled columns for the non-extra `names`."""
+
+        return [self.columns[name].label(name) for name in names if name in self.columns]
+
+    def dump(self, rows):
+        """Result rows as dicts, timestamps in ISO 8601."""
+
+        if not rows:
+            return []
+
+        names = rows[0]._fields
+        dates = self.dates.intersection(names)
+        if not dates:
+            return [dict(zip(names, row)) for row in rows]
+
+        out = []
+        for row in rows:
+            item = dict(zip(names, row))
+            for name in dates:
+                if item[name] is not None:
+                    item[name] = item[name].isoformat()
+            out.append(item)
+        return out
+
+
+def page_response(page, data):
+    return jsonify(data=data, older=page.older_cursor, newer=page.newer_cursor)
+
+
+MESSAGE_FIELDS = Fields(
+    always=('id', 'timestamp'),
+    extra=('liked',),
+    id=Message.id,
+    text=Message.text,
+    timestamp=Message.timestamp,
+    user_id=Message.user_id,
+    username=User.username,
+    image_url=User.image_url,
+)
+
+USER_FIELDS = Fields(
+    always=('id',),
+    extra=('following',),
+    id=User.id,
+    username=User.username,
+    image_url=User.image_url,
+    header_image_url=User.header_image_url,
+    bio=User.bio,
+    location=User.location,
+    messages_count=User.messages_count,
+    following_count=User.following_count,
+    followers_count=User.followers_count,
+    likes_count=User.likes_count,
+)
+
+THREAD_FIELDS = Fields(
+    always=('conversation_id', 'last_message_at'),
+    conversation_id=ConversationParticipant.conversation_id,
+    user_id=ConversationParticipant.other_user_id,
+    username=User.username,
+    image_url=User.image_url,
+    last_message_at=ConversationParticipant.last_message_at,
+    unread_count=ConversationParticipant.unread_count,
+)
+
+
+def message_page(query, timestamp_col, id_col):
+    """A page of messages from `query` (which must select from Message)."""
+
+    names = MESSAGE_FIELDS.requested()
+    query = query.with_entities(*MESSAGE_FIELDS.select(names))
+    if {'username', 'image_url'} & set(names):
+        query = query.join(User, User.id == Message.user_id)
+
+    page = paginate(query, timestamp_col, id_col)
+    data = MESSAGE_FIELDS.dump(page.items)
+    if 'liked' in names:
+        liked = g.user.liked_among(item['id'] for item in data)
+        for item in data:
+            item['liked'] = item['id'] in liked
+    return page_response(page, data)
+
+
+def user_columns(names):
+    """Columns for USER_FIELDS `names`, including whether the viewer follows
+    each user."""
+
+    columns = USER_FIELDS.select(names)
+    if 'following' in names:
+        mine = aliased(Follows)
+        columns.append(exists().where(mine.user_following_id == g.user.id,
+                                      mine.user_being_followed_id == User.id)
+                       .label('following'))
+    return columns
+
+
+def user_page(query, id_col):
+    """A page of users from `query` (which must select from User).
+
+    Follow rows have no timestamp, so these pages go by user id, highest
+    first, and `?before=` takes an id.
+    """
+
+    query = query.with_entities(*user_columns(USER_FIELDS.requested()))
+
+    before = request.args.get('before', type=int)
+    if before:
+        query = query.filter(id_col < before)
+
+    per_page = page_size()
+    rows = query.order_by(id_col.desc()).limit(per_page + 1).all()
+    older = str(rows[per_page - 1].id) if len(rows) > per_page else None
+    page = Page(rows[:per_page], older_cursor=older)
+    return page_response(page, USER_FIELDS.dump(page.items))
+
+
+##############################################################################
+# Errors and auth
+
+
+@api.errorhandler(HTTPException)
+def json_error(error):
+    return jsonify(error=error.description), error.code
+
+
+@api.before_request
+def require_login():
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+
+def visible_user(user_id):
+    """404 unless `user_id` exists and hasn't blocked the viewer."""
+
+    if not db.session.scalar(exists().where(User.id == user_id).select()):
+        abort(404)
+    if user_id in block_list.get(g.user.id).blocked_by:
+        abort(404)
+
+
+##############################################################################
+# Reading
+
+
+@api.route('/timeline')
+def timeline():
+    """The viewer's home timeline."""
+
+    query = (db.session.query(Message)
+             .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+             .filter(TimelineEntry.owner_id == g.user.id,
+                     block_list.visible_to(g.user.id, TimelineEntry.author_id)))
+    return message_page(query, TimelineEntry.timestamp, TimelineEntry.message_id)
+
+
+@api.route('/users/<int:user_id>')
+def user(user_id):
+    """One profile."""
+
+    visible_user(user_id)
+    row = db.session.execute(
+        select(*user_columns(USER_FIELDS.requested())).where(User.id == user_id)).one()
+    return jsonify(USER_FIELDS.dump([row])[0])
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages."""
+
+    visible_user(user_id)
+    query = (db.session.query(Message)
+             .filter(Message.user_id == user_id,
+                     block_list.visible_to(g.user.id, Message.user_id)))
+    return message_page(query, Message.timestamp, Message.id)
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """The messages a user has liked."""
+
+    visible_user(user_id)
+    query = (db.session.query(Message)
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id,
+                     block_list.visible_to(g.user.id, Message.user_id)))
+    return message_page(query, Message.timestamp, Message.id)
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Who a user follows."""
+
+    visible_user(user_id)
+    query = (db.session.query(User)
+             .join(Follows, Follows.user_being_followed_id == User.id)
+             .filter(Follows.user_following_id == user_id))
+    return user_page(query, User.id)
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Who follows a user."""
+
+    visible_user(user_id)
+    query = (db.session.query(User)
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user_id))
+    return user_page(query, User.id)
+
+
+@api.route('/inbox')
+def inbox():
+    """The viewer's conversations, most recently active first."""
+
+    names = THREAD_FIELDS.requested()
+    query = (db.session.query(*THREAD_FIELDS.select(names))
+             .select_from(ConversationParticipant)
+             .filter(ConversationParticipant.user_id == g.user.id,
+                     block_list.visible_to(g.user.id, ConversationParticipant.other_user_id)))
+    if {'username', 'image_url'} & set(names):
+        query = query.join(User, User.id == ConversationParticipant.other_user_id)
+
+    page = paginate(query, ConversationParticipant.last_message_at,
+                    ConversationParticipant.conversation_id,
+                    key=lambda row: (row.last_message_at, row.conversation_id))
+    return page_response(page, THREAD_FIELDS.dump(page.items))
+
+
+##############################################################################
+# Writing
+
+
+@api.route('/messages/<int:message_id>/like', methods=['POST', 'PUT', 'DELETE'])
+def like(message_id):
+    """Like (PUT), unlike (DELETE) or toggle (POST) a message."""
+
+    author_id = db.session.scalar(select(Message.user_id).where(Message.id == message_id))
+    if author_id is None:
+        abort(404)
+    if author_id == g.user.id:
+        abort(403, "You can't like your own messages.")
+
+    change = {'POST': likes.toggle, 'PUT': likes.like, 'DELETE': likes.unlike}
+    state = change[request.method](g.user.id, message_id)
+    db.session.commit()
+    return jsonify(state._asdict())
+
+
+@api.route('/users/<int:user_id>/follow', methods=['POST', 'PUT', 'DELETE'])
+def follow(user_id):
+    """Follow (PUT), unfollow (DELETE) or toggle (POST) a user."""
+
+    visible_user(user_id)
+    if user_id == g.user.id:
+        abort(403, "You can't follow yourself.")
+
+    change = {'POST': follows.toggle, 'PUT': follows.follow, 'DELETE': follows.unfollow}
+    state = change[request.method](g.user.id, user_id)
+    db.session.commit()
+    return jsonify(state._asdict())
+
+
+##############################################################################
+# Compression
+
+
+@api.after_request
+def compress(response):
+    """Compress large responses with the best encoding the client accepts."""
+
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < current_app.config.get('API_COMPRESS_MIN_SIZE', 1024):
+        return response
+
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(data, compresslevel=6))
+    else:
+        return response
+
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -1,13 +1,43 @@
+import json
+import math
 import os
+import time
 
-from flask import Flask, render_template, request, flash, redirect, session, g, abort
+from flask import (Flask, render_template, stream_template, get_flashed_messages, request, flash,
+                   redirect, session, g, abort, jsonify)
 # from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import delete, exists, select, true
+from sqlalchemy.orm import aliased, joinedload, undefer
 from sqlalchemy.exc import IntegrityError
-from flask_bcrypt import Bcrypt
+from werkzeug.middleware.proxy_fix import ProxyFix
 from forms import UserAddForm, LoginForm, MessageForm, EditProfileForm, DirectMessageForm
-from models import db, connect_db, User, Message, Likes, BlockedUsers, DirectMessage
+from models import (db, connect_db, User, Message, Likes, Follows, DirectMessage, TimelineEntry,
+                    ConversationParticipant)
+from pagination import Keyset, paginate
+from search import search_users
+from blocking import BlockList
+from throttle import LoginGuard, TokenBucket
+import api
+import async_db
+import bulk_load
+import cache
+import conversations
+import counters
+import db_pool
+import follows
+import fragments
+import http_cache
+import identity
+import likes
+import metrics
+import migrations
+import passwords
+import query_log
+import timeline
 
 CURR_USER_KEY = "curr_user"
+CURR_USER_SNAPSHOT_KEY = "curr_user_snapshot"
+BLOCKS_CHANGED_KEY = "blocks_changed_at"
 
 app = Flask(__name__)
 
@@ -15,15 +45,87 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = json.loads(os.environ.get('SQLALCHEMY_ENGINE_OPTIONS', '{}'))
+app.config['DATABASE_REPLICA_URL'] = os.environ.get('DATABASE_REPLICA_URL')
+app.config['REPLICA_PIN_SECONDS'] = float(os.environ.get('REPLICA_PIN_SECONDS', 5))
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = bool(int(os.environ.get('DB_POOL_PRE_PING', 0)))
+app.config['DB_STATEMENT_TIMEOUT'] = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))  # ms; 0 is none
+app.config['SQLALCHEMY_ECHO'] = bool(int(os.environ.get('SQLALCHEMY_ECHO', 0)))
+app.config['QUERY_LOG_SLOW_MS'] = float(os.environ.get('QUERY_LOG_SLOW_MS', 100))
+app.config['QUERY_LOG_SAMPLE_RATE'] = float(os.environ.get('QUERY_LOG_SAMPLE_RATE', 0.01))
+app.config['QUERY_LOG_TOP'] = int(os.environ.get('QUERY_LOG_TOP', 5))
+app.config['SERVER_TIMING'] = bool(int(os.environ.get('SERVER_TIMING', 1)))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['FEED_PAGE_SIZE'] = int(os.environ.get('FEED_PAGE_SIZE', 100))
+app.config['FEED_MAX_PAGE_SIZE'] = int(os.environ.get('FEED_MAX_PAGE_SIZE', 200))
+app.config['API_COMPRESS_MIN_SIZE'] = int(os.environ.get('API_COMPRESS_MIN_SIZE', 1024))
+app.config['STREAM_BATCH_SIZE'] = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+app.config['STREAM_CHUNK_SIZE'] = int(os.environ.get('STREAM_CHUNK_SIZE', 8192))
+app.config['SEARCH_PAGE_SIZE'] = int(os.environ.get('SEARCH_PAGE_SIZE', 30))
+app.config['SEARCH_MAX_RESULTS'] = int(os.environ.get('SEARCH_MAX_RESULTS', 300))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_MAX_PENDING'] = int(os.environ.get('PASSWORD_MAX_PENDING', 0)) or None
+app.config['PASSWORD_TIMEOUT'] = float(os.environ.get('PASSWORD_TIMEOUT', 10))
+app.config['LOGIN_USER_RATE'] = float(os.environ.get('LOGIN_USER_RATE', 5 / 60))
+app.config['LOGIN_USER_BURST'] = int(os.environ.get('LOGIN_USER_BURST', 10))
+app.config['LOGIN_IP_RATE'] = float(os.environ.get('LOGIN_IP_RATE', 1))
+app.config['LOGIN_IP_BURST'] = int(os.environ.get('LOGIN_IP_BURST', 30))
+app.config['LOGIN_UNKNOWN_TTL'] = int(os.environ.get('LOGIN_UNKNOWN_TTL', 30))
+# proxies (load balancers) in front of the app whose X-Forwarded-For and
+# X-Forwarded-Proto to trust; 0 trusts none and uses the socket's address
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 300))
+app.config['BLOCK_CACHE_TTL'] = int(os.environ.get('BLOCK_CACHE_TTL', 5))
+app.config['ASYNC_VIEWS'] = bool(int(os.environ.get('ASYNC_VIEWS', 0)))
+app.config['ASYNC_DATABASE_URL'] = os.environ.get('ASYNC_DATABASE_URL')
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
 # toolbar = DebugToolbarExtension(app)
 
-connect_db(app)
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'],
+                            x_proto=app.config['TRUSTED_PROXIES'])
 
+metrics.init_app(app)
+connect_db(app)
+query_log.init_app(app)
+passwords.init_app(app)
+http_cache.init_app(app)
+fragment_cache = fragments.init_app(app)
+async_database = async_db.init_app(app)
+app.cli.add_command(migrations.db_cli)
+app.cli.add_command(bulk_load.bulk_cli)
+app.cli.add_command(timeline.timeline_cli)
+app.cli.add_command(counters.counters_cli)
+app.cli.add_command(metrics.metrics_cli)
+
+# schema changes are applied with `flask db upgrade`, never at import
 with app.app_context():
-    db.create_all()
+    migrations.warn_if_behind()
+
+# Anything callable as loader(user_id, session_snapshot) -> user-or-None works
+# here; use identity.load_user to skip the snapshot cache entirely.
+user_loader = identity.SnapshotUserLoader(maxsize=app.config['USER_CACHE_SIZE'],
+                                          ttl=app.config['USER_CACHE_TTL'])
+login_guard = LoginGuard(TokenBucket(app.config['LOGIN_USER_RATE'], app.config['LOGIN_USER_BURST']),
+                         TokenBucket(app.config['LOGIN_IP_RATE'], app.config['LOGIN_IP_BURST']),
+                         unknown_ttl=app.config['LOGIN_UNKNOWN_TTL'])
+block_list = BlockList(maxsize=app.config['USER_CACHE_SIZE'],
+                       ttl=app.config['BLOCK_CACHE_TTL'])
+api.init_app(app, block_list)
+cache.watch('user_snapshots', user_loader.cache)
+cache.watch('block_lists', block_list.cache)
+cache.watch('fragments', fragment_cache)
 
 
 ##############################################################################
@@ -32,19 +134,42 @@ with app.app_context():
 
 @app.before_request 
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is an identity.CurrentUser: the navbar fields come from a cached
+    snapshot and the full row is only loaded if the view needs more.
+    """
+
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        g.user = user_loader(session[CURR_USER_KEY], session.get(CURR_USER_SNAPSHOT_KEY))
+        if g.user:
+            block_list.expire_before(g.user.id, session.get(BLOCKS_CHANGED_KEY))
 
     else:
         g.user = None
 
 
+@app.errorhandler(identity.UserGone)
+def user_gone(error):
+    """The session's account was deleted elsewhere: carry on logged out."""
+
+    do_logout()
+    return redirect(request.full_path if request.method == 'GET' else "/")
+
+
+@app.errorhandler(passwords.HasherBusy)
+def hasher_busy(error):
+    """Password checks are backed up; shed the request rather than queue it."""
+
+    return ("Too many sign-ins right now. Please try again in a moment.",
+            503, {"Retry-After": "5"})
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_USER_SNAPSHOT_KEY] = identity.snapshot(user)
 
 
 def do_logout():
@@ -52,6 +177,7 @@ def do_logout():
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
+    session.pop(CURR_USER_SNAPSHOT_KEY, None)
 
 
 @app.route('/signup', methods=["GET", "POST"])
@@ -77,6 +203,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            login_guard.forget(user.username)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -97,10 +224,17 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        # refuse before touching the database or bcrypt
+        retry_after = login_guard.retry_after(form.username.data, request.remote_addr)
+        if retry_after:
+            flash("Too many sign-in attempts. Please wait a moment and try again.", 'danger')
+            return (render_template('users/login.html', form=form), 429,
+                    {"Retry-After": str(math.ceil(retry_after))})
+
+        user = login_guard.authenticate(form.username.data, form.password.data)
 
         if user:
+            db.session.commit()  # saves a rehashed password, if any
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -118,44 +252,156 @@ def logout():
     return redirect('/login')
 
 
+##############################################################################
+# Feed loading
+#
+# Message templates show each message's author, and Message.user is a lazy
+# relationship, so a feed query that doesn't load authors up front costs one
+# SELECT per message. Every feed query declares its loading strategy here.
+
+def with_author():
+    """Load option: fetch each message's author in the same query, navbar
+    columns only."""
+
+    return (joinedload(Message.user, innerjoin=True)
+            .load_only(User.id, User.username, User.image_url))
+
+
+def viewer_tag():
+    """What a page shows because of who's viewing it, for ETags: the navbar
+    and who the viewer blocks or is blocked by."""
+
+    if not g.user:
+        return None
+    blocks = block_list.get(g.user.id)
+    return (g.user.id, g.user.username, g.user.image_url,
+            sorted(blocks.blocking), sorted(blocks.blocked_by))
+
+
+def liked_ids(messages):
+    """Which of `messages` the current user has liked, in one query.
+
+    Templates take this as `liked` to draw like buttons, so a page never
+    loads the user's whole like history.
+    """
+
+    return g.user.liked_among(msg.id for msg in messages) if g.user else set()
+
+
+def follow_list(user_id, followers=False):
+    """Who `user_id` follows (or, with followers=True, who follows them), as
+    (user, followed by the viewer) rows.
+
+    Read through a server-side cursor STREAM_BATCH_SIZE rows at a time, so
+    render it with stream_page; a popular user's list never sits in memory.
+    """
+
+    if followers:
+        listed, other = Follows.user_following_id, Follows.user_being_followed_id
+    else:
+        listed, other = Follows.user_being_followed_id, Follows.user_following_id
+
+    mine = aliased(Follows)
+    followed = exists().where(mine.user_following_id == g.user.id,
+                              mine.user_being_followed_id == User.id)
+
+    return db.session.execute(
+        select(User, followed)
+        .join(Follows, listed == User.id)
+        .where(other == user_id)
+        .execution_options(yield_per=app.config['STREAM_BATCH_SIZE']))
+
+
+def stream_page(template_name, **context):
+    """Like render_template, but send the page while it renders.
+
+    The shell goes out as soon as STREAM_CHUNK_SIZE bytes are ready and rows
+    follow as they're produced, so long lists start arriving at once and are
+    never held whole in memory.
+    """
+
+    # take the flashes now, while the session cookie can still be updated
+    get_flashed_messages(with_categories=True)
+    return app.response_class(_chunked(stream_template(template_name, **context)),
+                              mimetype='text/html')
+
+
+def _chunked(parts):
+    # Jinja yields a string per template node; batch them into packets
+    size = app.config['STREAM_CHUNK_SIZE']
+    buffer, buffered = [], 0
+    for part in parts:
+        buffer.append(part)
+        buffered += len(part)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
 ##############################################################################
 # General user routes:
 
 @app.route('/users')
+@db_pool.read_only
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search usernames, bios and
+    locations (see search.py), and a 'page' param.
     """
 
-    search = request.args.get('q')
+    search = request.args.get('q', '').strip()
+    criteria = [block_list.visible_to(g.user.id, User.id)] if g.user else []
+    users = search_users(search, request.args.get('page', 1, type=int), criteria)
+    following = g.user.following_among(u.id for u in users) if g.user else set()
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    not_modified = http_cache.check_etag([(u.id, u.row_version) for u in users],
+                                         users.has_next, sorted(following), viewer_tag())
+    if not_modified:
+        return not_modified
 
-    return render_template('users/index.html', users=users)
+    return stream_page('users/index.html', users=users, search=search, following=following)
 
 
 @app.route('/users/<int:user_id>')
+@db_pool.read_only
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    # the viewer's row comes along for its version: it changes when they
+    # follow, like or edit their profile
+    viewer_id = g.user.id if g.user else None
+    users = {u.id: u for u in User.query.options(undefer(User.row_version))
+                                        .filter(User.id.in_({user_id, viewer_id} - {None}))}
+    if user_id not in users:
+        abort(404)
+    user = users[user_id]
+
+    messages = Message.query.filter(Message.user_id == user_id)
+    if g.user:
+        # blocked viewers get a 404; blockers keep the page (to unblock)
+        # but not the messages
+        if user_id in block_list.get(g.user.id).blocked_by:
+            abort(404)
+        messages = messages.filter(block_list.visible_to(g.user.id, Message.user_id))
+
+    viewer = users.get(viewer_id)
+    not_modified = http_cache.check_etag(user.row_version, viewer and viewer.row_version,
+                                         viewer_tag())
+    if not_modified:
+        return not_modified
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    page = paginate(messages, Message.timestamp, Message.id)
+    return render_template('users/show.html', user=user, messages=page.items, page=page,
+                           liked=liked_ids(page.items))
 
 
 @app.route('/users/<int:user_id>/following')
+@db_pool.read_only
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -164,10 +410,11 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return stream_page('users/following.html', user=user, users=follow_list(user_id))
 
 
 @app.route('/users/<int:user_id>/followers')
+@db_pool.read_only
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -176,7 +423,8 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    return stream_page('users/followers.html', user=user,
+                       users=follow_list(user_id, followers=True))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -187,8 +435,8 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    User.query.get_or_404(follow_id)
+    follows.follow(g.user.id, follow_id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -202,19 +450,27 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    User.query.get_or_404(follow_id)
+    follows.unfollow(g.user.id, follow_id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 @app.route('/users/<int:user_id>/likes', methods=["GET"])
+@db_pool.read_only
 def show_likes(user_id):
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect('/')
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, likes=user.likes)
+    page = paginate(Message.query
+                    .join(Likes, Likes.message_id == Message.id)
+                    .filter(Likes.user_id == user_id,
+                            block_list.visible_to(g.user.id, Message.user_id))
+                    .options(with_author()),
+                    Message.timestamp, Message.id)
+    return render_template('users/likes.html', user=user, likes=page.items, page=page,
+                           liked=liked_ids(page.items))
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -227,7 +483,7 @@ def profile():
     form = EditProfileForm(obj=g.user) #pre-fill the form with the current user's data
 
     if form.validate_on_submit():
-        if User.authenticate(username=g.user.username, password=form.password.data):
+        if g.user.check_password(form.password.data):
             g.user.username = form.username.data
             g.user.email = form.email.data
             g.user.image_url = form.image_url.data or "/static/images/default-pic.png"
@@ -235,6 +491,10 @@ def profile():
             g.user.bio = form.bio.data
             g.user.location = form.location.data
             db.session.commit()
+            login_guard.forget(g.user.username)
+            fragment_cache.invalidate('user', g.user.id)
+
+            session[CURR_USER_SNAPSHOT_KEY] = user_loader.remember(g.user.hydrate())
             flash('Profile updated successfully!', 'success')
             return redirect(f'/users/{g.user.id}')
         else:
@@ -254,9 +514,13 @@ def delete_user():
         return redirect("/")
 
     do_logout()
+    user_loader.invalidate(g.user.id)
 
-    db.session.delete(g.user)
+    # follows, likes, messages etc. go with the row via ON DELETE CASCADE
+    counters.user_deleted(g.user.id)
+    db.session.execute(delete(User).where(User.id == g.user.id))
     db.session.commit()
+    fragment_cache.invalidate('user', g.user.id)
 
     return redirect("/signup")
 
@@ -280,6 +544,9 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        counters.bump(g.user.id, messages_count=1)
+        timeline.fan_out(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -288,11 +555,28 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@db_pool.read_only
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = db.session.get(Message, message_id,
+                         options=[with_author().undefer(User.row_version)])
+    if msg and g.user and block_list.hidden_from(g.user.id, msg.user_id):
+        abort(404)
+
+    liked = liked_ids([msg] if msg else [])
+    following = bool(msg and g.user and g.user.id != msg.user_id
+                     and g.user.is_following(msg.user))
+
+    if msg:
+        # messages can't be edited; only their author and the viewer change
+        not_modified = http_cache.check_etag(msg.user.row_version, sorted(liked), following,
+                                             viewer_tag())
+        if not_modified:
+            return not_modified
+
+    return render_template('messages/show.html', message=msg, liked=liked,
+                           following=following)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -304,19 +588,27 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    counters.message_deleted(msg)
     db.session.delete(msg)
     db.session.commit()
+    fragment_cache.invalidate('message', message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 #####################################################################
 ## Likes routes
-@app.route('/messages/<int:message_id>/like', methods=['POST'])
+@app.route('/messages/<int:message_id>/like', methods=['POST', 'PUT', 'DELETE'])
 def add_like(message_id):
-    """Toggle a liked message for the currently-logged-in user."""
-    print("Success!", message_id)
+    """Like or unlike a message for the currently-logged-in user.
+
+    POST toggles (the like buttons); PUT likes and DELETE unlikes, and both
+    are idempotent. Clients asking for JSON (static/js/likes.js) get the new
+    state and like count back instead of a redirect.
+    """
 
     if not g.user:
+        if wants_json():
+            return jsonify(error="Access unauthorized."), 401
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
@@ -324,17 +616,20 @@ def add_like(message_id):
     if liked_message.user_id == g.user.id:
         return abort(403)
 
-    user_likes = g.user.likes
-
-    if liked_message in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_message]
-    else:
-        g.user.likes.append(liked_message)
-
+    change = {'POST': likes.toggle, 'PUT': likes.like, 'DELETE': likes.unlike}
+    state = change[request.method](g.user.id, message_id)
     db.session.commit()
 
+    if wants_json():
+        return jsonify(state._asdict())
     return redirect("/")
 
+
+def wants_json():
+    """Did the client ask for a JSON response?"""
+
+    return request.accept_mimetypes.best == 'application/json'
+
 ########### BLOCK
 @app.route('/users/block/<int:user_id>', methods=['POST'])
 def block_user(user_id):
@@ -348,9 +643,10 @@ def block_user(user_id):
         flash("You cannot block yourself.", "danger")
         return redirect("/")
 
-    block = BlockedUsers(user_id=g.user.id, blocked_user_id=user_id)
-    db.session.add(block)
+    block_list.block(g.user.id, user_id)
     db.session.commit()
+    block_list.invalidate(g.user.id, user_id)
+    session[BLOCKS_CHANGED_KEY] = time.time()
 
     flash(f"{blocked_user.username} has been blocked.", "success")
     return redirect(f"/users/{user_id}")
@@ -362,10 +658,10 @@ def unblock_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    block = BlockedUsers.query.filter_by(user_id=g.user.id, blocked_user_id=user_id).first()
-    if block:
-        db.session.delete(block)
+    if block_list.unblock(g.user.id, user_id):
         db.session.commit()
+        block_list.invalidate(g.user.id, user_id)
+        session[BLOCKS_CHANGED_KEY] = time.time()
         flash("User has been unblocked.", "success")
     return redirect(f"/users/{user_id}")
 
@@ -381,15 +677,13 @@ def send_message(user_id):
     if recipient == g.user:
         flash("You cannot send a message to yourself.", "danger")
         return redirect("/")
+    if block_list.hidden_from(g.user.id, user_id, fresh=True):
+        flash("You cannot message this user.", "danger")
+        return redirect("/")
 
     form = DirectMessageForm()
     if form.validate_on_submit():
-        message = DirectMessage(
-            sender_id=g.user.id,
-            recipient_id=user_id,
-            text=form.text.data
-        )
-        db.session.add(message)
+        conversations.send(g.user.id, user_id, form.text.data)
         db.session.commit()
         flash("Message sent!", "success")
         return redirect(f"/users/{user_id}")
@@ -407,44 +701,78 @@ def reply_message(user_id):
     if recipient == g.user:
         flash("You cannot reply to yourself.", "danger")
         return redirect("/")
+    if block_list.hidden_from(g.user.id, user_id, fresh=True):
+        flash("You cannot message this user.", "danger")
+        return redirect("/")
 
     form = DirectMessageForm()
     if form.validate_on_submit():
-        message = DirectMessage(
-            sender_id=g.user.id,
-            recipient_id=user_id,
-            text=form.text.data
-        )
-        db.session.add(message)
+        conversations.send(g.user.id, user_id, form.text.data)
         db.session.commit()
         flash("Reply sent!", "success")
-        return redirect("/dm/inbox")
+        return redirect(f"/dm/with/{user_id}")
 
     return render_template('dm/reply.html', form=form, recipient=recipient)
 
 
 @app.route('/dm/inbox')
+@http_cache.cache_control("private, no-store")
 def inbox():
-    """Show inbox with direct messages."""
+    """Show inbox: the user's conversations, most recently active first."""
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    # Create an instance of DirectMessageForm
-    form = DirectMessageForm()
+    page = paginate(conversations.inbox_query(g.user.id)
+                    .filter(block_list.visible_to(g.user.id,
+                                                  ConversationParticipant.other_user_id))
+                    .options(joinedload(ConversationParticipant.other_user, innerjoin=True)),
+                    ConversationParticipant.last_message_at,
+                    ConversationParticipant.conversation_id,
+                    key=lambda p: (p.last_message_at, p.conversation_id))
+    return stream_page('dm/inbox.html', threads=page.items, page=page)
+
+
+@app.route('/dm/with/<int:user_id>')
+@http_cache.cache_control("private, no-store")
+def conversation(user_id):
+    """Show the thread with one user, newest first, and mark it read."""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    messages = DirectMessage.query.filter_by(recipient_id=g.user.id).order_by(DirectMessage.timestamp.desc()).all()
-    return render_template('dm/inbox.html', messages=messages, form=form)  # Pass form to the template
+    other = User.query.get_or_404(user_id)
+    if block_list.hidden_from(g.user.id, user_id):
+        abort(404)
+
+    thread = conversations.find(g.user.id, user_id)
+    if thread is None:
+        return redirect(f"/dm/send/{user_id}")
+
+    page = paginate(conversations.thread_query(thread.id),
+                    DirectMessage.timestamp, DirectMessage.id)
+    html = render_template('dm/thread.html', other=other, messages=page.items, page=page,
+                           form=DirectMessageForm())
+
+    # after rendering, so the commit doesn't expire the rows the page shows
+    conversations.mark_read(thread.id, g.user.id)
+    db.session.commit()
+    return html
 
 @app.route('/dm/sent')
+@http_cache.cache_control("private, no-store")
 def sent_messages():
     """Show sent messages."""
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    messages = DirectMessage.query.filter_by(sender_id=g.user.id).order_by(DirectMessage.timestamp.desc()).all()
-    return render_template('dm/sent.html', messages=messages)
+    page = paginate(DirectMessage.query
+                    .filter_by(sender_id=g.user.id)
+                    .filter(block_list.visible_to(g.user.id, DirectMessage.recipient_id))
+                    .options(joinedload(DirectMessage.recipient, innerjoin=True)),
+                    DirectMessage.timestamp, DirectMessage.id)
+    return render_template('dm/sent.html', messages=page.items, page=page)
 
 
 
@@ -453,32 +781,170 @@ def sent_messages():
 
 
 @app.route('/')
+@db_pool.read_only
 def homepage():
     """Show homepage:
     - anon users: no messages
-    - logged in: 100 most recent messages from users followed by the logged-in user
+    - logged in: most recent messages from users followed by the logged-in user,
+      a page at a time
     """
     if g.user:
-        followed_user_ids = [user.id for user in g.user.following] + [g.user.id]  # List of user IDs the logged-in user is following + their own ID
-        messages = Message.query.filter(Message.user_id.in_(followed_user_ids)).order_by(Message.timestamp.desc()).limit(100).all()
-        return render_template('home.html', messages=messages)
+        # read from the materialized timeline; see timeline.py
+        page = paginate(timeline.home_query(g.user.id)
+                        .filter(block_list.visible_to(g.user.id, TimelineEntry.author_id))
+                        .options(with_author()),
+                        TimelineEntry.timestamp, TimelineEntry.message_id)
+        return render_template('home.html', messages=page.items, page=page,
+                               liked=liked_ids(page.items))
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Async views
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# With ASYNC_VIEWS set, the busiest read pages are served by these instead:
+# each sends its independent queries (feed, liked-set, block-set, the
+# viewer's counters) to async_db together and waits one round trip for all
+# of them. They render the same templates as the views they replace.
+
+async def fetch_all(**statements):
+    """Run `statements` concurrently; returns their rows by name. None
+    statements are skipped and come back as None."""
+
+    names = [name for name, statement in statements.items() if statement is not None]
+    rows = await async_database.gather(*(statements[name] for name in names))
+    return dict.fromkeys(statements) | dict(zip(names, rows))
+
+
+def block_filter(column):
+    """The viewer's visible_to criterion on `column`, plus the block-set
+    query to run alongside it when their blocks aren't cached (the
+    criterion then always anti-joins)."""
+
+    if not g.user:
+        return true(), None
+    if block_list.cached(g.user.id) is None:
+        return block_list.excluding(g.user.id, column), block_list.statement(g.user.id)
+    return block_list.visible_to(g.user.id, column), None
+
+
+def liked_in(window):
+    """Query for the viewer's likes among the message ids `window` selects."""
+
+    return select(Likes.message_id).where(Likes.user_id == g.user.id,
+                                          Likes.message_id.in_(window.statement))
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def take_results(rows):
+    """Put the block-set and viewer rows fetch_all brought back to use."""
+
+    if rows.get('blocks') is not None:
+        block_list.remember(g.user.id, rows['blocks'])
+    if rows.get('viewer') is not None:
+        # no row means the user is gone: hydrate raises UserGone
+        g.user.hydrate(rows['viewer'][0].User if rows['viewer'] else None)
+
+
+@db_pool.read_only
+async def homepage_async():
+    """homepage, with its queries run concurrently."""
+
+    if not g.user:
+        return render_template('home-anon.html')
+
+    keyset = Keyset(TimelineEntry.timestamp, TimelineEntry.message_id)
+    visible, blocks = block_filter(TimelineEntry.author_id)
+    feed = timeline.home_query(g.user.id).filter(visible)
+
+    rows = await fetch_all(
+        messages=keyset.apply(feed.options(with_author())).statement,
+        liked=liked_in(keyset.apply(feed.with_entities(Message.id))),
+        viewer=None if g.user.is_hydrated else select(User).where(User.id == g.user.id),
+        blocks=blocks)
+    take_results(rows)
+
+    page = keyset.page([msg for msg, in rows['messages']])
+    return render_template('home.html', messages=page.items, page=page,
+                           liked={id for id, in rows['liked']})
+
+
+@db_pool.read_only
+async def users_show_async(user_id):
+    """users_show, with its queries run concurrently.
+
+    The messages are fetched alongside the profile rather than after the
+    ETag check, so a 304 costs a wasted feed query but never a second
+    round trip.
+    """
+
+    viewer_id = g.user.id if g.user else None
+    keyset = Keyset(Message.timestamp, Message.id)
+    visible, blocks = block_filter(Message.user_id)
+    messages = Message.query.filter(Message.user_id == user_id, visible)
+
+    rows = await fetch_all(
+        users=(select(User).options(undefer(User.row_version))
+               .where(User.id.in_({user_id, viewer_id} - {None}))),
+        messages=keyset.apply(messages).statement,
+        liked=viewer_id and liked_in(keyset.apply(messages.with_entities(Message.id))),
+        blocks=blocks)
+
+    users = {u.id: u for u, in rows['users']}
+    if g.user:
+        rows['viewer'] = [row for row in rows['users'] if row.User.id == viewer_id]
+    take_results(rows)
+
+    if user_id not in users:
+        abort(404)
+    user = users[user_id]
+    if g.user and user_id in block_list.get(g.user.id).blocked_by:
+        abort(404)
+
+    viewer = users.get(viewer_id)
+    not_modified = http_cache.check_etag(user.row_version, viewer and viewer.row_version,
+                                         viewer_tag())
+    if not_modified:
+        return not_modified
+
+    page = keyset.page([msg for msg, in rows['messages']])
+    return render_template('users/show.html', user=user, messages=page.items, page=page,
+                           liked={id for id, in rows['liked'] or ()})
+
+
+@http_cache.cache_control("private, no-store")
+async def inbox_async():
+    """inbox, with its queries run concurrently."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    keyset = Keyset(ConversationParticipant.last_message_at,
+                    ConversationParticipant.conversation_id,
+                    key=lambda p: (p.last_message_at, p.conversation_id))
+    visible, blocks = block_filter(ConversationParticipant.other_user_id)
+
+    rows = await fetch_all(
+        threads=keyset.apply(conversations.inbox_query(g.user.id)
+                             .filter(visible)
+                             .options(joinedload(ConversationParticipant.other_user,
+                                                 innerjoin=True))).statement,
+        blocks=blocks)
+    take_results(rows)
+
+    # not stream_page: a streamed body would be primed inside the context
+    # asgiref runs this view in, then finished outside it
+    page = keyset.page([thread for thread, in rows['threads']])
+    return render_template('dm/inbox.html', threads=page.items, page=page)
+
+
+# endpoint -> the async view that replaces it
+ASYNC_VIEWS = {
+    'homepage': homepage_async,
+    'users_show': users_show_async,
+    'inbox': inbox_async,
+}
+
+if app.config['ASYNC_VIEWS']:
+    app.view_functions.update(ASYNC_VIEWS)
@@ -0,0 +1,100 @@
+"""Running a view's independent queries concurrently.
+
+Flask runs an `async def` view in an event loop of its own for the length
+of the request (through asgiref), but asyncpg connections belong to the loop
+that opened them. So the async engine lives on a single background loop
+thread per process, and `AsyncDatabase.gather` hands statements over to it.
+Each statement runs on its own pooled connection, and the view awaits all
+of them together: a page with four queries waits one round trip, not four.
+
+Results come back fully buffered. ORM objects are detached, with their
+loaded attributes intact (sessions don't expire on commit), so load
+everything a template needs up front, e.g. with joinedload.
+"""
+
+import asyncio
+import atexit
+import threading
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import db_pool
+
+# async driver for each backend the sync URL may name
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_url(url):
+    """`url` with its driver swapped for the backend's async one."""
+
+    url = make_url(url)
+    if url.get_dialect().is_async:
+        return url
+    try:
+        return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+    except KeyError:
+        raise ValueError(f"No async driver for {url.get_backend_name()!r}") from None
+
+
+class AsyncDatabase:
+    """An async engine driven by its own event loop thread.
+
+    The thread starts on first use, so creating one is free for processes
+    that never serve an async view.
+    """
+
+    def __init__(self, url, **engine_options):
+        self.engine = create_async_engine(async_url(url), **engine_options)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='async-db', daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    async def gather(self, *statements):
+        """Run `statements` concurrently, each in its own session; returns
+        a list of their result rows, in order."""
+
+        future = asyncio.run_coroutine_threadsafe(self._gather(statements), self.loop)
+        return await asyncio.wrap_future(future)
+
+    async def _gather(self, statements):
+        return await asyncio.gather(*map(self._fetch, statements))
+
+    async def _fetch(self, statement):
+        async with self.sessions() as session:
+            result = await session.execute(statement)
+            return result.all()
+
+    def dispose(self):
+        """Close pooled connections and stop the loop thread."""
+
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.engine.dispose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def init_app(app):
+    """The app's AsyncDatabase: ASYNC_DATABASE_URL, or the sync database
+    through its async driver. Its pool is sized and instrumented like the
+    sync one (see db_pool.async_engine_options)."""
+
+    url = async_url(app.config.get('ASYNC_DATABASE_URL') or app.config['SQLALCHEMY_DATABASE_URI'])
+    database = AsyncDatabase(url, **db_pool.async_engine_options(app.config, url))
+    db_pool.watch({db_pool.ASYNC: database.engine.sync_engine})
+    atexit.register(database.dispose)
+    return database
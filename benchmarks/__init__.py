@@ -0,0 +1,19 @@
+"""Route benchmarks for Warbler.
+
+    python -m benchmarks.run --scale 100k --out report.json
+    python -m benchmarks.compare baseline.json report.json
+
+See run.py for what is measured and compare.py for how reports are judged.
+
+CI runs the 1k scale against a throwaway database and judges it by the
+stored baseline, baseline-1k.json:
+
+    createdb warbler-bench
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.run \\
+        --scale 1k --out report.json
+    python -m benchmarks.compare benchmarks/baseline-1k.json report.json
+
+The baseline's latencies come from one machine. Regenerate it on the CI
+runner type (same commands, --out benchmarks/baseline-1k.json) when that
+changes, or when a change is meant to move the numbers.
+"""
@@ -0,0 +1,74 @@
+"""Compare a benchmark report with a stored baseline.
+
+    python -m benchmarks.compare baseline.json report.json --latency-tolerance 0.25
+
+Prints a line per route. Exits with status 1 if any route regressed:
+- p50 or p99 latency grew by more than --latency-tolerance (a fraction),
+  and by more than --min-delta-ms;
+- it sends more statements than before;
+- peak RSS grew by more than --rss-tolerance.
+
+Reports are only compared if they used the same dataset and client.
+Latency depends on the machine, so keep one baseline per CI runner type.
+Statement counts don't depend on the machine.
+"""
+
+import argparse
+import json
+import sys
+
+
+def regressions(baseline, report, latency_tolerance=0.25, rss_tolerance=0.25, min_delta_ms=1.0):
+    """[(route, message)] for everything in `report` worse than `baseline`."""
+
+    for key in ('dataset', 'client'):
+        if baseline.get(key) != report.get(key):
+            return [('*', f"{key}s differ: {baseline.get(key)} vs {report.get(key)}")]
+
+    found = []
+    for name, new in report['routes'].items():
+        old = baseline['routes'].get(name)
+        if old is None:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if (new[key] > old[key] * (1 + latency_tolerance)
+                    and new[key] - old[key] > min_delta_ms):
+                found.append((name, f"{key} {old[key]:.2f} -> {new[key]:.2f}"))
+        if new['queries'] > old['queries']:
+            found.append((name, f"queries {old['queries']} -> {new['queries']}"))
+
+    if report['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + rss_tolerance):
+        found.append(('*', f"peak RSS {baseline['peak_rss_mb']} -> {report['peak_rss_mb']} MB"))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare a benchmark report with a baseline.")
+    parser.add_argument('baseline')
+    parser.add_argument('report')
+    parser.add_argument('--latency-tolerance', type=float, default=0.25)
+    parser.add_argument('--rss-tolerance', type=float, default=0.25)
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help="Ignore latency changes smaller than this.")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.report) as f:
+        report = json.load(f)
+
+    for name, new in report['routes'].items():
+        old = baseline['routes'].get(name, {})
+        print(f"{name:14} p50 {old.get('p50_ms', 0):8.2f} -> {new['p50_ms']:8.2f}ms  "
+              f"p99 {old.get('p99_ms', 0):8.2f} -> {new['p99_ms']:8.2f}ms  "
+              f"queries {old.get('queries', '-')} -> {new['queries']}")
+
+    found = regressions(baseline, report, args.latency_tolerance, args.rss_tolerance,
+                        args.min_delta_ms)
+    for name, message in found:
+        print(f"REGRESSION {name}: {message}")
+    sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
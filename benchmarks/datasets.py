@@ -0,0 +1,117 @@
+"""Fixed-scale benchmark datasets.
+
+Each scale is generated once by generator/create_csvs.py with a fixed seed,
+so every run (and every machine) benchmarks the same rows. The CSVs are
+cached under benchmarks/data/<scale>/ and bulk-loaded into the app's
+database.
+
+Loading drops every table first, so `load` only touches a database that is
+empty, or one whose name contains "bench" when `reload` is given. Pointing
+DATABASE_URL at a dev database by mistake can't wipe it.
+"""
+
+import os
+import subprocess
+import sys
+
+from sqlalchemy import exists, func, inspect, select
+
+from models import db, User
+import bulk_load
+import conversations
+import timeline
+
+SEED = 'warbler-bench'
+
+SCALES = {
+    '1k': dict(users=100, messages=1000, follows=2000, likes=2000),
+    '100k': dict(users=10000, messages=100000, follows=200000, likes=200000),
+    '1m': dict(users=100000, messages=1000000, follows=2000000, likes=2000000),
+}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, 'benchmarks', 'data')
+
+# direct messages sent to the viewer, for /dm/inbox
+INBOX_THREADS = 30
+
+
+def generate(scale, workers=1):
+    """Write `scale`'s CSVs unless they're cached; returns their directory."""
+
+    out = os.path.join(DATA_DIR, scale)
+    if os.path.exists(os.path.join(out, 'likes.csv')):
+        return out
+
+    os.makedirs(out, exist_ok=True)
+    args = [f"--{name}={value}" for name, value in SCALES[scale].items()]
+    subprocess.run([sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+                    f"--seed={SEED}", f"--workers={workers}", f"--out={out}", *args],
+                   check=True)
+    return out
+
+
+class UnsafeDatabase(Exception):
+    """Loading would drop data that doesn't look like a benchmark's."""
+
+
+def is_empty():
+    """Does the database hold no rows in the loadable tables?"""
+
+    # its own connection: a session transaction left open would block drop_all
+    with db.engine.connect() as conn:
+        inspector = inspect(conn)
+        return not any(inspector.has_table(table.name)
+                       and conn.scalar(select(exists().select_from(table)))
+                       for table in bulk_load.TABLES.values())
+
+
+def check_target(reload=False):
+    """Raise UnsafeDatabase unless loading may drop what's in the database."""
+
+    name = db.engine.url.database or ''
+    if is_empty():
+        return
+    if not reload:
+        raise UnsafeDatabase(f"{name} already holds data; pass --reload to replace it.")
+    if 'bench' not in name:
+        raise UnsafeDatabase(f"Refusing to drop {name}: benchmark databases' names "
+                             "must contain 'bench'.")
+
+
+def is_loaded(scale):
+    """Does the database already hold `scale`'s users?"""
+
+    if not inspect(db.engine).has_table(User.__tablename__):
+        return False
+    return db.session.scalar(select(func.count(User.id))) == SCALES[scale]['users']
+
+
+def load(scale, report=print, workers=1, reload=False):
+    """Load `scale` into an empty schema and prepare the viewer's pages.
+    `reload` allows dropping what's there (see check_target)."""
+
+    check_target(reload)
+    out = generate(scale, workers)
+    bulk_load.load({name: os.path.join(out, f"{name}.csv") for name in bulk_load.TABLES},
+                   fresh=True, report=report)
+    prepare(viewer_id(), report)
+
+
+def viewer_id():
+    """The benchmark's logged-in user: whoever follows the most people."""
+
+    return db.session.scalar(select(User.id)
+                             .order_by(User.following_count.desc(), User.id).limit(1))
+
+
+def prepare(viewer, report=print):
+    """Build the viewer's timeline and give them an inbox."""
+
+    timeline.backfill(viewer)
+    senders = db.session.scalars(select(User.id).where(User.id != viewer)
+                                 .order_by(User.id).limit(INBOX_THREADS))
+    for sender in senders:
+        conversations.send(sender, viewer, "benchmark hello")
+    db.session.commit()
+    report(f"prepared user {viewer}'s timeline and inbox")
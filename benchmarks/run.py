@@ -0,0 +1,241 @@
+"""Benchmark Warbler's main routes against a fixed-scale dataset.
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.run --scale 100k \\
+        --requests 200 --out report.json
+
+Loads the dataset (unless the database already holds it), logs in as the
+user who follows the most people, and requests each route --requests times
+after --warmup unrecorded requests. Requests go through Flask's test
+client, or with --wsgi through a local WSGI server over HTTP. A database
+that holds anything else (say another scale) is only replaced with
+--reload, and only if its name contains "bench"; see datasets.check_target.
+
+The JSON report records, per route, latency percentiles (p50/p99/max in
+ms), statements per request (counted with an engine event) and the
+process's peak RSS after the route ran. Compare two reports with
+`python -m benchmarks.compare`.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from sqlalchemy import event, select
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from app import app, CURR_USER_KEY
+from models import db, Follows, Message, User
+from benchmarks import datasets
+
+REPORT_VERSION = 1
+
+
+def routes(viewer, popular, message, other, follows_other):
+    """(name, method, urls) for every benchmarked request. Requests cycle
+    through `urls`; the POSTs' cycles undo themselves, so the data is the
+    same after every run."""
+
+    follow = (f"/users/follow/{other}", f"/users/stop-following/{other}")
+    return [
+        ("home", 'GET', ["/"]),
+        ("users", 'GET', ["/users"]),
+        ("users search", 'GET', ["/users?q=market"]),
+        ("profile", 'GET', [f"/users/{popular}"]),
+        ("followers", 'GET', [f"/users/{popular}/followers"]),
+        ("following", 'GET', [f"/users/{viewer}/following"]),
+        ("likes", 'GET', [f"/users/{viewer}/likes"]),
+        ("message", 'GET', [f"/messages/{message}"]),
+        ("inbox", 'GET', ["/dm/inbox"]),
+        ("like toggle", 'POST', [f"/messages/{message}/like"] * 2),
+        ("follow toggle", 'POST', list(reversed(follow) if follows_other else follow)),
+    ]
+
+
+def pick_targets(viewer):
+    """A popular profile, its latest message, and the least followed user
+    with whether the viewer follows them."""
+
+    popular = db.session.scalar(select(User.id).where(User.id != viewer)
+                                .order_by(User.followers_count.desc(), User.id).limit(1))
+    message = db.session.scalar(select(Message.id).where(Message.user_id == popular)
+                                .order_by(Message.timestamp.desc()).limit(1))
+    other = db.session.scalar(select(User.id).where(User.id != viewer)
+                              .order_by(User.followers_count, User.id).limit(1))
+    follows_other = db.session.get(Follows, (other, viewer)) is not None
+    return popular, message, other, follows_other
+
+
+##############################################################################
+# Clients: each returns a function making one request and reading the body
+
+
+def test_client(cookie):
+    client = app.test_client()
+    client.set_cookie(app.config['SESSION_COOKIE_NAME'], cookie)
+
+    def request(method, url):
+        resp = client.open(url, method=method)
+        resp.get_data()
+        resp.close()
+        return resp.status_code
+    return request
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def wsgi_client(cookie):
+    server = make_server('127.0.0.1', 0, app, threaded=False, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    headers = {'Cookie': f"{app.config['SESSION_COOKIE_NAME']}={cookie}"}
+
+    def request(method, url):
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_port)
+        conn.request(method, url, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        conn.close()
+        return resp.status
+    return request
+
+
+def session_cookie(user_id):
+    """A signed session cookie logging `user_id` in."""
+
+    return app.session_interface.get_signing_serializer(app).dumps({CURR_USER_KEY: user_id})
+
+
+##############################################################################
+# Measuring
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def percentile(values, pct):
+    return statistics.quantiles(values, n=100, method='inclusive')[pct - 1] if len(values) > 1 else values[0]
+
+
+def measure(request, method, urls, requests, warmup, statements):
+    """Time `requests` requests after `warmup` unrecorded ones, cycling
+    through `urls` and finishing the last cycle unrecorded."""
+
+    total = warmup + requests
+    for n in range(warmup):
+        request(method, urls[n % len(urls)])
+
+    latencies, queries, statuses = [], [], set()
+    for n in range(warmup, total):
+        before = statements[0]
+        started = time.perf_counter()
+        statuses.add(request(method, urls[n % len(urls)]))
+        latencies.append((time.perf_counter() - started) * 1000)
+        queries.append(statements[0] - before)
+
+    while total % len(urls):
+        request(method, urls[total % len(urls)])
+        total += 1
+
+    return {
+        'urls': urls,
+        'method': method,
+        'status': sorted(statuses),
+        'requests': requests,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(max(latencies), 3),
+        'queries': max(queries),
+        'mean_queries': round(statistics.fmean(queries), 2),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run(scale, requests=100, warmup=5, wsgi=False, reload=False, workers=1, report=print):
+    """Benchmark every route; returns the report dict."""
+
+    with app.app_context():
+        if reload or not datasets.is_loaded(scale):
+            datasets.load(scale, report=report, workers=workers, reload=reload)
+        viewer = datasets.viewer_id()
+        targets = pick_targets(viewer)
+        engine = db.engine
+        db.session.remove()
+
+    # one counter for every statement the app sends, from any thread
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', count)
+    request = (wsgi_client if wsgi else test_client)(session_cookie(viewer))
+
+    results = {}
+    try:
+        for name, method, urls in routes(viewer, *targets):
+            results[name] = measure(request, method, urls, requests, warmup, statements)
+            report(f"{name:14} p50 {results[name]['p50_ms']:8.2f}ms  "
+                   f"p99 {results[name]['p99_ms']:8.2f}ms  {results[name]['queries']} queries")
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+    return {
+        'version': REPORT_VERSION,
+        'scale': scale,
+        'dataset': dict(datasets.SCALES[scale], seed=datasets.SEED),
+        'client': 'wsgi' if wsgi else 'test',
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'routes': results,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Warbler's routes.")
+    parser.add_argument('--scale', choices=datasets.SCALES, default='1k')
+    parser.add_argument('--requests', type=int, default=100, help="Recorded requests per route.")
+    parser.add_argument('--warmup', type=int, default=5, help="Unrecorded requests per route.")
+    parser.add_argument('--wsgi', action='store_true',
+                        help="Go through a local WSGI server instead of the test client.")
+    parser.add_argument('--reload', action='store_true',
+                        help="Drop the database's tables and reload the dataset (only "
+                             "for databases whose name contains 'bench').")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Processes for generating the dataset.")
+    parser.add_argument('--out', help="Write the JSON report here (default: stdout).")
+    args = parser.parse_args(argv)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    # progress goes to stderr, so stdout is just the report
+    try:
+        result = run(args.scale, args.requests, args.warmup, args.wsgi, args.reload,
+                     args.workers, report=lambda line: print(line, file=sys.stderr))
+    except datasets.UnsafeDatabase as e:
+        parser.error(str(e))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Hiding blocked users from feeds, search and DMs.
+
+A block works both ways: once A blocks B, neither sees the other's
+messages, profile search hits or direct messages. Queries enforce it with
+`BlockList.visible_to`, which adds two NOT EXISTS anti-joins against
+`blocked_users` (one per direction, each served by its own index).
+
+Most users block nobody, so `BlockList` caches each user's block sets and
+skips the anti-joins entirely when both are empty. The cache is per
+process, so it is kept short (BLOCK_CACHE_TTL, a few seconds). After
+committing a block or unblock, call `invalidate` for both users and stamp
+the blocker's session with the time, so `expire_before` drops an older
+entry in whichever process serves their next request. Checks guarding a
+write, such as sending a DM, pass `fresh=True` and skip the cache.
+"""
+
+import time
+from collections import namedtuple
+
+from sqlalchemy import and_, delete, exists, select, true
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import TTLCache
+from models import db, BlockedUsers
+import db_pool
+
+Blocks = namedtuple('Blocks', 'blocking blocked_by')
+
+
+class BlockList:
+    """Per-user cache of who they block and who blocks them."""
+
+    def __init__(self, maxsize=10000, ttl=5):
+        # user id -> (time.time() when loaded, Blocks)
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, user_id):
+        """`user_id`'s Blocks: frozensets of ids they block / are blocked by."""
+
+        blocks = self.cached(user_id)
+        if blocks is None:
+            # every later request shares what we cache: never fill it from a replica
+            with db_pool.primary():
+                rows = db.session.execute(self.statement(user_id)).all()
+            blocks = self.remember(user_id, rows)
+        return blocks
+
+    def cached(self, user_id):
+        """`user_id`'s Blocks if cached, else None; never queries."""
+
+        entry = self.cache.get(user_id)
+        return entry and entry[1]
+
+    def expire_before(self, user_id, changed_at):
+        """Drop `user_id`'s entry if it was loaded before `changed_at`, a
+        time.time() such as the one in their session; None changes nothing."""
+
+        entry = self.cache.get(user_id)
+        if entry and changed_at and entry[0] < changed_at:
+            self.cache.pop(user_id)
+
+    def statement(self, user_id):
+        """The query `get` runs on a cache miss, for callers that run it
+        themselves; hand its rows to `remember`."""
+
+        return (select(BlockedUsers.user_id, BlockedUsers.blocked_user_id)
+                .where((BlockedUsers.user_id == user_id)
+                       | (BlockedUsers.blocked_user_id == user_id)))
+
+    def remember(self, user_id, rows):
+        """Cache and return the Blocks from `statement(user_id)`'s rows."""
+
+        blocks = Blocks(frozenset(b for u, b in rows if u == user_id),
+                        frozenset(u for u, b in rows if b == user_id))
+        self.cache.set(user_id, (time.time(), blocks))
+        return blocks
+
+    def hidden_from(self, viewer_id, other_id, fresh=False):
+        """Has either user blocked the other? With `fresh`, ask the
+        database rather than the cache."""
+
+        if fresh:
+            return db.session.scalar(select(exists().where(
+                ((BlockedUsers.user_id == viewer_id) & (BlockedUsers.blocked_user_id == other_id))
+                | ((BlockedUsers.user_id == other_id) & (BlockedUsers.blocked_user_id == viewer_id)))))
+        blocks = self.get(viewer_id)
+        return other_id in blocks.blocking or other_id in blocks.blocked_by
+
+    def visible_to(self, viewer_id, user_id_col):
+        """Criterion keeping rows whose `user_id_col` is not blocked either way.
+
+        Free (a constant TRUE) for viewers with no blocks at all.
+        """
+
+        blocks = self.get(viewer_id)
+        if not (blocks.blocking or blocks.blocked_by):
+            return true()
+        return self.excluding(viewer_id, user_id_col)
+
+    def excluding(self, viewer_id, user_id_col):
+        """`visible_to`'s anti-joins, without consulting the cache."""
+
+        return and_(~exists().where(BlockedUsers.user_id == viewer_id,
+                                    BlockedUsers.blocked_user_id == user_id_col),
+                    ~exists().where(BlockedUsers.user_id == user_id_col,
+                                    BlockedUsers.blocked_user_id == viewer_id))
+
+    def block(self, user_id, blocked_user_id):
+        """Record the block; blocking twice is harmless."""
+
+        db.session.execute(
+            insert(BlockedUsers)
+            .values(user_id=user_id, blocked_user_id=blocked_user_id)
+            .on_conflict_do_nothing(index_elements=[BlockedUsers.user_id,
+                                                    BlockedUsers.blocked_user_id]))
+
+    def unblock(self, user_id, blocked_user_id):
+        """Remove the block; returns whether there was one."""
+
+        removed = db.session.scalar(
+            delete(BlockedUsers)
+            .where(BlockedUsers.user_id == user_id,
+                   BlockedUsers.blocked_user_id == blocked_user_id)
+            .returning(BlockedUsers.id))
+        return removed is not None
+
+    def invalidate(self, *user_ids):
+        for user_id in user_ids:
+            self.cache.pop(user_id)
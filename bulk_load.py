@@ -0,0 +1,336 @@
+"""Bulk loading users, messages, follows and likes from CSV or NDJSON.
+
+    flask bulk load --users users.csv --messages messages.ndjson --follows follows.csv
+
+Files are read a chunk at a time. On PostgreSQL each chunk goes in with
+`COPY ... FROM STDIN`, and elsewhere with one executemany INSERT. Every
+chunk commits together with its checkpoint row in `bulk_load_checkpoints`,
+so an interrupted load resumes where it stopped when it is run again.
+Rows are never loaded twice.
+
+While loading, the tables' secondary indexes and (on PostgreSQL) foreign
+keys are dropped. Afterwards they are rebuilt in one pass each, which is
+far cheaper than maintaining them row by row. Then counters are recomputed
+and the tables analyzed. Run `flask timeline backfill` afterwards to build
+home timelines.
+
+Unless a file has an `id` column, each row's id is its line number
+(counting from 1, after any CSV header), so other files can refer to users
+and messages by line number. Ids are written out explicitly rather than
+drawn from the sequence, so a chunk that fails and is retried cannot shift
+them. After the load each sequence is moved past the largest id. Load into
+empty tables: `load` refuses a table that already has rows, unless it is
+resuming that table's load or `fresh` is given. In CSV, an empty field is
+NULL.
+"""
+
+import csv
+import io
+import itertools
+import json
+import os
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import DateTime, Integer, delete, exists, insert, inspect, select, text, update
+from sqlalchemy.schema import AddConstraint
+
+from models import db, User, Message, Follows, Likes
+import counters
+import migrations
+
+# in load order: each may refer to the ones before it
+TABLES = {
+    'users': User.__table__,
+    'messages': Message.__table__,
+    'follows': Follows.__table__,
+    'likes': Likes.__table__,
+}
+
+
+class LoadCheckpoint(db.Model):
+    """How far a bulk load has got through one file."""
+
+    __tablename__ = 'bulk_load_checkpoints'
+
+    source = db.Column(db.Text, primary_key=True)
+    rows = db.Column(db.BigInteger, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+##############################################################################
+# Reading
+
+
+def read_rows(path):
+    """Dicts from a .csv or .ndjson/.jsonl file, one at a time."""
+
+    if path.endswith(('.ndjson', '.jsonl')):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                yield {k: (v if v != '' else None) for k, v in row.items()}
+
+
+def _parser(column):
+    """Function turning a file's value for `column` into a Python value."""
+
+    if isinstance(column.type, DateTime):
+        return lambda v: v if v is None or isinstance(v, datetime) else datetime.fromisoformat(v)
+    if isinstance(column.type, Integer):
+        return lambda v: v if v is None else int(v)
+    return lambda v: v
+
+
+def _default(column):
+    if column.default is None or column.default.is_sequence:
+        return None
+    if column.default.is_callable:
+        return column.default.arg
+    return lambda ctx: column.default.arg
+
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _copy_field(value):
+    """`value` in COPY's text format."""
+
+    return '\\N' if value is None else str(value).translate(_COPY_ESCAPES)
+
+
+class Loader:
+    """Loads one table from `rows` (dicts), `chunk_size` rows per transaction."""
+
+    def __init__(self, table, fields, chunk_size=10000):
+        self.table = table
+        self.chunk_size = chunk_size
+        # ids the file leaves out are its line numbers
+        self.numbered = numbered(table) and 'id' not in fields
+        self.columns = [c for c in table.columns
+                        if not c.system and (c.name in fields or _default(c))]
+        if self.numbered:
+            self.columns.insert(0, table.c.id)
+        unknown = set(fields) - {c.name for c in table.columns}
+        if unknown:
+            raise click.UsageError(f"{table.name} has no columns {', '.join(sorted(unknown))}")
+        self.parsers = [(c.name, _parser(c), _default(c))
+                        for c in self.columns[1 if self.numbered else 0:]]
+
+    def values(self, row, line=None):
+        out = [line] if self.numbered else []
+        for name, parse, default in self.parsers:
+            value = parse(row.get(name))
+            if value is None and default:
+                value = default(None)
+            out.append(value)
+        return out
+
+    def chunks(self, rows, start=0):
+        """Lists of values, `chunk_size` rows at a time; `rows` begins
+        after `start` rows of its file."""
+
+        rows = enumerate(rows, start + 1)
+        while chunk := [self.values(row, line)
+                        for line, row in itertools.islice(rows, self.chunk_size)]:
+            yield chunk
+
+    def write(self, conn, chunk):
+        """Insert `chunk` (lists of values) on `conn`."""
+
+        if conn.dialect.driver == 'psycopg2':
+            self._copy(conn, chunk)
+        else:
+            names = [c.name for c in self.columns]
+            conn.execute(insert(self.table), [dict(zip(names, values)) for values in chunk])
+
+    def _copy(self, conn, chunk):
+        buffer = io.StringIO()
+        for values in chunk:
+            buffer.write('\t'.join(_copy_field(v) for v in values))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        quote = conn.dialect.identifier_preparer.quote
+        names = ', '.join(quote(c.name) for c in self.columns)
+        sql = f"COPY {quote(self.table.name)} ({names}) FROM STDIN"
+        with conn.connection.cursor() as cursor:
+            cursor.copy_expert(sql, buffer)
+
+
+##############################################################################
+# Loading
+
+
+def load(files, chunk_size=10000, fresh=False, report=print):
+    """Load `files` ({table name: path}) in TABLES order.
+
+    `fresh` drops and recreates the whole schema first; otherwise a table
+    with rows is refused (click.UsageError) unless its load is being
+    resumed. Calls `report`
+    with a line of progress after every chunk. Returns {table: rows loaded}.
+    """
+
+    if fresh:
+        db.drop_all()
+    migrations.upgrade()
+    LoadCheckpoint.__table__.create(db.engine, checkfirst=True)
+
+    tables = [name for name in TABLES if name in files]
+    with db.engine.connect() as conn:
+        for name in tables:
+            table = TABLES[name]
+            resuming = exists().where(LoadCheckpoint.source.startswith(f"{table.name}:"))
+            if conn.scalar(select(exists().select_from(table))) \
+                    and not conn.scalar(select(resuming)):
+                raise click.UsageError(f"{table.name} already has rows; "
+                                       "load into empty tables, or pass --fresh.")
+
+    with db.engine.begin() as conn:
+        defer_indexes(conn, [TABLES[name] for name in tables])
+
+    loaded = {}
+    for name in tables:
+        loaded[name] = load_file(TABLES[name], files[name], chunk_size, report)
+
+    started = time.perf_counter()
+    with db.engine.begin() as conn:
+        restore_indexes(conn)
+        reset_sequences(conn, [TABLES[name] for name in tables])
+        conn.execute(counters.recount_statement())
+        conn.execute(delete(LoadCheckpoint))
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            for name in tables:
+                conn.execute(text(f"ANALYZE {TABLES[name].name}"))
+    report(f"indexes, constraints and counters rebuilt in {time.perf_counter() - started:.1f}s")
+
+    return loaded
+
+
+def load_file(table, path, chunk_size=10000, report=print):
+    """Load one file into `table`, resuming from its checkpoint; returns the
+    number of rows it added."""
+
+    source = f"{table.name}:{os.path.abspath(path)}"
+    with db.engine.connect() as conn:
+        done = conn.scalar(select(LoadCheckpoint.rows).where(LoadCheckpoint.source == source)) or 0
+
+    rows = read_rows(path)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return 0
+    loader = Loader(table, first.keys(), chunk_size)
+    rows = itertools.islice(itertools.chain([first], rows), done, None)
+
+    if done:
+        report(f"{table.name}: resuming after row {done}")
+
+    started, added = time.perf_counter(), 0
+    for chunk in loader.chunks(rows, start=done):
+        with db.engine.begin() as conn:
+            loader.write(conn, chunk)
+            _checkpoint(conn, source, done + added + len(chunk))
+        added += len(chunk)
+        elapsed = time.perf_counter() - started
+        report(f"{table.name}: {done + added} rows ({added / elapsed:,.0f} rows/s)")
+
+    return added
+
+
+def _checkpoint(conn, source, rows):
+    updated = conn.execute(update(LoadCheckpoint)
+                           .where(LoadCheckpoint.source == source)
+                           .values(rows=rows, updated_at=datetime.utcnow()))
+    if not updated.rowcount:
+        conn.execute(insert(LoadCheckpoint).values(source=source, rows=rows))
+
+
+def numbered(table):
+    """Whether `table` has an integer `id` that the database numbers."""
+
+    column = table.c.get('id')
+    return (column is not None and column.primary_key and isinstance(column.type, Integer)
+            and column.autoincrement in (True, 'auto'))
+
+
+def reset_sequences(conn, tables):
+    """Move `tables`' id sequences past their largest id, on PostgreSQL."""
+
+    if conn.dialect.name != 'postgresql':
+        return
+    quote = conn.dialect.identifier_preparer.quote
+    for table in tables:
+        if numbered(table):
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                f"coalesce(max(id), 0) + 1, false) FROM {quote(table.name)}"),
+                {'table': table.name})
+
+
+def defer_indexes(conn, tables):
+    """Drop `tables`' secondary indexes, and their foreign keys on
+    PostgreSQL; `restore_indexes` puts them back."""
+
+    for table in tables:
+        for index in table.indexes:
+            index.drop(conn, checkfirst=True)
+
+        if conn.dialect.name == 'postgresql':
+            quote = conn.dialect.identifier_preparer.quote
+            for fk in inspect(conn).get_foreign_keys(table.name):
+                conn.execute(text(f"ALTER TABLE {quote(table.name)} "
+                                  f"DROP CONSTRAINT {quote(fk['name'])}"))
+
+
+def restore_indexes(conn):
+    """Recreate any model index or foreign key missing from the loadable
+    tables, e.g. after an interrupted load."""
+
+    for table in TABLES.values():
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+        if conn.dialect.name == 'postgresql':
+            present = {tuple(fk['constrained_columns'])
+                       for fk in inspect(conn).get_foreign_keys(table.name)}
+            for fk in table.foreign_key_constraints:
+                if tuple(c.name for c in fk.columns) not in present:
+                    conn.execute(AddConstraint(fk))
+
+
+##############################################################################
+# CLI
+
+bulk_cli = AppGroup('bulk', help="Bulk-load data files.")
+
+
+@bulk_cli.command('load')
+@click.option('--users', type=click.Path(exists=True, dir_okay=False))
+@click.option('--messages', type=click.Path(exists=True, dir_okay=False))
+@click.option('--follows', type=click.Path(exists=True, dir_okay=False))
+@click.option('--likes', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', default=10000, show_default=True,
+              help="Rows per COPY and transaction.")
+@click.option('--fresh', is_flag=True,
+              help="Drop and recreate every table first (and forget checkpoints). "
+                   "Without it, tables being loaded must be empty.")
+def load_command(chunk_size, fresh, **paths):
+    """Load CSV or NDJSON files, resuming an interrupted load."""
+
+    files = {name: path for name, path in paths.items() if path}
+    if not files:
+        raise click.UsageError("Give at least one of --users, --messages, --follows, --likes.")
+
+    started = time.perf_counter()
+    loaded = load(files, chunk_size=chunk_size, fresh=fresh, report=click.echo)
+    elapsed = time.perf_counter() - started
+    total = sum(loaded.values())
+    click.echo(f"Loaded {total} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s).")
@@ -0,0 +1,85 @@
+"""Small in-process caches for Warbler."""
+
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+_MISSING = object()
+
+HITS = metrics.counter('cache_hits_total', "Lookups that found a live entry.", ['cache'])
+MISSES = metrics.counter('cache_misses_total', "Lookups that found no live entry.", ['cache'])
+ENTRIES = metrics.gauge('cache_entries', "Entries held, live or expired.", ['cache'])
+
+
+class TTLCache:
+    """A thread-safe LRU mapping whose entries expire after `ttl` seconds.
+
+    Holds at most `maxsize` entries, evicting the least recently used. Each
+    process has its own copy, so anything cached here must be safe to serve
+    for up to `ttl` seconds after another process changes it.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the live value for `key`, or `default`."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            expires, value = self._data.get(key, (0, _MISSING))
+            if value is _MISSING or expires <= now:
+                self._data.pop(key, None)
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key` for `ttl` (default: the cache's) seconds."""
+
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove `key`, returning its value (expired or not) or `default`."""
+
+        with self._lock:
+            return self._data.pop(key, (0, default))[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def watch(name, cache):
+    """Report `cache`'s hits, misses and size, labelled `name`.
+
+    The hit ratio is hits / (hits + misses); in Prometheus, over the last
+    five minutes:
+
+        rate(cache_hits_total[5m])
+          / (rate(cache_hits_total[5m]) + rate(cache_misses_total[5m]))
+    """
+
+    HITS.labels(cache=name).set_function(lambda: cache.hits)
+    MISSES.labels(cache=name).set_function(lambda: cache.misses)
+    ENTRIES.labels(cache=name).set_function(lambda: len(cache))
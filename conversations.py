@@ -0,0 +1,173 @@
+"""Direct-message threads.
+
+Every message belongs to the `Conversation` between its two users. Each
+user has a `ConversationParticipant` row per thread holding what their
+inbox shows -- the other user, when the thread last changed, how many
+messages they haven't read -- so the inbox is one range read on
+(user_id, last_message_at) and a thread is one range read on
+(conversation_id, timestamp).
+
+`send` keeps all of it current with relative UPDATEs in the caller's
+transaction; `mark_read` clears a user's unread count when they open the
+thread.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import select, update, func, case, and_, exists, insert as sql_insert
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Conversation, ConversationParticipant, DirectMessage
+
+
+def pair(user_id, other_id):
+    """The canonical (user_a_id, user_b_id) key for two users."""
+
+    return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+
+def find(user_id, other_id):
+    """The conversation between two users, or None."""
+
+    user_a_id, user_b_id = pair(user_id, other_id)
+    return Conversation.query.filter_by(user_a_id=user_a_id, user_b_id=user_b_id).first()
+
+
+def get_or_create(user_id, other_id):
+    """The id of the conversation between two users, creating it if needed.
+
+    Safe against two first messages racing: the unique pair index decides
+    the winner and the loser reads the winner's row.
+    """
+
+    user_a_id, user_b_id = pair(user_id, other_id)
+
+    conversation_id = db.session.scalar(
+        insert(Conversation)
+        .values(user_a_id=user_a_id, user_b_id=user_b_id)
+        .on_conflict_do_nothing(index_elements=[Conversation.user_a_id, Conversation.user_b_id])
+        .returning(Conversation.id))
+
+    if conversation_id is None:
+        return db.session.scalar(
+            select(Conversation.id).where(Conversation.user_a_id == user_a_id,
+                                          Conversation.user_b_id == user_b_id))
+
+    db.session.execute(insert(ConversationParticipant), [
+        dict(conversation_id=conversation_id, user_id=user_id, other_user_id=other_id),
+        dict(conversation_id=conversation_id, user_id=other_id, other_user_id=user_id),
+    ])
+    return conversation_id
+
+
+def send(sender_id, recipient_id, text, timestamp=None):
+    """Add a message to the pair's thread; returns the new DirectMessage.
+
+    The sender's side counts as read up to their own message; the
+    recipient's unread count goes up by one.
+    """
+
+    timestamp = timestamp or datetime.utcnow()
+    conversation_id = get_or_create(sender_id, recipient_id)
+
+    message = DirectMessage(conversation_id=conversation_id, sender_id=sender_id,
+                            recipient_id=recipient_id, text=text, timestamp=timestamp)
+    db.session.add(message)
+    db.session.flush()
+
+    db.session.execute(
+        update(Conversation)
+        .where(Conversation.id == conversation_id)
+        .values(last_message_at=func.greatest(Conversation.last_message_at, timestamp)))
+
+    is_sender = ConversationParticipant.user_id == sender_id
+    db.session.execute(
+        update(ConversationParticipant)
+        .where(ConversationParticipant.conversation_id == conversation_id)
+        .values(last_message_at=func.greatest(ConversationParticipant.last_message_at, timestamp),
+                unread_count=case((is_sender, 0),
+                                  else_=ConversationParticipant.unread_count + 1),
+                last_read_message_id=case((is_sender, message.id),
+                                          else_=ConversationParticipant.last_read_message_id)))
+
+    return message
+
+
+def mark_read(conversation_id, user_id):
+    """Mark every message in the thread read for `user_id`."""
+
+    newest = (select(func.max(DirectMessage.id))
+              .where(DirectMessage.conversation_id == conversation_id)
+              .scalar_subquery())
+
+    db.session.execute(
+        update(ConversationParticipant)
+        .where(ConversationParticipant.conversation_id == conversation_id,
+               ConversationParticipant.user_id == user_id,
+               ConversationParticipant.unread_count > 0)
+        .values(unread_count=0, last_read_message_id=newest))
+
+
+def inbox_query(user_id):
+    """Unordered query for `user_id`'s conversations.
+
+    Order it by (last_message_at, conversation_id) to get an index range read.
+    """
+
+    return ConversationParticipant.query.filter(ConversationParticipant.user_id == user_id)
+
+
+def thread_query(conversation_id):
+    """Unordered query for one conversation's messages."""
+
+    return DirectMessage.query.filter(DirectMessage.conversation_id == conversation_id)
+
+
+def unread_total(user_id):
+    """How many unread messages `user_id` has across all threads."""
+
+    return db.session.scalar(
+        select(func.coalesce(func.sum(ConversationParticipant.unread_count), 0))
+        .where(ConversationParticipant.user_id == user_id,
+               ConversationParticipant.unread_count > 0))
+
+
+def backfill_statements():
+    """Statements that thread existing messages into conversations.
+
+    Used by the migration that introduced conversations; messages already
+    in a thread are left alone, so re-running it is harmless. Existing
+    messages count as read. Plain SQL, so it runs on any backend.
+    """
+
+    sender_first = DirectMessage.sender_id < DirectMessage.recipient_id
+    user_a = case((sender_first, DirectMessage.sender_id), else_=DirectMessage.recipient_id)
+    user_b = case((sender_first, DirectMessage.recipient_id), else_=DirectMessage.sender_id)
+
+    same_pair = and_(Conversation.user_a_id == user_a, Conversation.user_b_id == user_b)
+    unthreaded = DirectMessage.conversation_id.is_(None)
+
+    yield (sql_insert(Conversation)
+           .from_select(['user_a_id', 'user_b_id', 'last_message_at'],
+                        select(user_a, user_b, func.max(DirectMessage.timestamp))
+                        .where(unthreaded, ~exists().where(same_pair))
+                        .group_by(user_a, user_b)))
+
+    yield (update(DirectMessage)
+           .where(unthreaded)
+           .values(conversation_id=select(Conversation.id).where(same_pair).scalar_subquery()))
+
+    newest = (select(func.max(DirectMessage.id))
+              .where(DirectMessage.conversation_id == Conversation.id)
+              .scalar_subquery())
+
+    for mine, theirs in ((Conversation.user_a_id, Conversation.user_b_id),
+                         (Conversation.user_b_id, Conversation.user_a_id)):
+        missing = ~exists().where(ConversationParticipant.conversation_id == Conversation.id,
+                                  ConversationParticipant.user_id == mine)
+        yield (sql_insert(ConversationParticipant)
+               .from_select(['conversation_id', 'user_id', 'other_user_id',
+                             'last_message_at', 'last_read_message_id'],
+                            select(Conversation.id, mine, theirs,
+                                   Conversation.last_message_at, newest)
+                            .where(missing)))
@@ -0,0 +1,147 @@
+"""Maintained aggregate counts on users.
+
+`User.messages_count`, `following_count`, `followers_count` and
+`likes_count` are kept up to date by the views that write the underlying
+rows, using relative UPDATEs in the same transaction. `flask counters
+repair` recomputes them from the source tables, and `flask counters
+add-columns` adds and fills the columns on a database created before them.
+"""
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, update, func, inspect, text
+
+from models import db, User, Message, Follows, Likes
+
+COLUMNS = ('messages_count', 'following_count', 'followers_count', 'likes_count')
+
+
+def bump(user_id, **deltas):
+    """Add `deltas` to `user_id`'s counters, e.g. bump(1, likes_count=-1)."""
+
+    values = {name: getattr(User, name) + delta for name, delta in deltas.items()}
+    db.session.execute(update(User).where(User.id == user_id).values(**values))
+
+
+def follow(follower_id, followed_id, delta=1):
+    """Count a follow (or, with delta=-1, an unfollow)."""
+
+    bump(follower_id, following_count=delta)
+    bump(followed_id, followers_count=delta)
+
+
+def message_deleted(message):
+    """Uncount `message` and every like on it; call before deleting it."""
+
+    bump(message.user_id, messages_count=-1)
+
+    likers = select(Likes.user_id).where(Likes.message_id == message.id)
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(likers))
+        .values(likes_count=User.likes_count - 1))
+
+
+def user_deleted(user_id):
+    """Uncount everything `user_id` takes with them; call before deleting.
+
+    Their follows, followers, and the likes other users gave their messages
+    are removed by ON DELETE CASCADE, so other users' counters drop here.
+    """
+
+    followers = select(Follows.user_following_id).where(
+        Follows.user_being_followed_id == user_id)
+    followed = select(Follows.user_being_followed_id).where(
+        Follows.user_following_id == user_id)
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(followers))
+        .values(following_count=User.following_count - 1))
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(followed))
+        .values(followers_count=User.followers_count - 1))
+
+    lost_likes = (select(func.count())
+                  .select_from(Likes)
+                  .join(Message, Message.id == Likes.message_id)
+                  .where(Likes.user_id == User.id, Message.user_id == user_id)
+                  .scalar_subquery())
+    likers = (select(Likes.user_id)
+              .join(Message, Message.id == Likes.message_id)
+              .where(Message.user_id == user_id))
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(likers))
+        .values(likes_count=User.likes_count - lost_likes))
+
+
+def recount_statement(user_ids=None):
+    """UPDATE recomputing counters from the source tables for `user_ids` (or everyone)."""
+
+    def count(model, column):
+        return (select(func.count())
+                .select_from(model)
+                .where(column == User.id)
+                .scalar_subquery())
+
+    stmt = update(User).values(
+        messages_count=count(Message, Message.user_id),
+        following_count=count(Follows, Follows.user_following_id),
+        followers_count=count(Follows, Follows.user_being_followed_id),
+        likes_count=count(Likes, Likes.user_id),
+    )
+    if user_ids:
+        stmt = stmt.where(User.id.in_(user_ids))
+
+    return stmt
+
+
+def recount(user_ids=None):
+    """Recompute counters from the source tables for `user_ids` (or everyone)."""
+
+    stmt = recount_statement(user_ids).execution_options(synchronize_session=False)
+    return db.session.execute(stmt).rowcount
+
+
+def add_columns(conn):
+    """Add any missing counter columns to an existing `users` table and fill them.
+
+    `db.create_all()` never alters a table that already exists, so databases
+    created before the counters need this once.
+    """
+
+    existing = {column['name'] for column in inspect(conn).get_columns('users')}
+    for column in COLUMNS:
+        if column not in existing:
+            conn.execute(text(
+                f"ALTER TABLE users ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+
+    conn.execute(recount_statement())
+
+
+##############################################################################
+# CLI: `flask counters repair` / `flask counters add-columns`
+
+counters_cli = AppGroup('counters', help="Maintain per-user counters.")
+
+
+@counters_cli.command('repair')
+@click.option('--user', 'user_ids', type=int, multiple=True,
+              help="Only repair these users (default: everyone).")
+def repair_command(user_ids):
+    """Recompute counters from messages, follows and likes."""
+
+    n = recount(user_ids)
+    db.session.commit()
+    click.echo(f"Recounted {n} users.")
+
+
+@counters_cli.command('add-columns')
+def add_columns_command():
+    """Add and fill the counter columns on an existing database."""
+
+    with db.engine.begin() as conn:
+        add_columns(conn)
+    click.echo("Counter columns are in place.")
@@ -0,0 +1,207 @@
+"""Database connection pools: sizing, metrics and the read replica.
+
+`engine_options` turns the DB_POOL_* settings into engine options, with
+anything set in SQLALCHEMY_ENGINE_OPTIONS taking precedence. Every pooled
+engine uses `InstrumentedPool`, which records how long checkouts wait and
+how many time out. Gauges for pool size, connections in use and overflow
+read the live pool whenever metrics are collected.
+
+With DATABASE_REPLICA_URL set, views marked `@read_only` send their
+queries to the `replica` bind. Everything else, and any flush, goes to the
+primary. Replicas lag a little, so only mark views that can show slightly
+stale data: never one that reads back what the same request wrote.
+
+Since most writes redirect to a `@read_only` page, a request that commits
+a write pins its client to the primary for REPLICA_PIN_SECONDS (a time in
+the Flask session), so they see their own change. Reads that fill a
+cache shared by later requests run inside `with db_pool.primary():`, so a
+lagging replica can't put old data in the cache.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import current_app, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+import metrics
+
+REPLICA = 'replica'
+ASYNC = 'async'
+PRIMARY_UNTIL_KEY = 'db_primary_until'
+
+_use_primary = ContextVar('use_primary', default=False)
+
+CHECKOUT_SECONDS = metrics.histogram(
+    'db_pool_checkout_seconds', "Time to check a connection out of the pool.", ['pool'],
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 30))
+CHECKOUT_TIMEOUTS = metrics.counter(
+    'db_pool_timeouts_total', "Checkouts that gave up after pool_timeout.", ['pool'])
+POOL_SIZE = metrics.gauge('db_pool_size', "Connections the pool keeps open.", ['pool'])
+POOL_CHECKED_OUT = metrics.gauge('db_pool_checked_out', "Connections in use.", ['pool'])
+POOL_OVERFLOW = metrics.gauge(
+    'db_pool_overflow', "Connections open beyond the pool size.", ['pool'])
+
+
+class _Instrumented:
+    """Times checkouts and counts timeouts.
+
+    Metrics are labelled with the pool's `logging_name` (the engine's
+    `pool_logging_name`), which survives the pool being recreated.
+    """
+
+    def connect(self):
+        name = self.logging_name or 'primary'
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            CHECKOUT_TIMEOUTS.labels(pool=name).inc()
+            raise
+        finally:
+            CHECKOUT_SECONDS.labels(pool=name).observe(time.perf_counter() - start)
+
+
+class InstrumentedPool(_Instrumented, QueuePool):
+    """A QueuePool that times checkouts and counts timeouts."""
+
+
+class InstrumentedAsyncPool(_Instrumented, AsyncAdaptedQueuePool):
+    """The same, for async engines."""
+
+
+def engine_options(config, url):
+    """Engine options for `url` from the app's pool settings."""
+
+    url = make_url(url)
+    options = {}
+
+    # SQLite gets Flask-SQLAlchemy's own pool defaults
+    if url.get_backend_name() != 'sqlite':
+        options.update(
+            poolclass=InstrumentedPool,
+            pool_size=config.get('DB_POOL_SIZE', 5),
+            max_overflow=config.get('DB_MAX_OVERFLOW', 10),
+            pool_timeout=config.get('DB_POOL_TIMEOUT', 30),
+            pool_recycle=config.get('DB_POOL_RECYCLE', -1),
+            pool_pre_ping=config.get('DB_POOL_PRE_PING', False))
+
+    statement_timeout = config.get('DB_STATEMENT_TIMEOUT')
+    if statement_timeout and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {'options': f"-c statement_timeout={statement_timeout}"}
+
+    options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    return options
+
+
+# options that belong to the sync driver or pool and mean nothing to asyncpg
+SYNC_ONLY_OPTIONS = ('connect_args', 'creator', 'poolclass')
+
+
+def async_engine_options(config, url):
+    """`engine_options` for an async engine at `url`: the same pool sizing
+    and statement timeout, with asyncpg's way of setting the timeout and
+    pool metrics labelled 'async'. Sync-driver options are left out."""
+
+    url = make_url(url)
+    overrides = {key: value for key, value in (config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}).items()
+                 if key not in SYNC_ONLY_OPTIONS}
+    options = engine_options(dict(config, SQLALCHEMY_ENGINE_OPTIONS=overrides), url)
+    options.pop('connect_args', None)
+
+    if url.get_backend_name() != 'sqlite':
+        options.update(poolclass=InstrumentedAsyncPool, pool_logging_name=ASYNC)
+
+    statement_timeout = config.get('DB_STATEMENT_TIMEOUT')
+    if statement_timeout and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(statement_timeout)}}
+    return options
+
+
+def configure(app):
+    """Fill in SQLALCHEMY_ENGINE_OPTIONS, and the replica bind if
+    DATABASE_REPLICA_URL is set; call before db.init_app."""
+
+    config = app.config
+    replica = config.get('DATABASE_REPLICA_URL')
+    if replica:
+        config.setdefault('SQLALCHEMY_BINDS', {})[REPLICA] = dict(
+            engine_options(config, replica), url=replica, pool_logging_name=REPLICA)
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(config, config['SQLALCHEMY_DATABASE_URI'])
+
+
+def watch(engines):
+    """Point the pool gauges at `engines` (bind key -> engine)."""
+
+    for key, engine in engines.items():
+        name = key or 'primary'
+        if not isinstance(engine.pool, QueuePool):
+            continue
+        # engine.pool, not the pool itself: dispose() replaces it
+        POOL_SIZE.labels(pool=name).set_function(lambda engine=engine: engine.pool.size())
+        POOL_CHECKED_OUT.labels(pool=name).set_function(
+            lambda engine=engine: engine.pool.checkedout())
+        POOL_OVERFLOW.labels(pool=name).set_function(
+            lambda engine=engine: max(engine.pool.overflow(), 0))
+
+
+##############################################################################
+# Read replica
+
+
+def read_only(view):
+    """Let this view's queries go to the read replica, if there is one."""
+
+    view.read_only = True
+    return view
+
+
+@contextmanager
+def primary():
+    """Send the block's reads to the primary, even in a `@read_only` view."""
+
+    token = _use_primary.set(True)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+def _wants_replica():
+    if _use_primary.get() or not has_request_context():
+        return False
+    if session.get(PRIMARY_UNTIL_KEY, 0) > time.time():
+        return False
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'read_only', False)
+
+
+class RoutingSession(Session):
+    """db.session: sends `@read_only` views' queries to the replica bind."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if self._flushing or getattr(clause, 'is_dml', False):
+            self.info['wrote'] = True
+        elif bind is None and not self.info.get('wrote') and _wants_replica():
+            replica = self._db.engines.get(REPLICA)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _pin_to_primary(db_session):
+    """Keep a client that just wrote on the primary until replicas catch up."""
+
+    if (db_session.info.pop('wrote', False) and has_request_context()
+            and current_app.config.get('DATABASE_REPLICA_URL')):
+        session[PRIMARY_UNTIL_KEY] = time.time() + current_app.config.get('REPLICA_PIN_SECONDS', 5)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_writes(db_session):
+    db_session.info.pop('wrote', None)
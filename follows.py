@@ -0,0 +1,69 @@
+"""Following and unfollowing users.
+
+Like likes.py: each change is one INSERT ... ON CONFLICT DO NOTHING or
+DELETE against `follows`, so repeating it is harmless, and the counters
+and materialized timeline are only touched when a row really changed.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, User, Follows
+import counters
+import timeline
+
+FollowState = namedtuple('FollowState', 'user_id following followers_count')
+
+
+def follow(user_id, followed_id):
+    """Follow `followed_id` as `user_id`; returns the new FollowState."""
+
+    _add(user_id, followed_id)
+    return FollowState(followed_id, True, followers_count(followed_id))
+
+
+def unfollow(user_id, followed_id):
+    """Stop `user_id` following `followed_id`; returns the new FollowState."""
+
+    _remove(user_id, followed_id)
+    return FollowState(followed_id, False, followers_count(followed_id))
+
+
+def toggle(user_id, followed_id):
+    """Unfollow `followed_id` if `user_id` follows them, otherwise follow."""
+
+    if _remove(user_id, followed_id):
+        return FollowState(followed_id, False, followers_count(followed_id))
+    return follow(user_id, followed_id)
+
+
+def followers_count(user_id):
+    return db.session.scalar(select(User.followers_count).where(User.id == user_id))
+
+
+def _add(user_id, followed_id):
+    added = db.session.scalar(
+        insert(Follows)
+        .values(user_following_id=user_id, user_being_followed_id=followed_id)
+        .on_conflict_do_nothing()
+        .returning(Follows.user_being_followed_id))
+
+    if added is not None:
+        counters.follow(user_id, followed_id)
+        timeline.add_follow(user_id, followed_id)
+    return added is not None
+
+
+def _remove(user_id, followed_id):
+    removed = db.session.scalar(
+        delete(Follows)
+        .where(Follows.user_following_id == user_id,
+               Follows.user_being_followed_id == followed_id)
+        .returning(Follows.user_being_followed_id))
+
+    if removed is not None:
+        counters.follow(user_id, followed_id, delta=-1)
+        timeline.remove_follow(user_id, followed_id)
+    return removed is not None
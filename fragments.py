@@ -0,0 +1,83 @@
+"""Cached template fragments.
+
+The markup for a message or a user card is the same for every viewer, so
+templates wrap it in a `{% cache %}` block and render it once:
+
+    {% cache 'message', msg.id, msg.timestamp, 'user', msg.user.id, msg.user.username %}
+      ...markup that doesn't depend on who's viewing...
+    {% endcache %}
+
+The arguments, together with the block's template and line, key the
+fragment. They should include every mutable value the block shows, so an
+edit in any process changes the key instead of serving stale markup.
+
+Adjacent (kind, id) pairs among the arguments name the entities a fragment
+shows. `FragmentCache.invalidate(kind, id)` drops every fragment naming that
+entity. Views call it after they change or delete a user or message, so the
+dead entries free their space now instead of waiting for LRU eviction.
+
+Keep viewer-dependent markup, such as like and follow buttons, outside the
+block.
+"""
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from cache import TTLCache
+
+
+class FragmentCache(TTLCache):
+    """Rendered fragments by key, LRU-bounded to `maxsize` entries."""
+
+    def invalidate(self, kind, id):
+        """Drop every fragment whose key names entity (kind, id)."""
+
+        with self._lock:
+            stale = [key for key in self._data
+                     if any(key[i:i + 2] == (kind, id) for i in range(len(key) - 1))]
+            for key in stale:
+                del self._data[key]
+
+
+class FragmentCacheExtension(Extension):
+    """The `{% cache key, ... %}...{% endcache %}` tag."""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        # the same arguments in two places are two different fragments
+        args = [nodes.Const(f"{parser.name}:{lineno}"), parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(args)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+
+        key = tuple(key)
+        fragment = cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            cache.set(key, fragment)
+        return fragment
+
+
+def init_app(app):
+    """Enable `{% cache %}` in the app's templates; returns the cache."""
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache = FragmentCache(
+        maxsize=app.config.get('FRAGMENT_CACHE_SIZE', 10000),
+        ttl=app.config.get('FRAGMENT_CACHE_TTL', 300))
+    return app.jinja_env.fragment_cache
@@ -1,77 +1,196 @@
 """Generate CSVs of random data for Warbler.
 
-Students won't need to run this for the exercise; they will just use the CSV
-files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+    python generator/create_csvs.py --users 100000 --messages 10000000 \\
+        --follows 5000000 --likes 2000000 --workers 8 --seed 1
+
+Writes users.csv, messages.csv, follows.csv and (with --likes) likes.csv
+to --out, ready for `flask bulk load`. Ids are implied by line order,
+which is how the bulk loader assigns them. The defaults give the scale
+of the small sample committed next to this script.
+
+The data is shaped like a real network:
+- Followers follow a power law, so a few users have most of them.
+- Some users post far more than others.
+- Posting picks up over the period, peaks in the evenings and is busier
+  at weekends, and messages.csv is in time order.
+- Likes lean towards recent messages.
+
+Every file is written in parts, each from its own seeded RNG, so memory
+doesn't grow with the scale. The same --seed gives the same files whatever
+--workers is. Nothing here touches the network.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import random
+import shutil
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+from helpers import (CITIES, FIRST_NAMES, LAST_NAMES, day_weights, degrees, distinct_targets,
+                     paragraph, power_law_rank, sentence, times_of_day)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
-
-fake = Faker()
-
-# Generate random profile image URLs to use for users
+# bcrypt of "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# users (or days, for messages) per part
+PART_USERS = 10000
+PART_DAYS = 14
+
+
+def split(start, stop, size):
+    """[start, stop) in consecutive ranges of at most `size`."""
+
+    return [(lo, min(lo + size, stop)) for lo in range(start, stop, size)]
+
+
+def share(total, ranges, whole):
+    """Split `total` between `ranges` in proportion to their length."""
+
+    bounds = [round(total * (hi - 1) / whole) for lo, hi in ranges]
+    return [b - a for a, b in zip([0] + bounds, bounds[:-1] + [total])]
+
+
+##############################################################################
+# Parts: each writes rows for one slice to its own file
+
+
+def users_part(rng, writer, args, lo, hi):
+    for user_id in range(lo, hi):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        username = f"{first}{last}{user_id}"
+        writer.writerow([f"{username}@example.com", username, rng.choice(IMAGE_URLS),
+                         PASSWORD_HASH, sentence(rng, 3, 10), None, rng.choice(CITIES)])
+
+
+def messages_part(rng, writer, args, lo, hi, cumulative):
+    start = args.end - timedelta(days=args.days)
+    for d in range(lo, hi):
+        count = (round(args.messages * cumulative[d])
+                 - round(args.messages * cumulative[d - 1]) if d else
+                 round(args.messages * cumulative[0]))
+        for timestamp in times_of_day(rng, start + timedelta(days=d), count):
+            writer.writerow([paragraph(rng, MAX_WARBLER_LENGTH), timestamp.isoformat(' '),
+                             power_law_rank(rng, args.users, args.post_exponent)])
+
+
+def follows_part(rng, writer, args, lo, hi, total):
+    def pick():
+        return power_law_rank(rng, args.users, args.follow_exponent)
+
+    for follower, count in zip(range(lo, hi), degrees(rng, hi - lo, total, args.users - 1)):
+        for followed in distinct_targets(rng, args.users, count, follower, pick):
+            writer.writerow([followed, follower])
+
+
+def likes_part(rng, writer, args, lo, hi, total):
+    def pick():
+        # recent messages (the highest ids) are the most liked
+        return args.messages + 1 - power_law_rank(rng, args.messages, args.like_exponent)
+
+    for user_id, count in zip(range(lo, hi), degrees(rng, hi - lo, total, args.messages)):
+        for message_id in distinct_targets(rng, args.messages, count, 0, pick):
+            writer.writerow([user_id, message_id])
+
+
+PARTS = {
+    'users': users_part,
+    'messages': messages_part,
+    'follows': follows_part,
+    'likes': likes_part,
+}
+
+
+def write_part(kind, n, args, *params):
+    """Write part `n` of `kind`; returns its path."""
+
+    rng = random.Random(f"{args.seed}-{kind}-{n}")
+    path = os.path.join(args.out, f".{kind}.part{n}.csv")
+    with open(path, 'w', newline='') as f:
+        PARTS[kind](rng, csv.writer(f), args, *params)
+    return path
+
+
+def tasks(args):
+    """(kind, part number, args, *params) for every part of every file."""
+
+    users = split(1, args.users + 1, PART_USERS)
+    days = split(0, args.days, PART_DAYS)
+    cumulative = day_weights(args.end - timedelta(days=args.days), args.days)
+
+    out = []
+    out += [('users', n, args, lo, hi) for n, (lo, hi) in enumerate(users)]
+    out += [('messages', n, args, lo, hi, cumulative) for n, (lo, hi) in enumerate(days)]
+    out += [('follows', n, args, lo, hi, total)
+            for n, ((lo, hi), total) in enumerate(zip(users, share(args.follows, users, args.users)))]
+    if args.likes:
+        out += [('likes', n, args, lo, hi, total)
+                for n, ((lo, hi), total) in enumerate(zip(users, share(args.likes, users, args.users)))]
+    return out
+
+
+def join_parts(out, kind, headers, parts):
+    """Concatenate `parts` under a header into `kind`.csv, removing them."""
+
+    with open(os.path.join(out, f"{kind}.csv"), 'w', newline='') as f:
+        csv.writer(f).writerow(headers)
+        for path in parts:
+            with open(path, newline='') as part:
+                shutil.copyfileobj(part, f)
+            os.remove(path)
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs at any scale.")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000)
+    parser.add_argument('--likes', type=int, default=0)
+    parser.add_argument('--seed', default='warbler', help="Same seed, same files.")
+    parser.add_argument('--days', type=int, default=730, help="Days of posting to cover.")
+    parser.add_argument('--end', type=datetime.fromisoformat, default=datetime(2024, 1, 1),
+                        help="When the posting period ends (ISO date).")
+    parser.add_argument('--follow-exponent', type=float, default=1.1,
+                        help="Power-law exponent of follower counts.")
+    parser.add_argument('--post-exponent', type=float, default=0.9,
+                        help="Power-law exponent of messages per user.")
+    parser.add_argument('--like-exponent', type=float, default=1.2,
+                        help="How strongly likes favour recent messages.")
+    parser.add_argument('--workers', type=int, default=1, help="Processes to generate with.")
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)))
+    args = parser.parse_args(argv)
+
+    if args.users < 2:
+        parser.error("--users must be at least 2")
+
+    work = tasks(args)
+    if args.workers > 1:
+        with Pool(args.workers) as pool:
+            paths = pool.starmap(write_part, work)
+    else:
+        paths = [write_part(*task) for task in work]
+
+    headers = {'users': USERS_CSV_HEADERS, 'messages': MESSAGES_CSV_HEADERS,
+               'follows': FOLLOWS_CSV_HEADERS, 'likes': LIKES_CSV_HEADERS}
+    for kind in PARTS:
+        parts = [path for task, path in zip(work, paths) if task[0] == kind]
+        if parts:
+            join_parts(args.out, kind, headers[kind], parts)
+
+
+if __name__ == '__main__':
+    main()
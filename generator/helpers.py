@@ -1,14 +1,149 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything takes an explicit `random.Random`, so a given seed always
+produces the same data.
+"""
 
+import bisect
+import itertools
+from datetime import datetime, timedelta
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+WORDS = """
+    about above across after again against almost alone along already also always among
+    answer around away back because become before begin behind believe below best better
+    between beyond body book both bring build call care carry case cause center change city
+    clear close coffee cold color come common could country course cover create cup dark day
+    deal decide deep develop different dinner door down draw dream during early earth easy
+    either energy enough even evening every example face fact fall family far fast feel field
+    fight figure final find fire first floor follow food force forest form forward free
+    friend front full game garden general give glass good great green ground group grow half
+    hand happen hard head hear heart heavy help here high hold home hope hour house idea
+    image inside island keep kind kitchen know land language large last late laugh learn
+    leave letter level life light line listen little live long look machine make many market
+    matter mean measure meet memory middle might mind minute moment money month morning most
+    mountain move music name nature near need never next night north note nothing notice now
+    number ocean offer office often open order other outside page paint paper part party pass
+    people perhaps picture piece place plan plant play point power present probably problem
+    produce question quick quiet rain reach read ready real reason record remember rest river
+    road rock room round rule run same school science season second seem sense serve several
+    shape share short show side sign simple since sing small snow social song soon sound
+    south space speak special spring stand star start state station stay step still stone
+    story street strong study summer sun sure system table take talk teach team tell think
+    those though thought through time today together tomorrow tonight town travel tree true
+    turn under until upon usual valley very voice wait walk wall watch water weather week
+    weekend while whole wind window winter wish without wonder word work world write year
+    yesterday young
+""".split()
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+FIRST_NAMES = """
+    ada alan alex amy ana ben beth cam carla chen dana dev diego ella emil eva finn gina
+    hana hugo ian ida isla jack jade jon kai kara kim leo lia luca mae maya mia nia nico
+    noah omar owen pia raj rosa ruth sam sara tara theo una vera wes yara yuki zoe
+""".split()
 
-    return datetime.fromtimestamp(random_timestamp)
+LAST_NAMES = """
+    adams baker brown chang cruz davis diaz evans fischer garcia gray hall hill ito jones
+    kato khan kim lee lopez martin meyer miller moore nguyen novak patel perez price reed
+    rossi ruiz sato scott silva smith stone tanaka taylor turner walker ward white wong
+    young
+""".split()
+
+CITIES = """
+    Amsterdam Athens Austin Bangalore Berlin Bogota Boston Cairo Chicago Denver Dublin
+    Helsinki Istanbul Jakarta Lagos Lima Lisbon London Madrid Manila Melbourne Mexico_City
+    Montreal Mumbai Nairobi Osaka Oslo Paris Portland Prague Santiago Seattle Seoul Sydney
+    Taipei Tokyo Toronto Vancouver Vienna Warsaw
+""".replace('_', ' ').split()
+
+# relative posting activity by hour of day (local time), and by weekday
+# (Monday first): a morning bump, a lunch bump and a big evening peak
+HOURLY = (3, 2, 1, 1, 1, 2, 4, 7, 9, 9, 8, 9, 11, 10, 9, 9, 10, 12, 14, 16, 17, 15, 11, 6)
+WEEKDAY = (1.0, 1.0, 1.0, 1.0, 1.05, 1.2, 1.15)
+
+_HOURLY_CUMULATIVE = list(itertools.accumulate(HOURLY))
+
+
+def power_law_rank(rng, n, exponent):
+    """A rank in 1..n with P(rank k) roughly proportional to k ** -exponent.
+
+    Inverts the CDF of the continuous power law, so it takes O(1) time and
+    memory whatever `n` is. Rank 1 is the most likely.
+    """
+
+    u = rng.random()
+    if exponent == 1:
+        rank = n ** u
+    else:
+        a = 1 - exponent
+        rank = ((n ** a - 1) * u + 1) ** (1 / a)
+    return min(n, int(rank))
+
+
+def degrees(rng, count, total, cap, sigma=1.0):
+    """`count` heavy-tailed (lognormal) degrees, each at most `cap`, that add
+    up to `total` (or to as much of it as the cap allows).
+
+    Streams: memory doesn't grow with `count`.
+    """
+
+    remaining = min(total, count * cap)
+    for left in range(count - 1, -1, -1):
+        mean = remaining / (left + 1)
+        d = round(mean * rng.lognormvariate(-sigma * sigma / 2, sigma))
+        # leave neither too much nor too little for the rest
+        d = max(min(d, cap, remaining), remaining - left * cap)
+        remaining -= d
+        yield d
+
+
+def distinct_targets(rng, n, k, exclude, pick):
+    """`k` distinct ids in 1..n, none equal to `exclude`, each drawn with
+    `pick()` until it gives a new one."""
+
+    k = min(k, n - (1 <= exclude <= n))
+    if k > n // 2:
+        # rejection would crawl; sample the range instead
+        ids = rng.sample(range(1, n + 1), min(k + 1, n))
+        return [i for i in ids if i != exclude][:k]
+
+    chosen = set()
+    while len(chosen) < k:
+        i = pick()
+        if i != exclude:
+            chosen.add(i)
+    return list(chosen)
+
+
+def day_weights(start, days, growth=2.0):
+    """Cumulative share of posts made by the end of each day.
+
+    Activity grows linearly to `growth` times its starting rate over the
+    period, and weekends are busier.
+    """
+
+    weights = [(1 + (growth - 1) * d / max(days - 1, 1)) * WEEKDAY[(start + timedelta(d)).weekday()]
+               for d in range(days)]
+    total = sum(weights)
+    return [w / total for w in itertools.accumulate(weights)]
+
+
+def times_of_day(rng, day, count):
+    """`count` sorted datetimes during `day`, following HOURLY."""
+
+    times = []
+    for _ in range(count):
+        hour = bisect.bisect_right(_HOURLY_CUMULATIVE, rng.random() * _HOURLY_CUMULATIVE[-1])
+        times.append(day + timedelta(hours=hour, seconds=rng.random() * 3600))
+    times.sort()
+    return times
+
+
+def sentence(rng, low, high):
+    words = rng.choices(WORDS, k=rng.randint(low, high))
+    return ' '.join(words).capitalize() + '.'
+
+
+def paragraph(rng, max_length):
+    """A few sentences, cut to `max_length` characters."""
+
+    return ' '.join(sentence(rng, 4, 12) for _ in range(rng.randint(1, 3)))[:max_length]
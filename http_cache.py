@@ -0,0 +1,118 @@
+"""HTTP caching: Cache-Control policies, ETags and versioned static URLs.
+
+Every response gets a Cache-Control header. Views choose theirs with
+`@cache_control(...)`; the rest get `no-cache` (revalidate before reuse),
+plus `private` when someone is signed in so shared caches never keep their
+pages. Dynamic pages also vary on Cookie.
+
+Views that can tell cheaply whether their page changed call `check_etag`
+with what the page depends on -- row versions (`User.row_version`), ids,
+the viewer -- before doing the expensive part. A client that already has
+that version gets an empty 304 without the page being rendered:
+
+    not_modified = http_cache.check_etag(user.id, user.row_version)
+    if not_modified:
+        return not_modified
+
+`static_url(filename)` (a template global) adds the file's content hash to
+its URL. Requests carrying the current hash are cached for a year; a new
+deploy changes the URL instead of waiting for caches to expire.
+"""
+
+import functools
+import hashlib
+import os
+
+from flask import current_app, g, request, session, url_for
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def cache_control(value):
+    """Send `value` as the Cache-Control header for this view's responses."""
+
+    def decorator(view):
+        view.cache_control = value
+        return view
+    return decorator
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def check_etag(*parts):
+    """Tag the response with a weak ETag made from `parts`.
+
+    Returns a 304 response if the client already has this version, else
+    None. `parts` must repr the same in every process: pass sorted lists,
+    not sets.
+    """
+
+    # templates are part of the page too: a deploy that changes them
+    # changes every tag
+    etag = _digest(repr((current_app.extensions['http_cache'], parts)).encode())
+    g.etag = etag
+
+    # pending flashes would be lost with the 304; render them instead
+    if '_flashes' not in session and request.if_none_match.contains_weak(etag):
+        return current_app.response_class(status=304)
+
+
+@functools.lru_cache(maxsize=1024)
+def _file_version(path, mtime_ns):
+    with open(path, 'rb') as f:
+        return _digest(f.read())
+
+
+def static_version(filename):
+    """Content hash of a file in the static folder, or None if it's missing."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        return _file_version(path, os.stat(path).st_mtime_ns)
+    except OSError:
+        return None
+
+
+def static_url(filename):
+    """URL for a static file that changes whenever the file does."""
+
+    return url_for('static', filename=filename, v=static_version(filename))
+
+
+def set_cache_headers(response):
+    """after_request hook applying the policies above."""
+
+    if request.endpoint == 'static':
+        version = request.args.get('v')
+        if version and version == static_version(request.view_args['filename']):
+            response.headers['Cache-Control'] = f"public, max-age={STATIC_MAX_AGE}, immutable"
+        return response
+
+    policy = getattr(current_app.view_functions.get(request.endpoint), 'cache_control', None)
+    if policy is None:
+        policy = "private, no-cache" if g.get('user') else "no-cache"
+    response.headers['Cache-Control'] = policy
+    response.vary.add('Cookie')
+
+    if g.get('etag') and response.status_code in (200, 304):
+        response.set_etag(g.etag, weak=True)
+    return response
+
+
+def _templates_version(app):
+    folder = os.path.join(app.root_path, app.template_folder)
+    h = hashlib.blake2b(digest_size=8)
+    for root, dirs, files in sorted(os.walk(folder)):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                h.update(os.path.relpath(path, folder).encode() + f.read())
+    return h.hexdigest()
+
+
+def init_app(app):
+    app.extensions['http_cache'] = _templates_version(app)
+    app.after_request(set_cache_headers)
+    app.add_template_global(static_url)
@@ -0,0 +1,163 @@
+"""Loading the logged-in user for each request.
+
+`add_user_to_g` used to run a primary-key query before every request. Most
+pages only need the navbar fields, so the loader hands out a `CurrentUser`
+built from a small snapshot and only loads the full `User` row when a view
+touches anything else (relationships, counters, methods, writes).
+
+Snapshots come from a process-local LRU, falling back to the copy stored in
+the (signed) session cookie at login, and finally to the database.
+
+The per-user counters are deliberately not in the snapshot: they change on
+every follow, like and post, and a stale copy would outlive the change on
+other worker processes. Pages that show them (home, profile) still load the
+full row.
+"""
+
+import time
+
+from cache import TTLCache
+from models import db, User
+import db_pool
+
+SNAPSHOT_FIELDS = ('id', 'username', 'image_url', 'header_image_url')
+
+# User methods that only need `self.id`; CurrentUser runs them unhydrated.
+ID_METHODS = ('is_followed_by', 'is_following', 'is_blocking', 'has_liked',
+              'following_among', 'liked_among')
+
+
+class UserGone(Exception):
+    """The logged-in user's row was deleted after their snapshot was cached."""
+
+
+def snapshot(user):
+    """The compact, JSON-safe view of `user` that the loader caches."""
+
+    data = {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+    data['loaded_at'] = time.time()
+    return data
+
+
+class CurrentUser:
+    """The logged-in user, backed by a snapshot until more is needed.
+
+    Snapshot fields are answered without touching the database. Any other
+    attribute -- and every write -- goes to the full `User` row, which is
+    loaded once per request on first use (see `hydrate`).
+    """
+
+    def __init__(self, data, user=None, loader=None):
+        self.__dict__.update(_data=data, _user=user, _loader=loader)
+
+    def hydrate(self, user=None):
+        """Return the full `User` row, loading it if needed.
+
+        Pass `user` to supply a row the view already fetched, e.g. a
+        detached one from async_db; it is merged into the session.
+        """
+
+        if self._user is None:
+            if user is not None:
+                user = db.session.merge(user, load=False)
+            else:
+                with db_pool.primary():
+                    user = db.session.get(User, self._data['id'])
+            if user is None:
+                if self._loader:
+                    self._loader.invalidate(self._data['id'])
+                raise UserGone(self._data['id'])
+            self.__dict__['_user'] = user
+
+        return self._user
+
+    @property
+    def is_hydrated(self):
+        return self._user is not None
+
+    def __getattr__(self, name):
+        if self._user is None and name in SNAPSHOT_FIELDS:
+            return self._data[name]
+        if self._user is None and name in ID_METHODS:
+            return getattr(User, name).__get__(self)
+        return getattr(self.hydrate(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.hydrate(), name, value)
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+def load_user(user_id, session_snapshot=None):
+    """Uncached loader: always fetch the full row."""
+
+    user = db.session.get(User, user_id)
+    return user and CurrentUser(snapshot(user), user)
+
+
+class SnapshotUserLoader:
+    """Resolve a session's user id to a `CurrentUser`, caching snapshots.
+
+    Snapshots live in a process-local LRU for `ttl` seconds. A snapshot from
+    the session cookie is trusted for the same `ttl` after it was taken,
+    unless it predates the last `invalidate`/`remember` for that user, so an
+    old cookie from another browser cannot put stale data back.
+
+    Call `remember` with the saved row when a snapshot field changes, and
+    `invalidate` when the user is deleted; other processes catch up when
+    their entry expires.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.ttl = ttl
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # user id -> time.time() of the last change we know about
+        self.changed_at = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def __call__(self, user_id, session_snapshot=None):
+        data = self.cache.get(user_id)
+
+        if data is None and self._is_fresh(user_id, session_snapshot):
+            data = session_snapshot
+            self.cache.set(user_id, data)
+
+        if data is not None:
+            return CurrentUser(data, loader=self)
+
+        with db_pool.primary():
+            user = db.session.get(User, user_id)
+        if user is None:
+            return None
+
+        data = snapshot(user)
+        self.cache.set(user_id, data)
+        return CurrentUser(data, user, loader=self)
+
+    def _is_fresh(self, user_id, data):
+        if not (isinstance(data, dict)
+                and data.get('id') == user_id
+                and all(field in data for field in SNAPSHOT_FIELDS)):
+            return False
+
+        loaded_at = data.get('loaded_at', 0)
+        return (time.time() - loaded_at < self.ttl
+                and loaded_at >= self.changed_at.get(user_id, 0))
+
+    def remember(self, user):
+        """Cache a new snapshot of `user` after a change; returns it for the session."""
+
+        self.changed_at.set(user.id, time.time())
+        data = snapshot(user)
+        self.cache.set(user.id, data)
+        return data
+
+    def invalidate(self, user_id):
+        self.changed_at.set(user_id, time.time())
+        self.cache.pop(user_id)
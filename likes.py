@@ -0,0 +1,70 @@
+"""Liking and unliking messages.
+
+Each change is a single statement against `likes` -- an INSERT ... ON
+CONFLICT DO NOTHING or a DELETE -- backed by the unique index on
+(user_id, message_id), so it costs the same however many messages the user
+has liked, and repeating it is harmless. `likes_count` is only bumped when
+a row was really added or removed.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Likes
+import counters
+
+LikeState = namedtuple('LikeState', 'message_id liked count')
+
+
+def like(user_id, message_id):
+    """Like `message_id` as `user_id`; returns the new LikeState."""
+
+    _add(user_id, message_id)
+    return LikeState(message_id, True, count(message_id))
+
+
+def unlike(user_id, message_id):
+    """Remove `user_id`'s like of `message_id`; returns the new LikeState."""
+
+    _remove(user_id, message_id)
+    return LikeState(message_id, False, count(message_id))
+
+
+def toggle(user_id, message_id):
+    """Unlike `message_id` if `user_id` likes it, otherwise like it."""
+
+    if _remove(user_id, message_id):
+        return LikeState(message_id, False, count(message_id))
+    return like(user_id, message_id)
+
+
+def count(message_id):
+    """How many users like `message_id`."""
+
+    return db.session.scalar(
+        select(func.count()).select_from(Likes).where(Likes.message_id == message_id))
+
+
+def _add(user_id, message_id):
+    added = db.session.scalar(
+        insert(Likes)
+        .values(user_id=user_id, message_id=message_id)
+        .on_conflict_do_nothing(index_elements=[Likes.user_id, Likes.message_id])
+        .returning(Likes.id))
+
+    if added is not None:
+        counters.bump(user_id, likes_count=1)
+    return added is not None
+
+
+def _remove(user_id, message_id):
+    removed = db.session.scalar(
+        delete(Likes)
+        .where(Likes.user_id == user_id, Likes.message_id == message_id)
+        .returning(Likes.id))
+
+    if removed is not None:
+        counters.bump(user_id, likes_count=-1)
+    return removed is not None
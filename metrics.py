@@ -0,0 +1,577 @@
+"""In-process metrics: counters, gauges and histograms.
+
+A deliberately small registry in the spirit of the Prometheus client.
+Modules create their metrics at import time and update them inline:
+
+    LATENCY = metrics.histogram('password_hash_seconds', "Time to hash a password.")
+    LATENCY.observe(elapsed)
+
+    REQUESTS = metrics.counter('requests_total', "Requests served.", ['endpoint'])
+    REQUESTS.labels(endpoint='homepage').inc()
+
+`collect()` returns everything registered; `flask metrics show` prints it
+and `init_app` serves it at /metrics in Prometheus's text format, along
+with request latency by endpoint and status and the requests in flight.
+
+Counters and histograms keep a cell per thread, so updating one takes no
+lock: each thread only adds to its own cell and collection sums them.
+Gauges take a short lock.
+
+Under gunicorn every worker has its own registry. Set METRICS_DIR to a
+directory the workers share (a tmpfs such as /dev/shm is best): each
+worker writes its samples there every METRICS_FLUSH_INTERVAL seconds, and
+/metrics merges the files, so whichever worker is scraped reports the
+whole server. A worker's file is named by its pid and start time, so a new
+worker that gets an old one's pid can't overwrite it. Exited workers'
+counters and histograms are folded into one exited.json (see
+`fold_exited`), so totals never go backwards and the directory doesn't
+grow with every worker ever started; gauges only count live workers.
+Empty the directory when the server starts, e.g. in gunicorn's
+`on_starting` hook, and fold as workers go in its `child_exit` hook:
+
+    def child_exit(server, worker):
+        metrics.fold_exited(os.environ['METRICS_DIR'])
+
+Without METRICS_TOKEN, /metrics only answers requests made straight from
+the same host (loopback, and not forwarded by a proxy). Set a token to
+scrape from anywhere else.
+
+    METRICS_DIR              shared directory for multiprocess mode (default: off)
+    METRICS_FLUSH_INTERVAL   seconds between a worker's writes (default 5)
+    METRICS_TOKEN            if set, /metrics wants `Authorization: Bearer <token>`
+"""
+
+import atexit
+import bisect
+import contextlib
+import fcntl
+import hmac
+import json
+import math
+import os
+import threading
+import time
+
+import click
+from flask import current_app, g, request
+from flask.cli import AppGroup
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+REGISTRY = {}
+_registry_lock = threading.Lock()
+
+
+class _Metric:
+    """A named metric, optionally split into children by label values."""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        self._cells = {}
+        self._init()
+
+    def _init(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        """The child metric for these label values, created on first use."""
+
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(
+                    key, type(self)(self.name, self.help, **self._child_args()))
+        return child
+
+    def _child_args(self):
+        return {}
+
+    def _cell(self):
+        """This thread's cell; only this thread ever writes to it."""
+
+        ident = threading.get_ident()
+        cell = self._cells.get(ident)
+        if cell is None:
+            with self._lock:
+                cell = self._cells.setdefault(ident, self._new_cell())
+        return cell
+
+    def _all_cells(self):
+        with self._lock:
+            return list(self._cells.values())
+
+    def samples(self):
+        """[(labels dict, value dict)] for this metric and its children."""
+
+        if not self.labelnames:
+            return [({}, self._value())]
+        with self._lock:
+            children = sorted(self._children.items())
+        return [(dict(zip(self.labelnames, key)), child._value()) for key, child in children]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _init(self):
+        self.function = None
+
+    def _new_cell(self):
+        return [0]
+
+    def inc(self, amount=1):
+        self._cell()[0] += amount
+
+    def set_function(self, function):
+        """Read the total from `function()` instead, e.g. a count kept elsewhere."""
+
+        self.function = function
+
+    @property
+    def value(self):
+        if self.function:
+            return self.function()
+        return sum(cell[0] for cell in self._all_cells())
+
+    def _value(self):
+        return {'value': self.value}
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _init(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def set_function(self, function):
+        """Read the value from `function()` whenever the gauge is collected."""
+
+        self.function = function
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def _value(self):
+        return {'value': self.function() if self.function else self.value}
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _init(self):
+        pass
+
+    def _child_args(self):
+        return {'buckets': self.buckets}
+
+    def _new_cell(self):
+        # a count per bucket, the last one +Inf, then the sum and the count
+        return [0] * (len(self.buckets) + 1) + [0.0, 0]
+
+    def observe(self, value):
+        cell = self._cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def _totals(self):
+        totals = self._new_cell()
+        for cell in self._all_cells():
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+    @property
+    def counts(self):
+        return self._totals()[:-2]
+
+    @property
+    def sum(self):
+        return self._totals()[-2]
+
+    @property
+    def count(self):
+        return self._totals()[-1]
+
+    def _value(self):
+        totals = self._totals()
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), totals[:-2]):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'sum': totals[-2], 'count': totals[-1]}
+
+
+def _register(cls, name, help, labelnames, **kwargs):
+    with _registry_lock:
+        metric = REGISTRY.get(name)
+        if metric is None:
+            metric = REGISTRY[name] = cls(name, help, labelnames, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name!r} is already registered as a {metric.kind}")
+        return metric
+
+
+def counter(name, help, labelnames=()):
+    return _register(Counter, name, help, labelnames)
+
+
+def gauge(name, help, labelnames=()):
+    return _register(Gauge, name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, help, labelnames, buckets=buckets)
+
+
+def collect():
+    """Every registered metric, sorted by name."""
+
+    return [REGISTRY[name] for name in sorted(REGISTRY)]
+
+
+##############################################################################
+# Snapshots: plain data, for writing to disk and merging across processes
+
+
+def snapshot():
+    """Every registered metric as {name: {'kind', 'help', 'samples'}}."""
+
+    return {metric.name: {'kind': metric.kind, 'help': metric.help,
+                          'samples': metric.samples()}
+            for metric in collect()}
+
+
+EXITED = 'exited.json'
+
+# (pid, start) of this process, worked out again after a fork
+_identity = (None, None)
+
+
+def _started(pid):
+    """Process `pid`'s start time in clock ticks since boot, from /proc; None
+    if it isn't running or there is no /proc."""
+
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # field 22; the command name before it is in parentheses and may hold spaces
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+def _file_name():
+    global _identity
+
+    pid = os.getpid()
+    if _identity[0] != pid:
+        # without /proc, the time this process first wrote will do
+        _identity = (pid, _started(pid) or int(time.time() * 1000))
+    return f"{pid}-{_identity[1]}.json"
+
+
+def _alive(pid, start):
+    started = _started(pid)
+    if started is not None:
+        return str(started) == start
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _write(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    # readers see the old file or the new one, never half of either
+    os.replace(path + '.tmp', path)
+
+
+def write_snapshot(directory):
+    """Write this process's snapshot to `directory`/<pid>-<start>.json."""
+
+    _write(os.path.join(directory, _file_name()), snapshot())
+
+
+@contextlib.contextmanager
+def _locked(directory, operation):
+    with open(os.path.join(directory, '.lock'), 'a') as f:
+        fcntl.flock(f, operation)
+        yield
+
+
+def _process_files(directory):
+    """[(path, snapshot, alive)] for every process that has written one."""
+
+    found = []
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        pid, _, start = stem.partition('-')
+        if ext != '.json' or not pid.isdigit() or not start:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as f:
+                found.append((path, json.load(f), _alive(int(pid), start)))
+        except (OSError, ValueError):
+            continue
+    return found
+
+
+def _read_exited(directory):
+    try:
+        with open(os.path.join(directory, EXITED)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_snapshots(directory):
+    """[(snapshot, alive)] for every process that has written one, and
+    exited.json's folded totals."""
+
+    # shared: a fold in between two reads would count the folded files twice
+    with _locked(directory, fcntl.LOCK_SH):
+        found = [(data, alive) for path, data, alive in _process_files(directory)]
+        return found + [(_read_exited(directory), False)]
+
+
+def fold_exited(directory):
+    """Add exited processes' counters and histograms to exited.json and
+    remove their files. Returns how many were folded."""
+
+    with _locked(directory, fcntl.LOCK_EX):
+        exited = [(path, data) for path, data, alive in _process_files(directory) if not alive]
+        if exited:
+            _write(os.path.join(directory, EXITED),
+                   merge([(_read_exited(directory), False)]
+                         + [(data, False) for path, data in exited]))
+            for path, data in exited:
+                os.remove(path)
+        return len(exited)
+
+
+def _add(total, value):
+    if total is None:
+        return value
+    if 'buckets' in value:
+        return {'buckets': [(bound, a + b) for (bound, a), (_, b)
+                            in zip(total['buckets'], value['buckets'])],
+                'sum': total['sum'] + value['sum'],
+                'count': total['count'] + value['count']}
+    return {'value': total['value'] + value['value']}
+
+
+def merge(snapshots):
+    """Combine [(snapshot, alive)] into one snapshot. Counters and
+    histograms are summed over every process, gauges over live ones."""
+
+    merged = {}
+    for data, alive in snapshots:
+        for name, metric in data.items():
+            if metric['kind'] == 'gauge' and not alive:
+                continue
+            entry = merged.setdefault(name, dict(metric, samples={}))
+            for labels, value in metric['samples']:
+                key = tuple(sorted(labels.items()))
+                entry['samples'][key] = _add(entry['samples'].get(key), value)
+
+    return {name: dict(entry, samples=[(dict(key), value)
+                                       for key, value in sorted(entry['samples'].items())])
+            for name, entry in sorted(merged.items())}
+
+
+_flusher_pid = None
+
+
+def start_flusher(directory, interval=5):
+    """Write this process's snapshot to `directory` every `interval`
+    seconds, and at exit. Safe to call often: it starts one thread per
+    process, so workers forked after the first call start their own."""
+
+    global _flusher_pid
+
+    with _registry_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+
+    def flush():
+        while True:
+            time.sleep(interval)
+            _try_write_snapshot(directory)
+            try:
+                fold_exited(directory)
+            except OSError:
+                pass
+
+    threading.Thread(target=flush, name='metrics-flush', daemon=True).start()
+    atexit.register(_try_write_snapshot, directory)
+
+
+def _try_write_snapshot(directory):
+    try:
+        write_snapshot(directory)
+    except OSError:
+        pass
+
+
+##############################################################################
+# Prometheus text format
+
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and not math.isfinite(value):
+        return "NaN"
+    return repr(value)
+
+
+def _sample_line(name, labels, value):
+    if labels:
+        escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+                   for v in labels.values())
+        name += "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+    return f"{name} {_number(value)}"
+
+
+def exposition(data):
+    """A snapshot in Prometheus's text exposition format."""
+
+    lines = []
+    for name, metric in data.items():
+        help = metric['help'].replace('\\', r'\\').replace('\n', r'\n')
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for labels, value in metric['samples']:
+            if metric['kind'] != 'histogram':
+                lines.append(_sample_line(name, labels, value['value']))
+                continue
+            for bound, count in value['buckets']:
+                lines.append(_sample_line(f"{name}_bucket",
+                                          dict(labels, le=_number(float(bound))), count))
+            lines.append(_sample_line(f"{name}_sum", labels, value['sum']))
+            lines.append(_sample_line(f"{name}_count", labels, value['count']))
+    return "\n".join(lines) + "\n"
+
+
+##############################################################################
+# Request metrics and /metrics
+
+REQUEST_SECONDS = histogram('http_request_duration_seconds', "Time to handle a request.",
+                            ['endpoint', 'method', 'status'])
+REQUESTS_IN_FLIGHT = gauge('http_requests_in_flight', "Requests being handled.")
+
+
+def _start_request():
+    directory = current_app.config.get('METRICS_DIR')
+    if directory:
+        start_flusher(directory, current_app.config.get('METRICS_FLUSH_INTERVAL', 5))
+
+    g.metrics_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+
+
+def _record_request(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        # unmatched URLs share one label, so scanners can't add series
+        REQUEST_SECONDS.labels(endpoint=request.endpoint or 'none', method=request.method,
+                               status=response.status_code
+                               ).observe(time.perf_counter() - started)
+    return response
+
+
+def _finish_request(error=None):
+    if g.pop('metrics_started', None) is not None:
+        REQUESTS_IN_FLIGHT.dec()
+
+
+LOOPBACK = ('127.0.0.1', '::1')
+
+
+def _from_this_host():
+    # a proxy on this host would look like loopback, but it forwards
+    return (request.remote_addr in LOOPBACK
+            and 'X-Forwarded-For' not in request.headers
+            and 'Forwarded' not in request.headers)
+
+
+def metrics_view():
+    """Every metric, in Prometheus's text format."""
+
+    config = current_app.config
+    token = config.get('METRICS_TOKEN')
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                   f"Bearer {token}".encode()):
+            return current_app.response_class("Unauthorized\n", status=401)
+    elif not _from_this_host():
+        return current_app.response_class("Forbidden: set METRICS_TOKEN to scrape remotely\n",
+                                          status=403)
+
+    directory = config.get('METRICS_DIR')
+    if directory:
+        write_snapshot(directory)
+        fold_exited(directory)
+        data = merge(read_snapshots(directory))
+    else:
+        data = snapshot()
+    return current_app.response_class(exposition(data),
+                                      content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_app(app):
+    """Time the app's requests and serve /metrics. Call before the other
+    modules add request hooks, so the time their hooks take is counted."""
+
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+    app.teardown_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+##############################################################################
+# CLI
+
+metrics_cli = AppGroup('metrics', help="Inspect in-process metrics.")
+
+
+@metrics_cli.command('show')
+def show_command():
+    """Print this process's metrics."""
+
+    for metric in collect():
+        for labels, value in metric.samples():
+            label = ",".join(f"{k}={v}" for k, v in labels.items())
+            name = f"{metric.name}{{{label}}}" if label else metric.name
+            if metric.kind == 'histogram':
+                mean = value['sum'] / value['count'] if value['count'] else 0
+                click.echo(f"{name} count={value['count']} mean={mean:.4f}s")
+            else:
+                click.echo(f"{name} {value['value']}")
@@ -0,0 +1,312 @@
+"""Versioned schema migrations for Warbler.
+
+A fresh database is built straight from the models with `db.create_all()` and
+stamped with the latest version. An existing database is brought up to date
+by running, in order, every migration newer than the version recorded in
+`schema_version`. Each migration runs in its own transaction and is written
+so that re-running it is harmless.
+
+Schema changes only happen through `flask db upgrade`, run once per deploy.
+Importing the app just checks the schema is current (see `warn_if_behind`).
+
+    flask db upgrade         apply pending migrations
+    flask db current         show the recorded version
+    flask db check-indexes   EXPLAIN each route's query and check its index
+"""
+
+import logging
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import inspect, select, insert, delete, func, text
+
+from models import (db, User, Message, Follows, Likes, BlockedUsers, DirectMessage,
+                    TimelineEntry, Conversation, ConversationParticipant)
+import conversations
+import counters
+import search
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+# pg_advisory_xact_lock key; any constant unique to this app will do
+UPGRADE_LOCK_ID = 0x7761726231
+
+
+class SchemaVersion(db.Model):
+    """One applied migration."""
+
+    __tablename__ = 'schema_version'
+
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.Text, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+def migration(version, description):
+    """Register the decorated `fn(conn)` as migration number `version`."""
+
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+
+    return register
+
+
+def head():
+    """The newest migration version."""
+
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(conn):
+    """The newest version applied to the database behind `conn`."""
+
+    if not inspect(conn).has_table(SchemaVersion.__tablename__):
+        return 0
+    return conn.scalar(select(func.max(SchemaVersion.version))) or 0
+
+
+def upgrade(target=None):
+    """Bring the database up to `target` (default: the newest version).
+
+    Returns the list of versions applied.
+    """
+
+    target = head() if target is None else target
+    engine = db.engine
+
+    with engine.begin() as conn:
+        _lock(conn)
+        if not inspect(conn).has_table(User.__tablename__):
+            db.metadata.create_all(conn)
+            _record(conn, [m for m in MIGRATIONS if m[0] <= target])
+            return []
+
+        SchemaVersion.__table__.create(conn, checkfirst=True)
+
+    applied = []
+
+    for m in MIGRATIONS:
+        if m[0] > target:
+            break
+        with engine.begin() as conn:
+            # re-read under the lock: another upgrade may have applied it
+            _lock(conn)
+            if current_version(conn) < m[0]:
+                m[2](conn)
+                _record(conn, [m])
+                applied.append(m[0])
+
+    return applied
+
+
+def warn_if_behind():
+    """Log a warning if the database is missing migrations; never changes it."""
+
+    with db.engine.connect() as conn:
+        version = current_version(conn)
+
+    if version < head():
+        logger.warning("Database schema is at version %s but the code expects %s; "
+                       "run `flask db upgrade`.", version, head())
+    return version
+
+
+def _lock(conn):
+    """Serialize concurrent upgrades for the rest of `conn`'s transaction."""
+
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {'id': UPGRADE_LOCK_ID})
+
+
+def _record(conn, migrations):
+    if migrations:
+        conn.execute(insert(SchemaVersion),
+                     [dict(version=v, description=d) for v, d, fn in migrations])
+
+
+##############################################################################
+# Migrations. Never edit one that has shipped; add a new one instead.
+
+
+@migration(1, "materialized home timelines")
+def add_timeline_entries(conn):
+    # fill it afterwards with `flask timeline backfill`
+    TimelineEntry.__table__.create(conn, checkfirst=True)
+
+
+@migration(2, "per-user counters")
+def add_user_counters(conn):
+    counters.add_columns(conn)
+
+
+@migration(3, "indexes for feed, DM, follow, like and block lookups")
+def add_lookup_indexes(conn):
+    # the new unique indexes would fail on existing duplicate rows
+    for model, columns in ((Likes, (Likes.user_id, Likes.message_id)),
+                           (BlockedUsers, (BlockedUsers.user_id, BlockedUsers.blocked_user_id))):
+        keep = select(func.min(model.id)).group_by(*columns)
+        conn.execute(delete(model).where(model.id.not_in(keep)))
+
+    # named, not "every index on these tables": later migrations add more
+    names = {'ix_messages_user_id_timestamp', 'ix_direct_messages_recipient_timestamp',
+             'ix_direct_messages_sender_timestamp', 'ix_follows_user_following_id',
+             'ix_likes_user_message', 'ix_likes_message_id',
+             'ix_blocked_users_user_blocked', 'ix_blocked_users_blocked_user'}
+    for model in (Message, DirectMessage, Follows, Likes, BlockedUsers):
+        for index in model.__table__.indexes:
+            if index.name in names:
+                index.create(conn, checkfirst=True)
+
+    # likes_count was counted in migration 2, before the duplicates went
+    conn.execute(counters.recount_statement())
+
+
+@migration(4, "full-text user search index")
+def add_user_search_index(conn):
+    for index in User.__table__.indexes:
+        if index.name == 'ix_users_search':
+            index.create(conn, checkfirst=True)
+
+
+@migration(5, "direct message conversations")
+def add_conversations(conn):
+    Conversation.__table__.create(conn, checkfirst=True)
+    ConversationParticipant.__table__.create(conn, checkfirst=True)
+
+    columns = {c['name'] for c in inspect(conn).get_columns(DirectMessage.__tablename__)}
+    if 'conversation_id' not in columns:
+        conn.execute(text("ALTER TABLE direct_messages ADD COLUMN conversation_id INTEGER "
+                          "REFERENCES conversations (id) ON DELETE CASCADE"))
+
+    for stmt in conversations.backfill_statements():
+        conn.execute(stmt)
+
+    if conn.dialect.name == 'postgresql':
+        # SQLite can't add NOT NULL to a column in place; the model enforces it there
+        conn.execute(text("ALTER TABLE direct_messages ALTER COLUMN conversation_id SET NOT NULL"))
+
+    for index in DirectMessage.__table__.indexes:
+        if index.name == 'ix_direct_messages_conversation_timestamp':
+            index.create(conn, checkfirst=True)
+
+
+##############################################################################
+# Index checks: the query each hot route runs, and the index it should use.
+
+ROUTE_QUERIES = [
+    ("/", 'ix_timeline_entries_owner_timestamp',
+     select(TimelineEntry.message_id)
+     .where(TimelineEntry.owner_id == 1)
+     .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.message_id.desc())
+     .limit(100)),
+    ("/users?q=", 'ix_users_search',
+     search.search_query("jo lon").with_only_columns(User.id).limit(30)),
+    ("/users/<id>", 'ix_messages_user_id_timestamp',
+     select(Message.id)
+     .where(Message.user_id == 1)
+     .order_by(Message.timestamp.desc(), Message.id.desc())
+     .limit(100)),
+    ("/users/<id>/following", 'ix_follows_user_following_id',
+     select(Follows.user_being_followed_id).where(Follows.user_following_id == 1)),
+    ("/users/<id>/followers", 'follows_pkey',
+     select(Follows.user_following_id).where(Follows.user_being_followed_id == 1)),
+    ("/users/<id>/likes", 'ix_likes_user_message',
+     select(Likes.message_id).where(Likes.user_id == 1)),
+    ("/messages/<id>/like", 'ix_likes_message_id',
+     select(func.count()).select_from(Likes).where(Likes.message_id == 1)),
+    ("/users/block/<id>", 'ix_blocked_users_user_blocked',
+     select(BlockedUsers.blocked_user_id).where(BlockedUsers.user_id == 1)),
+    ("blocked-by lookups", 'ix_blocked_users_blocked_user',
+     select(BlockedUsers.user_id).where(BlockedUsers.blocked_user_id == 1)),
+    ("/dm/inbox", 'ix_conversation_participants_inbox',
+     select(ConversationParticipant.conversation_id)
+     .where(ConversationParticipant.user_id == 1)
+     .order_by(ConversationParticipant.last_message_at.desc(),
+               ConversationParticipant.conversation_id.desc())
+     .limit(100)),
+    ("/dm/with/<id>", 'ix_direct_messages_conversation_timestamp',
+     select(DirectMessage.id)
+     .where(DirectMessage.conversation_id == 1)
+     .order_by(DirectMessage.timestamp.desc(), DirectMessage.id.desc())
+     .limit(100)),
+    ("/dm/sent", 'ix_direct_messages_sender_timestamp',
+     select(DirectMessage.id)
+     .where(DirectMessage.sender_id == 1)
+     .order_by(DirectMessage.timestamp.desc(), DirectMessage.id.desc())
+     .limit(100)),
+]
+
+
+def explain(conn, stmt):
+    """The query plan for `stmt` as one string."""
+
+    sql = str(stmt.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == 'sqlite' else "EXPLAIN "
+    return "\n".join(str(row[-1]) for row in conn.execute(text(prefix + sql)))
+
+
+def check_indexes():
+    """EXPLAIN every ROUTE_QUERIES entry; return (route, index, used, plan) tuples.
+
+    On PostgreSQL sequential scans are disabled for the check, so a tiny
+    table still shows whether the index *can* serve the query.
+    """
+
+    results = []
+
+    with db.engine.connect() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text("SET LOCAL enable_seqscan = off"))
+
+        for route, index, stmt in ROUTE_QUERIES:
+            plan = explain(conn, stmt)
+            results.append((route, index, index in plan, plan))
+
+        conn.rollback()
+
+    return results
+
+
+##############################################################################
+# CLI
+
+db_cli = AppGroup('db', help="Manage the database schema.")
+
+
+@db_cli.command('upgrade')
+@click.option('--to', 'target', type=int, help="Stop at this version.")
+def upgrade_command(target):
+    """Apply pending migrations."""
+
+    applied = upgrade(target)
+    click.echo(f"Applied {applied}." if applied else "Already up to date.")
+
+
+@db_cli.command('current')
+def current_command():
+    """Show the database's schema version."""
+
+    with db.engine.connect() as conn:
+        click.echo(f"{current_version(conn)} (head is {head()})")
+
+
+@db_cli.command('check-indexes')
+@click.option('--verbose', is_flag=True, help="Print every plan.")
+def check_indexes_command(verbose):
+    """Check that each hot route's query uses its index."""
+
+    failed = 0
+
+    for route, index, used, plan in check_indexes():
+        click.echo(f"{'ok  ' if used else 'FAIL'} {route:<26} {index}")
+        if verbose or not used:
+            click.echo("     " + plan.replace("\n", "\n     "))
+        failed += not used
+
+    if failed:
+        raise SystemExit(1)
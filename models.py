@@ -1,11 +1,14 @@
 """SQLAlchemy models for Warbler."""
 
 from datetime import datetime
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import exists, func, literal_column, select
+from sqlalchemy.dialects.postgresql import REGCONFIG
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import db_pool
+import passwords
+
+db = SQLAlchemy(session_options={'class_': db_pool.RoutingSession})
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -24,6 +27,12 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key covers "who follows X"; this covers "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 class Likes(db.Model):
     """Mapping user likes to messages."""
 
@@ -44,6 +53,11 @@ class Likes(db.Model):
         db.ForeignKey('messages.id', ondelete='cascade')
     )
 
+    __table_args__ = (
+        db.Index('ix_likes_user_message', 'user_id', 'message_id', unique=True),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
 
 class BlockedUsers(db.Model):
     """Mapping of users blocking other users."""
@@ -54,6 +68,29 @@ class BlockedUsers(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'))
     blocked_user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'))
 
+    __table_args__ = (
+        db.Index('ix_blocked_users_user_blocked', 'user_id', 'blocked_user_id', unique=True),
+        db.Index('ix_blocked_users_blocked_user', 'blocked_user_id', 'user_id'),
+    )
+
+def _exists(*criteria):
+    return db.session.scalar(select(exists().where(*criteria)))
+
+
+def _ids_among(column, ids, *criteria):
+    ids = set(ids)
+    if not ids:
+        return set()
+    return set(db.session.scalars(select(column).where(column.in_(ids), *criteria)))
+
+
+def _search_document(username, bio, location):
+    text = (func.coalesce(username, '') + ' '
+            + func.coalesce(bio, '') + ' '
+            + func.coalesce(location, ''))
+    return func.to_tsvector(literal_column("'simple'", REGCONFIG), text)
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -99,6 +136,46 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Maintained by counters.py so pages never count a whole relationship.
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Postgres's row version: changes whenever anything on the row does
+    # (profile edits, counters). Never written; select it explicitly.
+    row_version = db.deferred(db.Column('xmin', db.Text, system=True,
+                                        server_default=db.FetchedValue()))
+
+    # queries must use User.search_document() unchanged to hit this index
+    __table_args__ = (
+        db.Index('ix_users_search', _search_document(username, bio, location),
+                 postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+
     followers = db.relationship(
         "User",
         secondary="follows",
@@ -124,19 +201,43 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    # The predicates below answer with one indexed EXISTS (or IN) query and
+    # only use self.id, so they never load a relationship collection.
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return _exists(Follows.user_being_followed_id == self.id,
+                       Follows.user_following_id == other_user.id)
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return _exists(Follows.user_following_id == self.id,
+                       Follows.user_being_followed_id == other_user.id)
 
     def is_blocking(self, other_user):
         """Check if this user is blocking another user."""
-        return other_user in self.blocked_users
+        return _exists(BlockedUsers.user_id == self.id,
+                       BlockedUsers.blocked_user_id == other_user.id)
+
+    def has_liked(self, message):
+        """Has this user liked `message`?"""
+        return _exists(Likes.user_id == self.id,
+                       Likes.message_id == message.id)
+
+    def following_among(self, user_ids):
+        """The subset of `user_ids` this user follows, in one query."""
+        return _ids_among(Follows.user_being_followed_id, user_ids,
+                          Follows.user_following_id == self.id)
+
+    def liked_among(self, message_ids):
+        """The subset of `message_ids` this user has liked, in one query."""
+        return _ids_among(Likes.message_id, message_ids,
+                          Likes.user_id == self.id)
+
+    @classmethod
+    def search_document(cls):
+        """The full-text document user search matches (see search.py)."""
+        return _search_document(cls.username, cls.bio, cls.location)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -144,7 +245,7 @@ class User(db.Model):
 
         Hashes password and adds user to system.
         """
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hasher.hash(password)
 
         user = User(
             username=username,
@@ -169,12 +270,26 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
+            if user.check_password(password):
                 return user
+        else:
+            passwords.hasher.check_dummy(password)
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's hash?
+
+        On a match, a hash stored at an old work factor is replaced while
+        we have the plaintext; the caller's commit saves it.
+        """
+        if not passwords.hasher.check(self.password, password):
+            return False
+
+        if passwords.hasher.needs_rehash(self.password):
+            self.password = passwords.hasher.hash(password)
+        return True
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -205,6 +320,70 @@ class Message(db.Model):
 
     user = db.relationship('User', backref='messages')
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+
+class Conversation(db.Model):
+    """The thread of direct messages between one pair of users.
+
+    The pair is stored in a canonical order (user_a_id < user_b_id) so the
+    unique index finds the thread for two users whoever wrote first.
+    Maintained by conversations.py.
+    """
+
+    __tablename__ = 'conversations'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_a_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False)
+    user_b_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False)
+    last_message_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_conversations_pair', 'user_a_id', 'user_b_id', unique=True),
+        db.CheckConstraint('user_a_id < user_b_id', name='ck_conversations_pair_order'),
+    )
+
+
+class ConversationParticipant(db.Model):
+    """One user's side of a conversation: what their inbox lists."""
+
+    __tablename__ = 'conversation_participants'
+
+    conversation_id = db.Column(
+        db.Integer,
+        db.ForeignKey('conversations.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    other_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # copied from the conversation so the inbox is one index range read
+    last_message_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # the newest message this user has seen in the thread
+    last_read_message_id = db.Column(db.Integer)
+
+    other_user = db.relationship('User', foreign_keys=[other_user_id])
+
+    __table_args__ = (
+        db.Index('ix_conversation_participants_inbox',
+                 'user_id', 'last_message_at', 'conversation_id'),
+    )
+
 
 class DirectMessage(db.Model):
     """Direct messages between users."""
@@ -212,6 +391,7 @@ class DirectMessage(db.Model):
     __tablename__ = 'direct_messages'
 
     id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id', ondelete='cascade'), nullable=False)
     sender_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False)
     recipient_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False)
     text = db.Column(db.Text, nullable=False)
@@ -220,10 +400,60 @@ class DirectMessage(db.Model):
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_messages')
     recipient = db.relationship('User', foreign_keys=[recipient_id], backref='received_messages')
 
+    __table_args__ = (
+        db.Index('ix_direct_messages_recipient_timestamp', 'recipient_id', 'timestamp', 'id'),
+        db.Index('ix_direct_messages_sender_timestamp', 'sender_id', 'timestamp', 'id'),
+        db.Index('ix_direct_messages_conversation_timestamp', 'conversation_id', 'timestamp', 'id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline.
+
+    Rows are written when a message is posted (fanned out to the author and
+    every follower) and when a follow starts, so the home page is a single
+    range read on (owner_id, timestamp).
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_owner_timestamp',
+                 'owner_id', 'timestamp', 'message_id'),
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. Pool sizing and the read
+    replica come from the app's config; see db_pool.py.
     """
+    db_pool.configure(app)
     db.app = app
     db.init_app(app)
+    with app.app_context():
+        db_pool.watch(db.engines)
@@ -0,0 +1,151 @@
+"""Keyset (cursor) pagination for Warbler feeds.
+
+Feeds are ordered newest first by (timestamp, id). A page is fetched with a
+row-value comparison against the last row the client saw, so page 50 costs
+the same index range read as page 1 -- there is no OFFSET.
+
+Cursors are opaque to clients: `?before=<cursor>` walks to older rows and
+`?after=<cursor>` walks back to newer ones.
+"""
+
+import base64
+import binascii
+from datetime import datetime
+
+from flask import abort, current_app, request, url_for
+from sqlalchemy import tuple_
+
+
+def encode_cursor(timestamp, id):
+    """Encode a (timestamp, id) feed position as an opaque URL-safe string."""
+
+    raw = f"{timestamp.isoformat()}|{id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by `encode_cursor`; raises ValueError if mangled."""
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, id = raw.split("|")
+        return datetime.fromisoformat(timestamp), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as exc:
+        raise ValueError(f"Bad cursor: {cursor!r}") from exc
+
+
+class Page:
+    """One page of a feed, with cursors for its neighbouring pages."""
+
+    def __init__(self, items, older_cursor=None, newer_cursor=None):
+        self.items = items
+        self.older_cursor = older_cursor
+        self.newer_cursor = newer_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def older_url(self):
+        """URL of the next (older) page, or None on the last page."""
+        if self.older_cursor:
+            return self._url(before=self.older_cursor)
+
+    @property
+    def newer_url(self):
+        """URL of the previous (newer) page, or None on the first page."""
+        if self.newer_cursor:
+            return self._url(after=self.newer_cursor)
+
+    def _url(self, **cursor):
+        """This endpoint's URL at `cursor`, keeping an explicit ?limit=."""
+        args = dict(request.view_args, **cursor)
+        if 'limit' in request.args:
+            args['limit'] = request.args['limit']
+        return url_for(request.endpoint, **args)
+
+
+def page_size():
+    """Rows per page: `?limit=` if given, capped at FEED_MAX_PAGE_SIZE."""
+
+    default = current_app.config['FEED_PAGE_SIZE']
+    limit = request.args.get('limit', default, type=int)
+    return max(1, min(limit, current_app.config['FEED_MAX_PAGE_SIZE']))
+
+
+class Keyset:
+    """The request's position in a newest-first feed ordered by
+    (`timestamp_col`, `id_col`), read from its cursors.
+
+    `apply` restricts a query (a Query or a select) to one page, and
+    `page` turns the rows it returned into a Page. `paginate` does both;
+    use them separately to run the query some other way (e.g. async).
+    """
+
+    def __init__(self, timestamp_col, id_col, per_page=None, key=None):
+        self.timestamp_col = timestamp_col
+        self.id_col = id_col
+        self.per_page = per_page or page_size()
+        self.key = key or (lambda row: (row.timestamp, row.id))
+
+        try:
+            before = request.args.get('before')
+            self.before = before and decode_cursor(before)
+            after = request.args.get('after')
+            self.after = after and decode_cursor(after)
+        except ValueError:
+            abort(400)
+
+    def apply(self, query):
+        """`query` limited to this page (plus one row, to spot the next).
+
+        Any ordering or limit already on `query` is replaced.
+        """
+
+        position = tuple_(self.timestamp_col, self.id_col)
+        query = query.order_by(None)
+
+        if self.after:
+            return (query
+                    .filter(position > tuple_(*self.after))
+                    .order_by(self.timestamp_col.asc(), self.id_col.asc())
+                    .limit(self.per_page + 1))
+
+        if self.before:
+            query = query.filter(position < tuple_(*self.before))
+        return (query
+                .order_by(self.timestamp_col.desc(), self.id_col.desc())
+                .limit(self.per_page + 1))
+
+    def page(self, rows):
+        """The Page for the rows `apply`'s query returned."""
+
+        if self.after:
+            has_newer, has_older = len(rows) > self.per_page, True
+            items = rows[:self.per_page][::-1]
+        else:
+            has_newer, has_older = bool(self.before), len(rows) > self.per_page
+            items = rows[:self.per_page]
+
+        if not items:
+            return Page(items)
+
+        return Page(items,
+                    older_cursor=encode_cursor(*self.key(items[-1])) if has_older else None,
+                    newer_cursor=encode_cursor(*self.key(items[0])) if has_newer else None)
+
+
+def paginate(query, timestamp_col, id_col, per_page=None, key=None):
+    """Fetch one newest-first page of `query` using the request's cursors.
+
+    `timestamp_col`/`id_col` are the columns the feed is ordered by; `key`
+    maps a result row back to its (timestamp, id) position and defaults to
+    the row's own `timestamp` and `id` attributes. Any ordering or limit
+    already on `query` is replaced.
+    """
+
+    keyset = Keyset(timestamp_col, id_col, per_page, key)
+    return keyset.page(keyset.apply(query).all())
@@ -0,0 +1,184 @@
+"""Password hashing off the request thread.
+
+bcrypt is slow on purpose: at cost 12 one hash or check takes about a
+quarter of a second of CPU. Run inline, a burst of logins pins every worker
+and starves all other routes. `PasswordHasher` runs that work on a small
+process pool instead, and caps how many requests may be waiting for it:
+once `max_pending` are in flight, new callers get `HasherBusy` (a 503)
+straight away instead of queueing behind the burst.
+
+    BCRYPT_LOG_ROUNDS       work factor for new hashes (default 12)
+    PASSWORD_WORKERS        pool processes; 0 hashes inline (default: CPUs)
+    PASSWORD_MAX_PENDING    in-flight limit (default: 4 per worker)
+    PASSWORD_TIMEOUT        seconds to wait for a result (default 10)
+
+Hashes made at a different cost still verify; `needs_rehash` tells
+`User.authenticate` to store a fresh hash after a successful login, so
+changing BCRYPT_LOG_ROUNDS migrates users as they sign in.
+
+This module must not import the app or models: pool workers import it.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+import metrics
+
+LATENCY = metrics.histogram('password_hash_seconds',
+                            "Time to hash or check a password, including queueing.",
+                            ['op'])
+BCRYPT_SECONDS = metrics.histogram('password_bcrypt_seconds',
+                                   "Time bcrypt itself took, without queueing.", ['op'])
+IN_FLIGHT = metrics.gauge('password_hash_in_flight', "Password operations in progress.")
+REJECTED = metrics.counter('password_hash_rejected_total',
+                           "Password operations refused because the pool was full.")
+
+
+class HasherBusy(Exception):
+    """Too many password operations are already waiting; try again later."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def _timed(fn, *args):
+    """fn(*args) and the seconds it took, measured where it ran."""
+
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class PasswordHasher:
+    """bcrypt on a bounded process pool."""
+
+    def __init__(self, rounds=12, workers=None, max_pending=None, timeout=10):
+        self.rounds = rounds
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.max_pending = max_pending or 4 * max(self.workers, 1)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._dummy_hash = None
+
+    def hash(self, password):
+        """A new bcrypt hash of `password` at the configured cost."""
+
+        if not password:
+            raise ValueError("Password must be non-empty.")
+        return self._run('hash', _hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`? Malformed hashes never match."""
+
+        try:
+            return self._run('check', _check, hashed, password)
+        except ValueError:
+            return False
+
+    def check_dummy(self, password):
+        """Spend as long as a real check would, then return False.
+
+        For logins naming a user that doesn't exist, so they take as long
+        as a wrong password and don't reveal which usernames are taken.
+        """
+
+        if self._dummy_hash is None:
+            self._dummy_hash = self.hash(os.urandom(16).hex())
+        self.check(self._dummy_hash, password)
+        return False
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than the current one?"""
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def _run(self, op, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            REJECTED.inc()
+            raise HasherBusy()
+
+        IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            if not self.workers:
+                try:
+                    result, seconds = _timed(fn, *args)
+                finally:
+                    self._release()
+            else:
+                result, seconds = self._submit(fn, *args)
+            BCRYPT_SECONDS.labels(op=op).observe(seconds)
+            return result
+        finally:
+            LATENCY.labels(op=op).observe(time.perf_counter() - start)
+
+    def _submit(self, fn, *args):
+        try:
+            future = self._executor().submit(_timed, fn, *args)
+        except BaseException:
+            self._release()
+            raise
+
+        # the slot is held until the pool is done with the work, not just
+        # until we stop waiting, so timed-out work still counts towards
+        # max_pending and the pool's queue can't grow past it
+        future.add_done_callback(lambda future: self._release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HasherBusy() from None
+
+    def _release(self):
+        IN_FLIGHT.dec()
+        self._slots.release()
+
+    def _executor(self):
+        # started on first use, so importing the app doesn't fork
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+# Replaced by init_app; inline until then so scripts that use the models
+# without the app (seed.py) still work.
+hasher = PasswordHasher(workers=0)
+
+
+def init_app(app):
+    """Build the app's hasher from its config."""
+
+    global hasher
+
+    hasher = PasswordHasher(
+        rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+        workers=app.config.get('PASSWORD_WORKERS'),
+        max_pending=app.config.get('PASSWORD_MAX_PENDING'),
+        timeout=app.config.get('PASSWORD_TIMEOUT', 10))
+    return hasher
@@ -0,0 +1,174 @@
+"""Per-request SQL instrumentation and the slow-query log.
+
+Engine events time every statement a request sends. After the request:
+
+- the response gets a `Server-Timing: db;dur=12.3;desc="5 queries"`
+  header, so browser dev tools show database time next to the rest;
+- if any statement took at least QUERY_LOG_SLOW_MS, a WARNING goes to the
+  `query_log` logger listing the slowest ones;
+- a QUERY_LOG_SAMPLE_RATE fraction of the other requests are logged at
+  INFO, so the log shows what normal traffic costs too.
+
+Each log line is one JSON object: the endpoint, status, statement count,
+database time and up to QUERY_LOG_TOP of the slowest statements. Statements
+are logged with their parameters' shapes (types and row counts) and never
+their values, so passwords and messages stay out of the logs.
+
+    QUERY_LOG_SLOW_MS       slow statement threshold (default 100)
+    QUERY_LOG_SAMPLE_RATE   fraction of other requests to log (default 0.01)
+    QUERY_LOG_TOP           slowest statements kept per request (default 5)
+    SERVER_TIMING           send the Server-Timing header (default on)
+
+Timing a statement costs two clock reads. Only statements that are slow,
+or that beat the request's current top few, are kept. That makes this
+cheap enough to leave on in production.
+
+Only statements sent from the request's own thread are counted. Streamed
+bodies run their queries after the response has gone, so those are
+missed, and so are async views' statements on the event loop's thread.
+"""
+
+import heapq
+import json
+import logging
+import random
+import re
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+MAX_STATEMENT_LENGTH = 1000
+
+
+class QueryTrace:
+    """What one request sent to the database."""
+
+    def __init__(self, top=5, slow_seconds=0.1):
+        self.count = 0
+        self.seconds = 0.0
+        self.top = top
+        self.slow_seconds = slow_seconds
+        # min-heap of (seconds, n, statement, shape): the `top` slowest
+        self.slowest = []
+        self.has_slow = False
+
+    def record(self, seconds, statement, parameters, executemany):
+        self.count += 1
+        self.seconds += seconds
+        if seconds >= self.slow_seconds:
+            self.has_slow = True
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, (seconds, self.count, statement,
+                                          shape(parameters, executemany)))
+        elif self.slowest and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, self.count, statement,
+                                             shape(parameters, executemany)))
+
+    def statements(self):
+        """The slowest statements, slowest first, ready for the log."""
+
+        return [{'ms': round(seconds * 1000, 3), 'sql': tidy(statement), 'params': params}
+                for seconds, n, statement, params in sorted(self.slowest, reverse=True)]
+
+
+def shape(parameters, executemany=False):
+    """Parameters' types without their values: {'name': 'str'} for a dict,
+    ['int', 'str'] for a tuple, and a row count for executemany."""
+
+    if executemany:
+        rows = list(parameters)
+        return {'rows': len(rows), 'each': shape(rows[0]) if rows else None}
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def tidy(statement):
+    """`statement` on one line, cut to MAX_STATEMENT_LENGTH."""
+
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    if len(statement) > MAX_STATEMENT_LENGTH:
+        statement = statement[:MAX_STATEMENT_LENGTH] + "..."
+    return statement
+
+
+##############################################################################
+# Engine events and request hooks
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_log_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_log_start'].pop()
+    if has_request_context():
+        trace = g.get('query_trace')
+        if trace is not None:
+            trace.record(time.perf_counter() - started, statement, parameters, executemany)
+
+
+def _handle_error(context):
+    # a failed statement never reaches after_cursor_execute
+    starts = context.connection.info.get('query_log_start') if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def listen(engine):
+    """Time `engine`'s statements for the current request."""
+
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+
+
+def start_trace():
+    """before_request hook: start counting this request's statements."""
+
+    config = current_app.config
+    g.query_trace = QueryTrace(top=config.get('QUERY_LOG_TOP', 5),
+                               slow_seconds=config.get('QUERY_LOG_SLOW_MS', 100) / 1000)
+
+
+def finish_trace(response):
+    """after_request hook: add Server-Timing and write the log line."""
+
+    trace = g.pop('query_trace', None)
+    if trace is None:
+        return response
+
+    config = current_app.config
+    if config.get('SERVER_TIMING', True):
+        response.headers.add(
+            'Server-Timing', f'db;dur={trace.seconds * 1000:.1f};desc="{trace.count} queries"')
+
+    if trace.has_slow or (trace.count
+                          and random.random() < config.get('QUERY_LOG_SAMPLE_RATE', 0.01)):
+        logger.log(logging.WARNING if trace.has_slow else logging.INFO, json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'queries': trace.count,
+            'db_ms': round(trace.seconds * 1000, 3),
+            'slowest': trace.statements(),
+        }))
+    return response
+
+
+def init_app(app):
+    """Time the statements of every request to the app's databases; call
+    after connect_db."""
+
+    with app.app_context():
+        for engine in app.extensions['sqlalchemy'].engines.values():
+            listen(engine)
+    app.before_request(start_trace)
+    app.after_request(finish_trace)
@@ -0,0 +1,114 @@
+"""User search for `/users?q=`.
+
+Matches are found with PostgreSQL full-text search over username, bio and
+location (`User.search_document()`, indexed by the GIN index
+`ix_users_search`), so a search is an index lookup rather than a
+leading-wildcard scan of every user. Each word of the query matches as a
+prefix: "jo lon" finds a user "john" in "London".
+
+Results are ranked with username prefix matches first, then by text rank,
+then alphabetically. They are paged with `?page=`, and no more than
+SEARCH_MAX_RESULTS are ever reachable, which keeps the OFFSET bounded.
+The index is an ordinary database index, so signups and profile edits show
+up in the next search with nothing extra to maintain.
+"""
+
+import re
+
+from flask import current_app, request, url_for
+from sqlalchemy import case, false, func, literal_column, select
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.orm import undefer
+
+from models import db, User
+
+WORD = re.compile(r"\w+")
+
+
+def to_tsquery(search):
+    """A prefix tsquery matching every word in `search`, or None if it has none.
+
+    Only word characters reach `to_tsquery`, so user input can't inject
+    tsquery operators.
+    """
+
+    words = WORD.findall(search.lower())
+    if not words:
+        return None
+    return func.to_tsquery(literal_column("'simple'", REGCONFIG),
+                           " & ".join(f"{word}:*" for word in words))
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_query(search, *criteria):
+    """A select of users matching `search` and `criteria`, best first.
+
+    A blank `search` matches all users.
+    """
+
+    users = select(User).where(*criteria)
+
+    if not search:
+        return users.order_by(User.username)
+
+    tsquery = to_tsquery(search)
+    if tsquery is None:
+        return users.where(false())
+
+    document = User.search_document()
+    username_prefix = User.username.ilike(_escape_like(search) + "%", escape="\\")
+
+    return (users
+            .where(document.op("@@")(tsquery))
+            .order_by(case((username_prefix, 0), else_=1),
+                      func.ts_rank(document, tsquery).desc(),
+                      User.username))
+
+
+class Results:
+    """One page of search results."""
+
+    def __init__(self, items, number, has_next):
+        self.items = items
+        self.number = number
+        self.has_next = has_next
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def prev_url(self):
+        if self.number > 1:
+            return self._url(self.number - 1)
+
+    @property
+    def next_url(self):
+        if self.has_next:
+            return self._url(self.number + 1)
+
+    def _url(self, number):
+        return url_for(request.endpoint, **dict(request.args, page=number))
+
+
+def search_users(search, page=1, criteria=()):
+    """One page of `search_query(search, *criteria)`, within SEARCH_MAX_RESULTS."""
+
+    per_page = current_app.config['SEARCH_PAGE_SIZE']
+    max_results = current_app.config['SEARCH_MAX_RESULTS']
+
+    last_page = max(1, -(-max_results // per_page))
+    page = max(1, min(page, last_page))
+    offset = (page - 1) * per_page
+    limit = min(per_page, max_results - offset)
+
+    query = search_query(search, *criteria).options(undefer(User.row_version))
+    rows = db.session.scalars(query.offset(offset).limit(limit + 1)).all()
+    has_next = len(rows) > limit and offset + limit < max_results
+
+    return Results(rows[:limit], page, has_next)
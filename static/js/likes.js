@@ -0,0 +1,21 @@
+// Like buttons: toggle in place over JSON instead of posting the form and
+// reloading "/". Without JavaScript the form still works as before.
+$(document).on('submit', 'form.messages-like', function (evt) {
+  evt.preventDefault();
+  var $form = $(this);
+  var $button = $form.find('button').prop('disabled', true);
+
+  $.ajax({
+    url: $form.attr('action'),
+    method: 'POST',
+    headers: {Accept: 'application/json'}
+  }).done(function (state) {
+    $button.toggleClass('btn-primary', state.liked)
+           .toggleClass('btn-secondary', !state.liked)
+           .attr('title', state.count + (state.count === 1 ? ' like' : ' likes'));
+  }).fail(function () {
+    $form[0].submit();  // fall back to a normal post (no submit event)
+  }).always(function () {
+    $button.prop('disabled', false);
+  });
+});
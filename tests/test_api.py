@@ -0,0 +1,147 @@
+import gzip
+import json
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows, BlockedUsers
+from app import app, CURR_USER_KEY, user_loader, block_list
+import conversations
+import timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 JSON endpoints."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            for i in (1, 2, 3):
+                user = User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                user.id = i
+            db.session.flush()
+
+            db.session.add(Follows(user_being_followed_id=2, user_following_id=1))
+            for n in range(3):
+                db.session.add(Message(text=f"post {n}", user_id=2))
+            db.session.flush()
+            conversations.send(2, 1, "hi")
+            timeline.backfill(1)
+            db.session.commit()
+
+            self.message_ids = [m.id for m in Message.query.order_by(Message.id)]
+
+        user_loader.cache.clear()
+        block_list.cache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def login(self, c, user_id=1):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_requires_login(self):
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.json, {"error": "Access unauthorized."})
+
+    def test_timeline_pages_with_cursors(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/v1/timeline?limit=2")
+            self.assertEqual([m["text"] for m in resp.json["data"]], ["post 2", "post 1"])
+            self.assertEqual(resp.json["data"][0]["username"], "user2")
+            self.assertIs(resp.json["data"][0]["liked"], False)
+            self.assertIsNone(resp.json["newer"])
+
+            resp = c.get(f"/api/v1/timeline?limit=2&before={resp.json['older']}")
+            self.assertEqual([m["text"] for m in resp.json["data"]], ["post 0"])
+            self.assertIsNone(resp.json["older"])
+
+    def test_field_selection(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/v1/timeline?fields=text")
+            self.assertEqual(set(resp.json["data"][0]), {"id", "timestamp", "text"})
+
+            resp = c.get("/api/v1/timeline?fields=text,password")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_profile_and_follow_lists(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/v1/users/2")
+            self.assertEqual(resp.json["username"], "user2")
+            self.assertEqual(resp.json["messages_count"], 0)
+            self.assertIs(resp.json["following"], True)
+
+            resp = c.get("/api/v1/users/2/followers")
+            self.assertEqual([(u["id"], u["following"]) for u in resp.json["data"]], [(1, False)])
+
+            resp = c.get("/api/v1/users/1/following?fields=username")
+            self.assertEqual(resp.json["data"], [{"id": 2, "username": "user2"}])
+
+    def test_blocked_profile_is_hidden(self):
+        with app.app_context():
+            db.session.add(BlockedUsers(user_id=3, blocked_user_id=1))
+            db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/api/v1/users/3")
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn("error", resp.json)
+
+    def test_inbox(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/api/v1/inbox")
+        [thread] = resp.json["data"]
+        self.assertEqual((thread["user_id"], thread["username"], thread["unread_count"]),
+                         (2, "user2", 1))
+
+    def test_like_and_follow_are_idempotent(self):
+        message_id = self.message_ids[0]
+
+        with self.client as c:
+            self.login(c)
+
+            for _ in range(2):
+                resp = c.put(f"/api/v1/messages/{message_id}/like")
+                self.assertEqual(resp.json, {"message_id": message_id, "liked": True, "count": 1})
+            resp = c.delete(f"/api/v1/messages/{message_id}/like")
+            self.assertEqual(resp.json["count"], 0)
+
+            resp = c.post("/api/v1/users/3/follow")
+            self.assertEqual(resp.json, {"user_id": 3, "following": True, "followers_count": 1})
+            for _ in range(2):
+                resp = c.delete("/api/v1/users/3/follow")
+                self.assertEqual(resp.json["followers_count"], 0)
+
+            self.assertEqual(c.put("/api/v1/users/1/follow").status_code, 403)
+
+    def test_large_responses_are_gzipped(self):
+        with app.app_context():
+            for n in range(50):
+                db.session.add(Message(text="x" * 100, user_id=2))
+            db.session.flush()
+            timeline.backfill(1)
+            db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/api/v1/timeline", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        body = json.loads(gzip.decompress(resp.get_data()))
+        self.assertEqual(len(body["data"]), 53)
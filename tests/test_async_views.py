@@ -0,0 +1,95 @@
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from models import db, User, Message, Follows, Likes, BlockedUsers
+from app import app, CURR_USER_KEY, ASYNC_VIEWS, user_loader, block_list, fragment_cache
+from async_db import async_url
+import conversations
+import timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class AsyncViewsTestCase(TestCase):
+    """Test that the async views serve the same pages as the sync ones."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            for i in (1, 2, 3):
+                user = User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                user.id = i
+            db.session.flush()
+
+            for author in (2, 3):
+                db.session.add(Follows(user_being_followed_id=author, user_following_id=1))
+                for n in range(3):
+                    db.session.add(Message(text=f"post {n} by {author}", user_id=author))
+                conversations.send(author, 1, f"dm from {author}")
+            db.session.flush()
+            timeline.backfill(1)
+
+            self.liked_id = Message.query.filter_by(user_id=2).first().id
+            db.session.add(Likes(user_id=1, message_id=self.liked_id))
+            db.session.commit()
+
+        self.client = app.test_client()
+        self.clear_caches()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def clear_caches(self):
+        user_loader.cache.clear()
+        block_list.cache.clear()
+        fragment_cache.clear()
+
+    def get_both(self, url, user_id=1):
+        """`url` as served by the sync and then the async view."""
+
+        pages = []
+        for views in ({}, ASYNC_VIEWS):
+            self.clear_caches()
+            with patch.dict(app.view_functions, views), self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                resp = c.get(url)
+            pages.append((resp.status_code, resp.get_data(as_text=True)))
+        return pages
+
+    def test_pages_match(self):
+        for url in ("/", "/?limit=2", "/users/2", "/users/1?limit=1", "/dm/inbox"):
+            with self.subTest(url=url):
+                sync, async_ = self.get_both(url)
+                self.assertEqual(sync[0], 200)
+                self.assertEqual(sync, async_)
+
+    def test_liked_state(self):
+        _, (status, html) = self.get_both("/")
+        self.assertEqual(status, 200)
+        self.assertEqual(html.count("btn-primary"), 1)
+        self.assertIn(f'action="/messages/{self.liked_id}/like"', html)
+
+    def test_blocks_are_applied_and_cached(self):
+        with app.app_context():
+            db.session.add(BlockedUsers(user_id=1, blocked_user_id=3))
+            db.session.add(BlockedUsers(user_id=2, blocked_user_id=1))
+            db.session.commit()
+
+        sync, async_ = self.get_both("/")
+        self.assertEqual(sync, async_)
+        self.assertNotIn("by 3", async_[1])
+        self.assertEqual(block_list.cached(1).blocking, {3})
+
+        sync, async_ = self.get_both("/users/2")
+        self.assertEqual((sync[0], async_[0]), (404, 404))
+
+    def test_async_url(self):
+        self.assertEqual(str(async_url("postgresql:///warbler")), "postgresql+asyncpg:///warbler")
+        self.assertEqual(str(async_url("sqlite:///test.db")), "sqlite+aiosqlite:///test.db")
+        with self.assertRaises(ValueError):
+            async_url("mysql://db/warbler")
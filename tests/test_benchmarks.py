@@ -0,0 +1,84 @@
+import json
+import os
+from unittest import TestCase
+from benchmarks.compare import regressions
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from models import db, User
+from app import app
+from benchmarks import datasets
+
+
+def report(p50=10.0, p99=20.0, queries=3, rss=100.0, dataset='1k'):
+    return {
+        'dataset': {'scale': dataset},
+        'client': 'test',
+        'routes': {'home': {'p50_ms': p50, 'p99_ms': p99, 'queries': queries}},
+        'peak_rss_mb': rss,
+    }
+
+
+class CompareTestCase(TestCase):
+    """Test judging benchmark reports against a baseline."""
+
+    def test_within_tolerance(self):
+        self.assertEqual(regressions(report(), report(p50=12.0, p99=24.0, rss=110.0)), [])
+
+    def test_small_changes_ignored(self):
+        # +50%, but only half a millisecond
+        self.assertEqual(regressions(report(p50=1.0), report(p50=1.5)), [])
+
+    def test_latency_regression(self):
+        found = regressions(report(), report(p99=30.0))
+        self.assertEqual(found, [('home', "p99_ms 20.00 -> 30.00")])
+
+    def test_query_regression(self):
+        found = regressions(report(), report(queries=4))
+        self.assertEqual(found, [('home', "queries 3 -> 4")])
+
+    def test_rss_regression(self):
+        found = regressions(report(), report(rss=200.0), rss_tolerance=0.5)
+        self.assertEqual(found, [('*', "peak RSS 100.0 -> 200.0 MB")])
+
+    def test_different_datasets(self):
+        found = regressions(report(), report(dataset='100k'))
+        self.assertEqual(len(found), 1)
+        self.assertIn("datasets differ", found[0][1])
+
+    def test_stored_baseline(self):
+        path = os.path.join(os.path.dirname(datasets.__file__), 'baseline-1k.json')
+        with open(path) as f:
+            baseline = json.load(f)
+        self.assertEqual(baseline['dataset'], dict(datasets.SCALES['1k'], seed=datasets.SEED))
+        self.assertEqual(regressions(baseline, baseline), [])
+
+
+class TargetTestCase(TestCase):
+    """Test that loading a dataset won't drop a database by mistake."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_empty_database(self):
+        with app.app_context():
+            datasets.check_target()
+
+    def test_database_with_rows(self):
+        with app.app_context():
+            User.signup("dev", "dev@test.com", "password", None)
+            db.session.commit()
+
+            with self.assertRaisesRegex(datasets.UnsafeDatabase, "--reload"):
+                datasets.check_target()
+            # warbler-test isn't a benchmark database, even with --reload
+            with self.assertRaisesRegex(datasets.UnsafeDatabase, "bench"):
+                datasets.check_target(reload=True)
+            db.session.rollback()
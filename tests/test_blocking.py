@@ -0,0 +1,119 @@
+import os
+import time
+from unittest import TestCase
+from models import db, User, Message, Follows, BlockedUsers, DirectMessage
+from app import app, CURR_USER_KEY, BLOCKS_CHANGED_KEY, block_list
+import conversations
+import timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class BlockingTestCase(TestCase):
+    """Test that blocks hide users from feeds, search and DMs."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            self.client = app.test_client()
+
+            for uid, name in ((1111, "alice"), (2222, "bob"), (3333, "carol")):
+                u = User.signup(name, f"{name}@test.com", "password", None)
+                u.id = uid
+            db.session.flush()
+
+            for uid in (2222, 3333):
+                db.session.add(Follows(user_being_followed_id=uid, user_following_id=1111))
+                db.session.add(Message(text=f"post by {uid}", user_id=uid))
+                conversations.send(uid, 1111, f"dm from {uid}")
+            db.session.flush()
+            timeline.backfill(1111)
+            db.session.commit()
+
+        block_list.cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+        block_list.cache.clear()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def get(self, c, url):
+        return c.get(url).get_data(as_text=True)
+
+    def test_block_hides_both_directions(self):
+        with self.client as c:
+            self.login(c, 1111)
+            self.assertIn("post by 2222", self.get(c, "/"))
+
+            c.post("/users/block/2222")
+
+            self.assertNotIn("post by 2222", self.get(c, "/"))
+            self.assertIn("post by 3333", self.get(c, "/"))
+            self.assertNotIn("@bob", self.get(c, "/users?q=bo"))
+            self.assertNotIn("@bob", self.get(c, "/dm/inbox"))
+            self.assertIn("@carol", self.get(c, "/dm/inbox"))
+            self.assertEqual(c.get("/dm/with/2222").status_code, 404)
+            # the blocker can still reach the profile to unblock
+            self.assertIn("Unblock", self.get(c, "/users/2222"))
+            self.assertNotIn("post by 2222", self.get(c, "/users/2222"))
+
+            self.login(c, 2222)
+            self.assertEqual(c.get("/users/1111").status_code, 404)
+            self.assertNotIn("@alice", self.get(c, "/users"))
+            c.post("/dm/send/1111", data={"text": "let me in"})
+
+            self.login(c, 1111)
+            c.post("/users/unblock/2222")
+            self.assertIn("post by 2222", self.get(c, "/"))
+            self.assertIn("dm from 2222", self.get(c, "/dm/with/2222"))
+            self.assertNotIn("let me in", self.get(c, "/dm/with/2222"))
+
+    def test_block_twice_is_harmless(self):
+        with self.client as c:
+            self.login(c, 1111)
+            c.post("/users/block/2222")
+            resp = c.post("/users/block/2222")
+            self.assertEqual(resp.status_code, 302)
+
+    def test_no_blocks_adds_no_filter(self):
+        with app.app_context():
+            self.assertEqual(block_list.get(1111), (frozenset(), frozenset()))
+            criterion = block_list.visible_to(1111, Message.user_id)
+            self.assertEqual(str(criterion), "true")
+
+    def block_elsewhere(self, user_id, blocked_user_id):
+        """A block committed by another process, whose cache we don't share."""
+        with app.app_context():
+            db.session.add(BlockedUsers(user_id=user_id, blocked_user_id=blocked_user_id))
+            db.session.commit()
+
+    def test_session_stamp_expires_other_processes_cache(self):
+        with self.client as c:
+            self.login(c, 1111)
+            self.assertIn("post by 2222", self.get(c, "/"))
+
+            self.block_elsewhere(1111, 2222)
+            with c.session_transaction() as sess:
+                sess[BLOCKS_CHANGED_KEY] = time.time()
+
+            self.assertNotIn("post by 2222", self.get(c, "/"))
+
+    def test_dm_checks_skip_the_cache(self):
+        with app.app_context():
+            self.assertEqual(block_list.get(2222), (frozenset(), frozenset()))
+
+        with self.client as c:
+            self.login(c, 2222)
+            self.block_elsewhere(1111, 2222)
+            c.post("/dm/send/1111", data={"text": "let me in"})
+
+        with app.app_context():
+            self.assertIsNone(DirectMessage.query.filter_by(text="let me in").first())
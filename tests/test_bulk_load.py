@@ -0,0 +1,126 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+import click
+import psycopg2
+from sqlalchemy import create_engine, func, inspect, select
+from models import db, User, Message, Follows
+from app import app
+import bulk_load
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class BulkLoadTestCase(TestCase):
+    """Test bulk loading CSV and NDJSON files."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.files = {
+            'users': self.write('users.csv', "email,username,password,bio\n" + "".join(
+                f"u{i}@test.com,user{i},hash,\n" for i in range(1, 4))),
+            'messages': self.write('messages.ndjson', "".join(
+                json.dumps({'text': f"post {n}", 'timestamp': f"2020-01-0{n + 1}T00:00:00",
+                            'user_id': 1 + n % 2}) + "\n" for n in range(5))
+                + json.dumps({'text': "tab\there\nand \\N", 'user_id': 3}) + "\n"),
+            'follows': self.write('follows.csv',
+                                  "user_being_followed_id,user_following_id\n1,2\n1,3\n2,3\n"),
+        }
+
+    def tearDown(self):
+        self.dir.cleanup()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def write(self, name, content):
+        path = os.path.join(self.dir.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def load(self, **kwargs):
+        with app.app_context():
+            return bulk_load.load(self.files, report=lambda line: None, **kwargs)
+
+    def test_load(self):
+        self.assertEqual(self.load(fresh=True, chunk_size=2),
+                         {'users': 3, 'messages': 6, 'follows': 3})
+
+        with app.app_context():
+            user = db.session.get(User, 1)
+            self.assertEqual((user.username, user.bio, user.image_url),
+                             ("user1", None, "/static/images/default-pic.png"))
+            self.assertEqual((user.messages_count, user.followers_count), (3, 2))
+            self.assertEqual(db.session.get(Message, 6).text, "tab\there\nand \\N")
+
+            inspector = inspect(db.engine)
+            self.assertEqual(len(inspector.get_foreign_keys('follows')), 2)
+            self.assertIn('ix_messages_user_id_timestamp',
+                          {index['name'] for index in inspector.get_indexes('messages')})
+            self.assertEqual(db.session.scalar(select(func.count(bulk_load.LoadCheckpoint.source))), 0)
+
+    def test_resumes_after_a_bad_row(self):
+        good = self.files['follows']
+        self.files['follows'] = self.write('bad.csv', open(good).read() + "3,oops\n")
+        with self.assertRaises(ValueError):
+            self.load(fresh=True, chunk_size=2)
+
+        with app.app_context():
+            self.assertEqual(db.session.query(Follows).count(), 2)
+            self.assertEqual(inspect(db.engine).get_foreign_keys('follows'), [])
+            db.session.remove()
+
+        with open(self.files['follows'], 'w') as f:
+            f.write(open(good).read())
+        self.assertEqual(self.load(chunk_size=2), {'users': 0, 'messages': 0, 'follows': 1})
+
+        with app.app_context():
+            self.assertEqual(db.session.query(User).count(), 3)
+            self.assertEqual(db.session.query(Follows).count(), 3)
+            self.assertEqual(len(inspect(db.engine).get_foreign_keys('follows')), 2)
+
+    def test_ids_survive_a_failed_chunk(self):
+        good = self.files['messages']
+        lines = open(good).read().splitlines(keepends=True)
+        # line 4 has no text, so the second chunk fails halfway through COPY
+        self.files['messages'] = self.write('bad.ndjson', "".join(
+            json.dumps({'user_id': 1}) + "\n" if n == 3 else line
+            for n, line in enumerate(lines)))
+        with self.assertRaises(psycopg2.IntegrityError):
+            self.load(fresh=True, chunk_size=2)
+
+        with app.app_context():
+            self.assertEqual(db.session.query(Message).count(), 2)
+            db.session.remove()
+
+        with open(self.files['messages'], 'w') as f:
+            f.write("".join(lines))
+        self.assertEqual(self.load(chunk_size=2)['messages'], 4)
+
+        with app.app_context():
+            texts = dict(db.session.execute(select(Message.id, Message.text)).all())
+            self.assertEqual(sorted(texts), [1, 2, 3, 4, 5, 6])
+            self.assertEqual(texts[4], "post 3")
+
+            # the sequence carries on after the loaded ids
+            message = Message(text="new", user_id=1)
+            db.session.add(message)
+            db.session.commit()
+            self.assertEqual(message.id, 7)
+
+    def test_refuses_tables_with_rows(self):
+        self.load(fresh=True)
+        with self.assertRaises(click.UsageError):
+            self.load()
+
+    def test_executemany_fallback(self):
+        engine = create_engine("sqlite://")
+        loader = bulk_load.Loader(Message.__table__, ['text', 'user_id'])
+        with engine.begin() as conn:
+            Message.__table__.create(conn)
+            loader.write(conn, list(loader.chunks([{'text': "hi", 'user_id': "7"}]))[0])
+            row = conn.execute(select(Message.user_id, Message.timestamp)).one()
+        self.assertEqual(row.user_id, 7)
+        self.assertIsNotNone(row.timestamp)
@@ -0,0 +1,107 @@
+import os
+from unittest import TestCase
+from sqlalchemy import text
+from models import db, User, DirectMessage, Conversation, ConversationParticipant
+from app import app, CURR_USER_KEY
+import conversations
+import migrations
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class ConversationsTestCase(TestCase):
+    """Test threaded direct messages."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            self.client = app.test_client()
+
+            for uid, name in ((1111, "alice"), (2222, "bob"), (3333, "carol")):
+                u = User.signup(name, f"{name}@test.com", "password", None)
+                u.id = uid
+            db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def participant(self, conversation_id, user_id):
+        with app.app_context():
+            return db.session.get(ConversationParticipant, (conversation_id, user_id))
+
+    def test_send_threads_and_counts_unread(self):
+        with self.client as c:
+            self.login(c, 2222)
+            c.post("/dm/send/1111", data={"text": "hi alice"})
+            c.post("/dm/send/1111", data={"text": "you there?"})
+            self.login(c, 3333)
+            c.post("/dm/send/1111", data={"text": "hello from carol"})
+
+            with app.app_context():
+                self.assertEqual(Conversation.query.count(), 2)
+                bob_thread = conversations.find(1111, 2222).id
+                self.assertEqual(conversations.unread_total(1111), 3)
+
+            self.assertEqual(self.participant(bob_thread, 1111).unread_count, 2)
+            self.assertEqual(self.participant(bob_thread, 2222).unread_count, 0)
+
+            self.login(c, 1111)
+            html = c.get("/dm/inbox").get_data(as_text=True)
+            self.assertLess(html.index("@carol"), html.index("@bob"))
+            self.assertIn("2 unread", html)
+
+            html = c.get("/dm/with/2222").get_data(as_text=True)
+            self.assertIn("you there?", html)
+            self.assertNotIn("hello from carol", html)
+
+            alice = self.participant(bob_thread, 1111)
+            self.assertEqual(alice.unread_count, 0)
+            with app.app_context():
+                newest = db.session.query(db.func.max(DirectMessage.id)).filter_by(
+                    conversation_id=bob_thread).scalar()
+            self.assertEqual(alice.last_read_message_id, newest)
+
+            resp = c.post("/dm/reply/2222", data={"text": "yes!"})
+            self.assertEqual(resp.location, "/dm/with/2222")
+            self.assertEqual(self.participant(bob_thread, 2222).unread_count, 1)
+
+            # the inbox now lists bob's thread first
+            html = c.get("/dm/inbox").get_data(as_text=True)
+            self.assertLess(html.index("@bob"), html.index("@carol"))
+
+    def test_migration_threads_existing_messages(self):
+        with app.app_context():
+            db.session.remove()
+            with db.engine.begin() as conn:
+                migrations._record(conn, [m for m in migrations.MIGRATIONS if m[0] < 5])
+                conn.execute(text("DROP TABLE conversation_participants"))
+                conn.execute(text("ALTER TABLE direct_messages DROP COLUMN conversation_id"))
+                conn.execute(text("DROP TABLE conversations"))
+                conn.execute(text(
+                    "INSERT INTO direct_messages (sender_id, recipient_id, text, timestamp) VALUES "
+                    "(2222, 1111, 'one', '2020-01-01'), (1111, 2222, 'two', '2020-01-02'), "
+                    "(3333, 1111, 'three', '2020-01-03')"))
+
+            self.assertEqual(migrations.upgrade(), [5])
+
+            self.assertEqual(Conversation.query.count(), 2)
+            self.assertEqual(DirectMessage.query.filter_by(conversation_id=None).count(), 0)
+            thread = conversations.find(2222, 1111)
+            self.assertEqual(DirectMessage.query.filter_by(conversation_id=thread.id).count(), 2)
+            self.assertEqual(ConversationParticipant.query.filter_by(user_id=1111).count(), 2)
+            self.assertEqual(conversations.unread_total(1111), 0)
+
+            db.session.remove()
+            with db.engine.begin() as conn:
+                migrations.add_conversations(conn)
+            self.assertEqual(Conversation.query.count(), 2)
+            self.assertEqual(ConversationParticipant.query.count(), 4)
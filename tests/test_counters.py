@@ -0,0 +1,107 @@
+import os
+from unittest import TestCase
+from sqlalchemy import text
+from models import db, User, Message, Follows, Likes
+from app import app, CURR_USER_KEY
+import counters
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class CountersTestCase(TestCase):
+    """Test maintained per-user counters."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            self.client = app.test_client()
+
+            u1 = User.signup("alice", "alice@test.com", "password", None)
+            u1.id = 1111
+            u2 = User.signup("bob", "bob@test.com", "password", None)
+            u2.id = 2222
+            db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def counts(self, user_id):
+        with app.app_context():
+            u = db.session.get(User, user_id)
+            return (u.messages_count, u.following_count, u.followers_count, u.likes_count)
+
+    def test_views_maintain_counters(self):
+        with self.client as c:
+            self.login(c, 2222)
+            c.post("/messages/new", data={"text": "bob's post"})
+            self.assertEqual(self.counts(2222), (1, 0, 0, 0))
+
+            self.login(c, 1111)
+            c.post("/users/follow/2222")
+            with app.app_context():
+                msg_id = Message.query.one().id
+            c.post(f"/messages/{msg_id}/like")
+
+            self.assertEqual(self.counts(1111), (0, 1, 0, 1))
+            self.assertEqual(self.counts(2222), (1, 0, 1, 0))
+
+            c.post(f"/messages/{msg_id}/like")
+            c.post("/users/stop-following/2222")
+            self.assertEqual(self.counts(1111), (0, 0, 0, 0))
+            self.assertEqual(self.counts(2222), (1, 0, 0, 0))
+
+    def test_delete_paths(self):
+        with app.app_context():
+            msg = Message(text="bob's post", user_id=2222)
+            db.session.add(msg)
+            db.session.add(Follows(user_being_followed_id=2222, user_following_id=1111))
+            db.session.flush()
+            db.session.add(Likes(user_id=1111, message_id=msg.id))
+            counters.recount()
+            db.session.commit()
+            msg_id = msg.id
+
+        self.assertEqual(self.counts(1111), (0, 1, 0, 1))
+
+        with self.client as c:
+            self.login(c, 2222)
+            c.post(f"/messages/{msg_id}/delete")
+            self.assertEqual(self.counts(1111), (0, 1, 0, 0))
+            self.assertEqual(self.counts(2222), (0, 0, 1, 0))
+
+            c.post("/users/delete")
+            self.assertEqual(self.counts(1111), (0, 0, 0, 0))
+
+    def test_repair_command(self):
+        with app.app_context():
+            db.session.add(Message(text="uncounted", user_id=1111))
+            db.session.commit()
+
+        self.assertEqual(self.counts(1111)[0], 0)
+
+        result = app.test_cli_runner().invoke(args=["counters", "repair"])
+        self.assertIn("Recounted 2 users", result.output)
+        self.assertEqual(self.counts(1111)[0], 1)
+
+    def test_add_columns_to_existing_table(self):
+        with app.app_context():
+            db.session.add(Message(text="before counters", user_id=1111))
+            db.session.commit()
+            db.session.remove()
+
+            with db.engine.begin() as conn:
+                for column in counters.COLUMNS:
+                    conn.execute(text(f"ALTER TABLE users DROP COLUMN {column}"))
+
+        result = app.test_cli_runner().invoke(args=["counters", "add-columns"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(self.counts(1111), (1, 0, 0, 0))
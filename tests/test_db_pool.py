@@ -0,0 +1,130 @@
+import os
+import time
+from unittest import TestCase
+from unittest.mock import patch
+import flask
+from sqlalchemy import create_engine, exc, update
+from models import db, User
+from app import app
+import app as warbler
+import db_pool
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class DbPoolTestCase(TestCase):
+    """Test pool configuration, pool metrics and replica routing."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            User.signup("user1", "user1@test.com", "password", None)
+            db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_engine_options(self):
+        config = {'DB_POOL_SIZE': 3, 'DB_STATEMENT_TIMEOUT': 500,
+                  'SQLALCHEMY_ENGINE_OPTIONS': {'max_overflow': 0}}
+
+        options = db_pool.engine_options(config, "postgresql:///warbler")
+        self.assertIs(options['poolclass'], db_pool.InstrumentedPool)
+        self.assertEqual((options['pool_size'], options['max_overflow']), (3, 0))
+        self.assertEqual(options['connect_args'], {'options': "-c statement_timeout=500"})
+
+        self.assertEqual(db_pool.engine_options(config, "sqlite://"), {'max_overflow': 0})
+
+    def test_async_engine_options(self):
+        config = {'DB_POOL_SIZE': 3, 'DB_STATEMENT_TIMEOUT': 500,
+                  'SQLALCHEMY_ENGINE_OPTIONS': {'max_overflow': 0,
+                                                'poolclass': db_pool.InstrumentedPool,
+                                                'connect_args': {'options': "-c x=1"}}}
+
+        options = db_pool.async_engine_options(config, "postgresql+asyncpg:///warbler")
+        self.assertIs(options['poolclass'], db_pool.InstrumentedAsyncPool)
+        self.assertEqual((options['pool_size'], options['max_overflow']), (3, 0))
+        self.assertEqual(options['pool_logging_name'], db_pool.ASYNC)
+        self.assertEqual(options['connect_args'],
+                         {'server_settings': {'statement_timeout': "500"}})
+
+    def test_async_engine_is_instrumented(self):
+        engine = warbler.async_database.engine
+        self.assertIsInstance(engine.pool, db_pool.InstrumentedAsyncPool)
+        self.assertEqual(engine.pool.size(), app.config['DB_POOL_SIZE'])
+        self.assertIn(({'pool': db_pool.ASYNC}, {'value': 0}), db_pool.POOL_CHECKED_OUT.samples())
+
+    def test_app_engine_is_instrumented(self):
+        with app.app_context():
+            self.assertIsInstance(db.engine.pool, db_pool.InstrumentedPool)
+
+        checkouts = db_pool.CHECKOUT_SECONDS.labels(pool='primary')
+        before = checkouts.count
+        self.client.get("/users")
+        self.assertGreater(checkouts.count, before)
+
+        [(_, in_use)] = [sample for sample in db_pool.POOL_CHECKED_OUT.samples()
+                         if sample[0] == {'pool': 'primary'}]
+        self.assertEqual(in_use, {'value': 0})
+
+    def test_timeouts_are_counted(self):
+        engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'],
+                               poolclass=db_pool.InstrumentedPool, pool_size=1,
+                               max_overflow=0, pool_timeout=0.01, pool_logging_name='test')
+        timeouts = db_pool.CHECKOUT_TIMEOUTS.labels(pool='test')
+        before = timeouts.value
+
+        with engine.connect():
+            with self.assertRaises(exc.TimeoutError):
+                engine.connect()
+        engine.dispose()
+
+        self.assertEqual(timeouts.value, before + 1)
+
+    def test_read_only_views_use_the_replica(self):
+        with app.app_context():
+            engines = db.engines
+            replica = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+            engines[db_pool.REPLICA] = replica
+            try:
+                with app.test_request_context("/users"):
+                    self.assertIs(db.session.get_bind(User), replica)
+                with app.test_request_context("/users/delete", method="POST"):
+                    self.assertIs(db.session.get_bind(User), db.engine)
+            finally:
+                del engines[db_pool.REPLICA]
+                replica.dispose()
+
+    def test_writers_and_cache_fills_use_the_primary(self):
+        with app.app_context():
+            engines = db.engines
+            replica = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+            engines[db_pool.REPLICA] = replica
+            try:
+                with patch.dict(app.config, DATABASE_REPLICA_URL="postgresql:///replica"):
+                    with app.test_request_context("/users"):
+                        with db_pool.primary():
+                            self.assertIs(db.session.get_bind(User), db.engine)
+
+                    # a request that commits a write pins its client...
+                    with app.test_request_context("/users/profile", method="POST"):
+                        db.session.execute(update(User).values(bio="new"))
+                        db.session.commit()
+                        pinned = flask.session[db_pool.PRIMARY_UNTIL_KEY]
+                    self.assertGreater(pinned, time.time())
+
+                    # ...so the page it redirects to reads from the primary
+                    with app.test_request_context("/users"):
+                        flask.session[db_pool.PRIMARY_UNTIL_KEY] = pinned
+                        self.assertIs(db.session.get_bind(User), db.engine)
+                    with app.test_request_context("/users"):
+                        flask.session[db_pool.PRIMARY_UNTIL_KEY] = time.time() - 1
+                        self.assertIs(db.session.get_bind(User), replica)
+            finally:
+                del engines[db_pool.REPLICA]
+                replica.dispose()
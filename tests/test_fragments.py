@@ -0,0 +1,45 @@
+from unittest import TestCase
+from jinja2 import Environment
+from fragments import FragmentCache, FragmentCacheExtension
+
+class FragmentCacheTestCase(TestCase):
+    """Test the {% cache %} tag and invalidation."""
+
+    def setUp(self):
+        self.env = Environment(extensions=[FragmentCacheExtension])
+        self.env.fragment_cache = FragmentCache(maxsize=10, ttl=60)
+        self.template = self.env.from_string(
+            "{% cache 'message', id, 'user', author %}{{ render() }}{% endcache %}")
+        self.renders = 0
+
+    def render(self, **context):
+        def render():
+            self.renders += 1
+            return f"#{self.renders}"
+        return self.template.render(render=render, **context)
+
+    def test_renders_once_per_key(self):
+        self.assertEqual(self.render(id=1, author=5), "#1")
+        self.assertEqual(self.render(id=1, author=5), "#1")
+        self.assertEqual(self.render(id=2, author=5), "#2")
+
+    def test_invalidate_by_any_entity(self):
+        self.render(id=1, author=5)
+        self.render(id=2, author=6)
+
+        self.env.fragment_cache.invalidate('user', 5)
+        self.assertEqual(self.render(id=1, author=5), "#3")
+        self.assertEqual(self.render(id=2, author=6), "#2")
+
+        self.env.fragment_cache.invalidate('message', 2)
+        self.assertEqual(self.render(id=2, author=6), "#4")
+
+    def test_blocks_with_the_same_arguments_are_separate(self):
+        template = self.env.from_string(
+            "{% cache 'user', 1 %}a{% endcache %}\n{% cache 'user', 1 %}b{% endcache %}")
+        self.assertEqual(template.render(), "a\nb")
+
+    def test_size_is_bounded(self):
+        for i in range(20):
+            self.render(id=i, author=0)
+        self.assertEqual(len(self.env.fragment_cache), 10)
@@ -0,0 +1,91 @@
+import os
+from unittest import TestCase
+from models import db, User, Message
+from app import app, CURR_USER_KEY, user_loader, block_list
+import counters
+import http_cache
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class HttpCacheTestCase(TestCase):
+    """Test cache policies, ETags and versioned static URLs."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            for i in (1, 2):
+                user = User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                user.id = i
+            db.session.flush()
+            msg = Message(text="hello", user_id=2)
+            db.session.add(msg)
+            db.session.commit()
+            self.message_id = msg.id
+
+        user_loader.cache.clear()
+        block_list.cache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def test_versioned_static_is_immutable(self):
+        with app.test_request_context():
+            url = http_cache.static_url('js/likes.js')
+        self.assertIn("?v=", url)
+
+        resp = self.client.get(url)
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+
+        resp = self.client.get("/static/js/likes.js?v=stale")
+        self.assertNotIn("immutable", resp.headers["Cache-Control"])
+
+    def test_profile_not_modified_until_viewer_changes(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/users/2")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("private", resp.headers["Cache-Control"])
+            etag = resp.headers["ETag"]
+            self.assertTrue(etag.startswith('W/'))
+
+            resp = c.get("/users/2", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            with app.app_context():
+                counters.follow(1, 2)
+                db.session.commit()
+
+            resp = c.get("/users/2", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_message_etag_differs_by_viewer(self):
+        url = f"/messages/{self.message_id}"
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.headers["Cache-Control"], "no-cache")
+        anonymous = resp.headers["ETag"]
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get(url, headers={"If-None-Match": anonymous})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], anonymous)
+
+    def test_direct_messages_are_not_stored(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/dm/inbox")
+        self.assertEqual(resp.headers["Cache-Control"], "private, no-store")
@@ -0,0 +1,144 @@
+import os
+from unittest import TestCase
+from sqlalchemy import event
+from models import db, User
+from app import app, CURR_USER_KEY, CURR_USER_SNAPSHOT_KEY, user_loader
+import identity
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class IdentityTestCase(TestCase):
+    """Test the cached current-user loader."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            self.client = app.test_client()
+
+            u = User.signup("cached", "cached@test.com", "password", None)
+            u.id = 1111
+            db.session.commit()
+
+        user_loader.cache.clear()
+        user_loader.changed_at.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def count_queries(self, fn):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                result = fn()
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+
+        return result, statements
+
+    def test_second_load_is_cached(self):
+        loader = identity.SnapshotUserLoader()
+
+        first, statements = self.count_queries(lambda: loader(1111))
+        self.assertTrue(first.is_hydrated)
+        self.assertEqual(len(statements), 1)
+
+        second, statements = self.count_queries(lambda: (loader(1111), loader(1111).username)[0])
+        self.assertFalse(second.is_hydrated)
+        self.assertEqual(statements, [])
+
+    def test_session_snapshot_is_used(self):
+        loader = identity.SnapshotUserLoader()
+
+        with app.app_context():
+            data = identity.snapshot(db.session.get(User, 1111))
+
+        user, statements = self.count_queries(lambda: loader(1111, data))
+        self.assertEqual(user.username, "cached")
+        self.assertEqual(statements, [])
+
+        # a snapshot for someone else is ignored
+        data['id'] = 2222
+        loader = identity.SnapshotUserLoader()
+        user, statements = self.count_queries(lambda: loader(1111, data).id)
+        self.assertEqual(user, 1111)
+        self.assertEqual(len(statements), 1)
+
+    def test_relationships_hydrate(self):
+        loader = identity.SnapshotUserLoader()
+
+        with app.app_context():
+            loader(1111)
+            user = loader(1111)
+            self.assertEqual(user.following, [])
+            self.assertTrue(user.is_hydrated)
+            self.assertEqual(user.email, "cached@test.com")
+
+    def test_profile_edit_invalidates(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1111
+
+            self.assertIn('alt="cached"', c.get("/users/1111").get_data(as_text=True))
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "cached@test.com",
+                                           "password": "password"})
+
+            with c.session_transaction() as sess:
+                self.assertEqual(sess[CURR_USER_SNAPSHOT_KEY]['username'], "renamed")
+
+            self.assertIn('alt="renamed"', c.get("/users/1111").get_data(as_text=True))
+
+    def test_stale_cookie_snapshot_is_rejected(self):
+        loader = identity.SnapshotUserLoader()
+
+        with app.app_context():
+            user = db.session.get(User, 1111)
+            old = identity.snapshot(user)
+            user.username = "renamed"
+            db.session.commit()
+            loader.remember(user)
+
+        loader.cache.clear()
+        user, statements = self.count_queries(lambda: loader(1111, old).username)
+        self.assertEqual(user, "renamed")
+        self.assertEqual(len(statements), 1)
+
+    def test_deleted_user_is_logged_out(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1111
+            c.get("/users/1111")
+
+            with app.app_context():
+                db.session.execute(db.delete(User).where(User.id == 1111))
+                db.session.commit()
+
+            resp = c.get("/", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Sign up", resp.get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+                self.assertNotIn(CURR_USER_SNAPSHOT_KEY, sess)
+
+    def test_predicates_do_not_hydrate(self):
+        loader = identity.SnapshotUserLoader()
+
+        with app.app_context():
+            loader(1111)
+            user = loader(1111)
+            self.assertFalse(user.is_following(user))
+            self.assertEqual(user.following_among([1111]), set())
+            self.assertFalse(user.is_hydrated)
@@ -0,0 +1,85 @@
+import os
+from unittest import TestCase
+from models import db, User, Message, Likes
+from app import app, CURR_USER_KEY
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+JSON = {"Accept": "application/json"}
+
+class LikesTestCase(TestCase):
+    """Test the like/unlike endpoint."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            self.client = app.test_client()
+
+            u1 = User.signup("liker", "liker@test.com", "password", None)
+            u1.id = 1111
+            u2 = User.signup("author", "author@test.com", "password", None)
+            u2.id = 2222
+            db.session.flush()
+            msg = Message(text="like me", user_id=2222)
+            db.session.add(msg)
+            db.session.commit()
+            self.msg_id = msg.id
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def likes_count(self):
+        with app.app_context():
+            return db.session.get(User, 1111).likes_count
+
+    def test_toggle_returns_json_state(self):
+        url = f"/messages/{self.msg_id}/like"
+        with self.client as c:
+            self.login(c, 1111)
+
+            resp = c.post(url, headers=JSON)
+            self.assertEqual(resp.json, {"message_id": self.msg_id, "liked": True, "count": 1})
+
+            resp = c.post(url, headers=JSON)
+            self.assertEqual(resp.json, {"message_id": self.msg_id, "liked": False, "count": 0})
+            self.assertEqual(self.likes_count(), 0)
+
+    def test_put_and_delete_are_idempotent(self):
+        url = f"/messages/{self.msg_id}/like"
+        with self.client as c:
+            self.login(c, 1111)
+
+            for _ in range(2):
+                self.assertEqual(c.put(url, headers=JSON).json["count"], 1)
+            self.assertEqual(self.likes_count(), 1)
+            with app.app_context():
+                self.assertEqual(Likes.query.count(), 1)
+
+            for _ in range(2):
+                self.assertFalse(c.delete(url, headers=JSON).json["liked"])
+            self.assertEqual(self.likes_count(), 0)
+
+    def test_form_post_still_redirects(self):
+        with self.client as c:
+            self.login(c, 1111)
+            resp = c.post(f"/messages/{self.msg_id}/like")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(self.likes_count(), 1)
+
+    def test_unauthorized(self):
+        resp = self.client.post(f"/messages/{self.msg_id}/like", headers=JSON)
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client as c:
+            self.login(c, 2222)
+            self.assertEqual(c.post(f"/messages/{self.msg_id}/like", headers=JSON).status_code, 403)
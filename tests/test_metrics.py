@@ -0,0 +1,155 @@
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from models import db, User
+from app import app, CURR_USER_KEY, user_loader, block_list
+import metrics
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class MetricsTestCase(TestCase):
+    """Test the metrics registry and the /metrics endpoint."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            user = User.signup("measured", "measured@test.com", "password", None)
+            user.id = 1
+            db.session.commit()
+
+        user_loader.cache.clear()
+        block_list.cache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_endpoint(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            c.get("/users/1")
+            c.get("/users/1")
+            c.get("/no-such-page")
+
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain; version=0.0.4"))
+
+        text = resp.get_data(as_text=True)
+        self.assertIn("# TYPE http_request_duration_seconds histogram", text)
+        self.assertRegex(text, r'http_request_duration_seconds_count\{endpoint="users_show",'
+                               r'method="GET",status="200"\} [1-9]')
+        self.assertIn('endpoint="none",method="GET",status="404"', text)
+        self.assertIn("http_requests_in_flight 1", text)
+        self.assertIn('cache_hits_total{cache="user_snapshots"}', text)
+        self.assertIn('db_pool_checked_out{pool="primary"}', text)
+        self.assertIn('password_bcrypt_seconds_count{op="hash"}', text)
+
+    def test_token(self):
+        remote = {'REMOTE_ADDR': "10.0.0.5"}
+        with patch.dict(app.config, METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            resp = self.client.get("/metrics", headers={'Authorization': "Bearer s3cret"},
+                                   environ_base=remote)
+            self.assertEqual(resp.status_code, 200)
+
+    def test_only_this_host_without_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+        self.assertEqual(self.client.get("/metrics", environ_base={'REMOTE_ADDR': "10.0.0.5"}
+                                         ).status_code, 403)
+        # a proxy on this host passing the outside world's requests on
+        self.assertEqual(self.client.get("/metrics", headers={'X-Forwarded-For': "203.0.113.9"}
+                                         ).status_code, 403)
+
+    def test_multiprocess(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with patch.dict(app.config, METRICS_DIR=directory):
+                resp = self.client.get("/metrics")
+            [name] = [name for name in os.listdir(directory) if name.endswith('.json')]
+            self.assertRegex(name, rf"^{os.getpid()}-\d+\.json$")
+        self.assertIn("http_request_duration_seconds_bucket", resp.get_data(as_text=True))
+
+    def test_exited_processes_folded(self):
+        def exited(directory, name, requests):
+            with open(os.path.join(directory, name), 'w') as f:
+                json.dump({
+                    'test_folded_total': {'kind': 'counter', 'help': "Folded.",
+                                          'samples': [({}, {'value': requests})]},
+                    'test_folded_gauge': {'kind': 'gauge', 'help': "Gone.",
+                                          'samples': [({}, {'value': 1})]},
+                }, f)
+
+        def total(directory):
+            merged = metrics.merge(metrics.read_snapshots(directory))
+            return merged['test_folded_total']['samples'][0][1]['value']
+
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.write_snapshot(directory)
+            # this pid, but an earlier process's start: the pid was reused
+            exited(directory, f"{os.getpid()}-0.json", 2)
+            exited(directory, "4194305-1.json", 3)
+            self.assertEqual(total(directory), 5)
+
+            self.assertEqual(metrics.fold_exited(directory), 2)
+            self.assertEqual(total(directory), 5)
+            names = {name for name in os.listdir(directory) if name.endswith('.json')}
+            self.assertEqual(names, {metrics.EXITED, metrics._file_name()})
+
+            exited(directory, "4194305-2.json", 4)
+            metrics.fold_exited(directory)
+            self.assertEqual(total(directory), 9)
+            merged = metrics.merge(metrics.read_snapshots(directory))
+            self.assertNotIn('test_folded_gauge', merged)
+
+    def test_merge(self):
+        def process(requests, in_flight):
+            return {
+                'requests_total': {'kind': 'counter', 'help': "Requests.",
+                                   'samples': [({'code': '200'}, {'value': requests})]},
+                'in_flight': {'kind': 'gauge', 'help': "In flight.",
+                              'samples': [({}, {'value': in_flight})]},
+                'seconds': {'kind': 'histogram', 'help': "Seconds.",
+                            'samples': [({}, {'buckets': [[1, requests], [float('inf'), requests]],
+                                              'sum': 0.5 * requests, 'count': requests})]},
+            }
+
+        merged = metrics.merge([(process(2, 1), True), (process(3, 1), True),
+                                (process(5, 9), False)])
+        self.assertEqual(merged['requests_total']['samples'], [({'code': '200'}, {'value': 10})])
+        # exited processes' gauges are dropped
+        self.assertEqual(merged['in_flight']['samples'], [({}, {'value': 2})])
+        [(_, seconds)] = merged['seconds']['samples']
+        self.assertEqual((seconds['count'], seconds['sum']), (10, 5.0))
+        self.assertEqual(seconds['buckets'][-1], (float('inf'), 10))
+
+        text = metrics.exposition(merged)
+        self.assertIn('requests_total{code="200"} 10', text)
+        self.assertIn('seconds_bucket{le="+Inf"} 10', text)
+
+    def test_counters_from_many_threads(self):
+        counter = metrics.Counter('test_threads_total', "Increments.")
+        histogram = metrics.Histogram('test_threads_seconds', "Observations.")
+
+        def work():
+            for _ in range(1000):
+                counter.inc()
+                histogram.observe(0.01)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(counter.value, 8000)
+        self.assertEqual(histogram.count, 8000)
+        self.assertEqual(histogram.counts[1], 8000)
@@ -0,0 +1,76 @@
+import os
+from unittest import TestCase
+from sqlalchemy import text, inspect
+from models import db, User, Message, Likes
+from app import app
+import migrations
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+class MigrationsTestCase(TestCase):
+    """Test schema migrations and index checks."""
+
+    def setUp(self):
+        """Create a database at the newest schema version."""
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            with db.engine.begin() as conn:
+                migrations._record(conn, migrations.MIGRATIONS)
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_up_to_date(self):
+        with app.app_context():
+            self.assertEqual(migrations.upgrade(), [])
+            with db.engine.connect() as conn:
+                self.assertEqual(migrations.current_version(conn), migrations.head())
+
+    def test_upgrade_legacy_schema(self):
+        """Roll the schema back to version 1 by hand, then upgrade it."""
+        with app.app_context():
+            u = User.signup("legacy", "legacy@test.com", "password", None)
+            db.session.add(Message(id=10, text="old", user=u))
+            db.session.commit()
+            uid = u.id
+            db.session.remove()
+
+            with db.engine.begin() as conn:
+                conn.execute(text("DELETE FROM schema_version WHERE version >= 2"))
+                conn.execute(text("DROP INDEX ix_likes_user_message"))
+                conn.execute(text("DROP INDEX ix_messages_user_id_timestamp"))
+                for column in ('messages_count', 'following_count', 'followers_count', 'likes_count'):
+                    conn.execute(text(f"ALTER TABLE users DROP COLUMN {column}"))
+                conn.execute(text(
+                    f"INSERT INTO likes (user_id, message_id) VALUES ({uid}, 10), ({uid}, 10)"))
+
+            self.assertEqual(migrations.upgrade(), [2, 3, 4, 5])
+
+            columns = {c['name'] for c in inspect(db.engine).get_columns('users')}
+            self.assertIn('messages_count', columns)
+            self.assertEqual(Likes.query.count(), 1)
+            user = db.session.get(User, uid)
+            self.assertEqual(user.messages_count, 1)
+            self.assertEqual(user.likes_count, 1)
+
+            results = {r[1]: r[2] for r in migrations.check_indexes()}
+            self.assertTrue(results['ix_messages_user_id_timestamp'])
+
+    def test_routes_use_indexes(self):
+        with app.app_context():
+            for route, index, used, plan in migrations.check_indexes():
+                self.assertTrue(used, f"{route} does not use {index}:\n{plan}")
+
+    def test_check_indexes_command(self):
+        result = app.test_cli_runner().invoke(args=["db", "check-indexes"])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+    def test_upgrade_empty_database(self):
+        with app.app_context():
+            db.drop_all()
+            self.assertEqual(migrations.upgrade(), [])
+            self.assertTrue(inspect(db.engine).has_table('timeline_entries'))
+            self.assertEqual(migrations.warn_if_behind(), migrations.head())
@@ -0,0 +1,86 @@
+import os
+import re
+from datetime import datetime
+from unittest import TestCase
+from models import db, User, Message
+from app import app, CURR_USER_KEY
+import conversations
+from pagination import encode_cursor, decode_cursor
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class PaginationTestCase(TestCase):
+    """Test keyset pagination of feeds."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            self.client = app.test_client()
+
+            u1 = User.signup("paged", "paged@test.com", "password", None)
+            u1.id = 1111
+            u2 = User.signup("other", "other@test.com", "password", None)
+            u2.id = 2222
+            db.session.commit()
+
+            # two messages share a timestamp so ties are broken by id
+            same = datetime(2020, 1, 1)
+            for n in range(5):
+                db.session.add(Message(id=100 + n, text=f"post-{n}", user_id=1111,
+                                       timestamp=same if n < 2 else datetime(2020, 1, 1 + n)))
+                conversations.send(2222, 1111, f"dm-{n}", timestamp=datetime(2021, 1, 1 + n))
+            db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_cursor_round_trip(self):
+        ts = datetime(2024, 5, 6, 7, 8, 9, 123456)
+        self.assertEqual(decode_cursor(encode_cursor(ts, 42)), (ts, 42))
+
+        with self.assertRaises(ValueError):
+            decode_cursor("not-a-cursor")
+
+    def test_profile_pages(self):
+        with self.client as c:
+            seen = []
+            url = "/users/1111?limit=2"
+
+            while url:
+                html = c.get(url).get_data(as_text=True)
+                seen += re.findall(r"post-\d", html)
+                older = re.search(r'href="([^"]*before=[^"]*)"', html)
+                url = older and older.group(1).replace("&amp;", "&")
+
+            self.assertEqual(seen, ["post-4", "post-3", "post-2", "post-1", "post-0"])
+
+    def test_newer_cursor_walks_back(self):
+        with self.client as c:
+            html = c.get("/users/1111?limit=2").get_data(as_text=True)
+            older = re.search(r'href="([^"]*before=[^"]*)"', html).group(1)
+
+            html = c.get(older.replace("&amp;", "&")).get_data(as_text=True)
+            newer = re.search(r'href="([^"]*after=[^"]*)"', html).group(1)
+
+            html = c.get(newer.replace("&amp;", "&")).get_data(as_text=True)
+            self.assertEqual(re.findall(r"post-\d", html), ["post-4", "post-3"])
+
+    def test_bad_cursor(self):
+        with self.client as c:
+            resp = c.get("/users/1111?before=garbage")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_conversation_is_paged(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1111
+
+            html = c.get("/dm/with/2222?limit=3").get_data(as_text=True)
+            self.assertEqual(re.findall(r"dm-\d", html), ["dm-4", "dm-3", "dm-2"])
+            self.assertIn("before=", html)
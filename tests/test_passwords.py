@@ -0,0 +1,113 @@
+import os
+from unittest import TestCase, mock
+from models import db, User
+from app import app
+import passwords
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class PasswordHasherTestCase(TestCase):
+    """Test the pooled bcrypt hasher."""
+
+    def test_hash_and_check_on_pool(self):
+        hasher = passwords.PasswordHasher(rounds=4, workers=1)
+        try:
+            hashed = hasher.hash("secret")
+            self.assertTrue(hashed.startswith("$2b$04$"))
+            self.assertTrue(hasher.check(hashed, "secret"))
+            self.assertFalse(hasher.check(hashed, "wrong"))
+            self.assertFalse(hasher.check("not a hash", "secret"))
+        finally:
+            hasher.shutdown()
+
+    def test_full_queue_is_rejected(self):
+        hasher = passwords.PasswordHasher(rounds=4, workers=0, max_pending=1)
+        rejected = passwords.REJECTED.value
+
+        self.assertTrue(hasher._slots.acquire(blocking=False))
+        with self.assertRaises(passwords.HasherBusy):
+            hasher.hash("secret")
+        self.assertEqual(passwords.REJECTED.value, rejected + 1)
+
+        hasher._slots.release()
+        self.assertTrue(hasher.hash("secret"))
+
+    def test_timed_out_work_keeps_its_slot(self):
+        hasher = passwords.PasswordHasher(rounds=14, workers=1, max_pending=1, timeout=30)
+        try:
+            # start the worker process, so the slow hash goes straight to it
+            hasher.check(passwords._hash("x", 4), "x")
+            hasher.timeout = 0.1
+
+            with self.assertRaises(passwords.HasherBusy):
+                hasher.hash("slow")
+
+            # still being hashed: the next caller is turned away, not queued
+            rejected = passwords.REJECTED.value
+            with self.assertRaises(passwords.HasherBusy):
+                hasher.hash("another")
+            self.assertEqual(passwords.REJECTED.value, rejected + 1)
+            self.assertEqual(len(hasher._pool._pending_work_items), 1)
+
+            # and the slot comes back once the pool finishes
+            self.assertTrue(hasher._slots.acquire(timeout=30))
+            hasher._slots.release()
+        finally:
+            hasher.shutdown()
+
+    def test_latency_is_recorded(self):
+        hasher = passwords.PasswordHasher(rounds=4, workers=0)
+        checks = passwords.LATENCY.labels(op='check')
+        before = checks.count
+
+        hasher.check(hasher.hash("secret"), "secret")
+        self.assertEqual(checks.count, before + 1)
+
+    def test_needs_rehash(self):
+        hasher = passwords.PasswordHasher(rounds=5, workers=0)
+        self.assertTrue(hasher.needs_rehash(passwords._hash("x", 4)))
+        self.assertFalse(hasher.needs_rehash(passwords._hash("x", 5)))
+
+
+class RehashOnLoginTestCase(TestCase):
+    """Test that logging in upgrades hashes made at an old cost."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.add(User(username="legacy", email="legacy@test.com",
+                                password=passwords._hash("password", 4)))
+            db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def stored_hash(self):
+        with app.app_context():
+            return User.query.filter_by(username="legacy").one().password
+
+    def test_login_rehashes(self):
+        hasher = passwords.PasswordHasher(rounds=5, workers=0)
+        with mock.patch.object(passwords, "hasher", hasher):
+            resp = self.client.post("/login", data={"username": "legacy", "password": "nope"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(self.stored_hash().startswith("$2b$04$"))
+
+            resp = self.client.post("/login", data={"username": "legacy", "password": "password"})
+            self.assertEqual(resp.status_code, 302)
+
+        hashed = self.stored_hash()
+        self.assertTrue(hashed.startswith("$2b$05$"))
+        self.assertTrue(hasher.check(hashed, "password"))
+
+    def test_busy_hasher_returns_503(self):
+        with mock.patch.object(passwords.hasher, "_run", side_effect=passwords.HasherBusy):
+            resp = self.client.post("/login", data={"username": "legacy", "password": "password"})
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "5")
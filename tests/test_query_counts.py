@@ -0,0 +1,132 @@
+import os
+from contextlib import contextmanager
+from unittest import TestCase
+from sqlalchemy import event
+from bs4 import BeautifulSoup
+from models import db, User, Message, Likes, Follows
+from app import app, CURR_USER_KEY, user_loader, block_list
+import conversations
+import timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+AUTHORS = 10
+
+# Most statements a route may issue, however many rows it renders. A route
+# that lazy-loads per row blows through these as soon as it shows a page.
+ROUTE_BUDGETS = {
+    "/": 4,
+    "/users/100": 5,
+    "/users/1/likes": 5,
+    "/messages/{message_id}": 4,
+    "/dm/inbox": 3,
+    "/dm/sent": 3,
+    "/dm/with/100": 6,
+}
+
+
+class QueryCountTestCase(TestCase):
+    """Guard feed routes against N+1 queries."""
+
+    def setUp(self):
+        """Create a reader who follows, likes and messages many authors."""
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            self.client = app.test_client()
+
+            reader = User.signup("reader", "reader@test.com", "password", None)
+            reader.id = 1
+            for i in range(AUTHORS):
+                author = User.signup(f"author{i}", f"author{i}@test.com", "password", None)
+                author.id = 100 + i
+                db.session.flush()
+                db.session.add(Follows(user_being_followed_id=author.id, user_following_id=1))
+                msg = Message(text=f"post {i}", user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Likes(user_id=1, message_id=msg.id))
+                conversations.send(author.id, 1, "hi")
+                conversations.send(1, author.id, "hey")
+            db.session.add(Message(text="my own post", user_id=1))
+            db.session.flush()
+            timeline.backfill(1)
+            db.session.commit()
+
+            self.message_id = Message.query.filter_by(user_id=100).one().id
+
+        user_loader.cache.clear()
+        block_list.cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    @contextmanager
+    def count_queries(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+
+    def test_routes_stay_within_query_budget(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            for route, budget in ROUTE_BUDGETS.items():
+                url = route.format(message_id=self.message_id)
+                with self.subTest(url=url), self.count_queries() as statements:
+                    resp = c.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertLessEqual(
+                        len(statements), budget,
+                        f"{url} ran {len(statements)} queries:\n" + "\n\n".join(statements))
+
+    def test_home_renders_every_author(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            html = c.get("/").get_data(as_text=True)
+            for i in range(AUTHORS):
+                self.assertIn(f"@author{i}", html)
+
+    def like_buttons(self, c, url):
+        soup = BeautifulSoup(c.get(url).get_data(as_text=True), 'html.parser')
+        return {form['action']: 'btn-primary' in form.button['class']
+                for form in soup.select('form.messages-like')}
+
+    def test_like_buttons_show_liked_state(self):
+        with app.app_context():
+            Likes.query.filter_by(message_id=self.message_id).delete()
+            db.session.commit()
+
+        action = f"/messages/{self.message_id}/like"
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            home = self.like_buttons(c, "/")
+            self.assertEqual(len(home), AUTHORS)
+            self.assertEqual(sum(home.values()), AUTHORS - 1)
+            self.assertFalse(home[action])
+
+            self.assertEqual(self.like_buttons(c, "/users/100"), {action: False})
+            self.assertEqual(self.like_buttons(c, f"/messages/{self.message_id}"), {action: False})
+
+            likes = self.like_buttons(c, "/users/1/likes")
+            self.assertEqual(len(likes), AUTHORS - 1)
+            self.assertTrue(all(likes.values()))
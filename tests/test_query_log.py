@@ -0,0 +1,77 @@
+import json
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from models import db, User
+from app import app, CURR_USER_KEY, user_loader, block_list
+import query_log
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class QueryLogTestCase(TestCase):
+    """Test per-request statement timing and the slow-query log."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            user = User.signup("logged", "logged@test.com", "password", None)
+            user.id = 1
+            db.session.commit()
+
+        user_loader.cache.clear()
+        block_list.cache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def test_server_timing(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/users/1")
+
+        timing = resp.headers["Server-Timing"]
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries"$')
+        self.assertNotIn('desc="0 queries"', timing)
+
+    def test_server_timing_can_be_turned_off(self):
+        with patch.dict(app.config, SERVER_TIMING=False):
+            resp = self.client.get("/users/1")
+        self.assertNotIn("Server-Timing", resp.headers)
+
+    def test_slow_statements_logged_without_values(self):
+        with patch.dict(app.config, QUERY_LOG_SLOW_MS=0, QUERY_LOG_TOP=2):
+            with self.assertLogs('query_log', 'WARNING') as logs:
+                self.client.get("/users?q=needle")
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['endpoint'], 'list_users')
+        self.assertEqual(line['status'], 200)
+        self.assertGreaterEqual(line['queries'], 1)
+        self.assertLessEqual(len(line['slowest']), 2)
+        self.assertTrue(all('sql' in s and 'params' in s for s in line['slowest']))
+        self.assertNotIn("needle", logs.output[0])
+
+    def test_fast_requests_sampled(self):
+        with patch.dict(app.config, QUERY_LOG_SAMPLE_RATE=0):
+            with self.assertNoLogs('query_log'):
+                self.client.get("/users/1")
+
+        with patch.dict(app.config, QUERY_LOG_SAMPLE_RATE=1):
+            with self.assertLogs('query_log', 'INFO'):
+                self.client.get("/users/1")
+
+    def test_shape(self):
+        self.assertEqual(query_log.shape({'id': 1, 'q': "x"}), {'id': 'int', 'q': 'str'})
+        self.assertEqual(query_log.shape((1, None)), ['int', 'NoneType'])
+        self.assertEqual(query_log.shape([{'id': 1}, {'id': 2}], executemany=True),
+                         {'rows': 2, 'each': {'id': 'int'}})
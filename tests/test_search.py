@@ -0,0 +1,69 @@
+import os
+from unittest import TestCase
+from models import db, User
+from app import app
+import search
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class SearchTestCase(TestCase):
+    """Test user search."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            self.client = app.test_client()
+
+            for username, bio, location in [("johnny", None, "Paris"),
+                                            ("bigjohn", "I am john", None),
+                                            ("alice", "Likes jokes", "London"),
+                                            ("bob_london", None, None)]:
+                u = User.signup(username, f"{username}@test.com", "password", None)
+                u.bio = bio
+                u.location = location
+            db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def usernames(self, q, page=1):
+        with app.test_request_context("/users"):
+            return [u.username for u in search.search_users(q, page)]
+
+    def test_prefix_matches_rank_first(self):
+        self.assertEqual(self.usernames("john"), ["johnny", "bigjohn"])
+        self.assertEqual(self.usernames("jo"), ["johnny", "alice", "bigjohn"])
+
+    def test_matches_bio_and_location(self):
+        self.assertEqual(set(self.usernames("london")), {"alice", "bob_london"})
+        self.assertEqual(self.usernames("jok lon"), ["alice"])
+        self.assertEqual(self.usernames("%_&!"), [])
+
+    def test_pages_stop_at_result_limit(self):
+        app.config.update(SEARCH_PAGE_SIZE=1, SEARCH_MAX_RESULTS=2)
+        try:
+            self.assertEqual(self.usernames(""), ["alice"])
+            self.assertEqual(self.usernames("", page=2), ["bigjohn"])
+            self.assertEqual(self.usernames("", page=3), ["bigjohn"])
+
+            resp = self.client.get("/users?page=2")
+            html = resp.get_data(as_text=True)
+            self.assertIn("@bigjohn", html)
+            self.assertIn("Previous", html)
+            self.assertNotIn(">Next<", html)
+        finally:
+            app.config.update(SEARCH_PAGE_SIZE=30, SEARCH_MAX_RESULTS=300)
+
+    def test_signup_is_searchable(self):
+        with app.app_context():
+            User.signup("newcomer", "new@test.com", "password", None)
+            db.session.commit()
+
+        resp = self.client.get("/users?q=newc")
+        self.assertIn("@newcomer", resp.get_data(as_text=True))
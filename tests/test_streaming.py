@@ -0,0 +1,62 @@
+import os
+from unittest import TestCase
+from bs4 import BeautifulSoup
+from models import db, User, Follows
+from app import app, CURR_USER_KEY, user_loader
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class StreamedPagesTestCase(TestCase):
+    """Test list pages rendered with stream_page."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            for i in range(1, 5):
+                user = User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                user.id = i
+            db.session.flush()
+
+            # 2, 3 and 4 follow 1; the viewer (2) also follows 3
+            for follower in (2, 3, 4):
+                db.session.add(Follows(user_being_followed_id=1, user_following_id=follower))
+            db.session.add(Follows(user_being_followed_id=3, user_following_id=2))
+            db.session.commit()
+
+        user_loader.cache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def follow_buttons(self, resp):
+        soup = BeautifulSoup(resp.get_data(as_text=True), 'html.parser')
+        return {form['action'].rsplit('/', 1)[1]: form.button.get_text()
+                for form in soup.select('.card-contents form')}
+
+    def test_followers_streamed_with_follow_state(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            resp = c.get("/users/1/followers")
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(self.follow_buttons(resp),
+                             {"2": "Follow", "3": "Unfollow", "4": "Follow"})
+
+            resp = c.get("/users/2/following")
+            self.assertEqual(self.follow_buttons(resp), {"1": "Unfollow", "3": "Unfollow"})
+
+    def test_flashes_shown_once(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+                sess['_flashes'] = [('success', "Flashed!")]
+
+            self.assertIn("Flashed!", c.get("/dm/inbox").get_data(as_text=True))
+            self.assertNotIn("Flashed!", c.get("/dm/inbox").get_data(as_text=True))
@@ -0,0 +1,111 @@
+import os
+from unittest import TestCase, mock
+from werkzeug.middleware.proxy_fix import ProxyFix
+from models import db, User
+from app import app
+from throttle import LoginGuard, TokenBucket
+import app as warbler
+import passwords
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class TokenBucketTestCase(TestCase):
+    """Test the per-key token buckets."""
+
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        with mock.patch("throttle.time.monotonic", return_value=100):
+            self.assertEqual(bucket.take("a"), 0)
+            self.assertEqual(bucket.take("a"), 0)
+            self.assertAlmostEqual(bucket.take("a"), 1)
+            self.assertEqual(bucket.take("b"), 0)
+
+        with mock.patch("throttle.time.monotonic", return_value=101):
+            self.assertEqual(bucket.take("a"), 0)
+
+    def test_refund(self):
+        bucket = TokenBucket(rate=1e-6, burst=1)
+        self.assertEqual(bucket.take("a"), 0)
+        self.assertTrue(bucket.take("a"))
+        bucket.refund("a")
+        self.assertEqual(bucket.take("a"), 0)
+
+    def test_size_is_bounded(self):
+        bucket = TokenBucket(rate=1, burst=1, maxsize=2)
+        for key in "abc":
+            bucket.take(key)
+        self.assertEqual(list(bucket._buckets), ["b", "c"])
+
+
+class LoginThrottleTestCase(TestCase):
+    """Test throttled logins and the unknown-username cache."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            User.signup("testuser", "test@test.com", "password", None)
+            db.session.commit()
+
+        self.client = app.test_client()
+        self.guard = LoginGuard(TokenBucket(rate=1e-6, burst=2),
+                                TokenBucket(rate=1e-6, burst=100))
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_throttled_before_bcrypt(self):
+        with mock.patch.object(warbler, "login_guard", self.guard):
+            for _ in range(2):
+                resp = self.client.post("/login", data={"username": "testuser", "password": "not-my-password"})
+                self.assertEqual(resp.status_code, 200)
+
+            with mock.patch.object(passwords.hasher, "_run") as run:
+                resp = self.client.post("/login",
+                                        data={"username": "testuser", "password": "password"})
+            run.assert_not_called()
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn("Retry-After", resp.headers)
+
+    def test_unknown_username_is_cached(self):
+        with app.app_context():
+            self.assertFalse(self.guard.authenticate("nobody", "password"))
+            self.assertTrue(self.guard.unknown.get("nobody"))
+
+            with mock.patch.object(User, "query") as query:
+                self.assertFalse(self.guard.authenticate("nobody", "password"))
+            query.filter_by.assert_not_called()
+
+            User.signup("nobody", "nobody@test.com", "password", None)
+            db.session.commit()
+            self.guard.forget("nobody")
+            self.assertTrue(self.guard.authenticate("nobody", "password"))
+
+    def test_refused_attempts_spend_one_bucket(self):
+        guard = LoginGuard(TokenBucket(rate=1e-6, burst=1), TokenBucket(rate=1e-6, burst=2))
+
+        self.assertEqual(guard.retry_after("victim", "1.1.1.1"), 0)
+        # the username is out of tokens; the IP keeps its second one
+        self.assertTrue(guard.retry_after("victim", "1.1.1.1"))
+        self.assertEqual(guard.retry_after("other", "1.1.1.1"), 0)
+        # the IP is out of tokens; the username keeps its one
+        self.assertTrue(guard.retry_after("third", "1.1.1.1"))
+        self.assertEqual(guard.retry_after("third", "2.2.2.2"), 0)
+
+    def test_ip_bucket_uses_forwarded_client_address(self):
+        guard = LoginGuard(TokenBucket(rate=1e-6, burst=100), TokenBucket(rate=1e-6, burst=1))
+        data = {"username": "testuser", "password": "not-my-password"}
+
+        with mock.patch.object(warbler, "login_guard", guard), \
+                mock.patch.object(app, "wsgi_app", ProxyFix(app.wsgi_app, x_for=1)):
+            for client in ("1.1.1.1", "2.2.2.2"):
+                resp = self.client.post("/login", data=data,
+                                        headers={"X-Forwarded-For": client})
+                self.assertEqual(resp.status_code, 200)
+
+            resp = self.client.post("/login", data=data, headers={"X-Forwarded-For": "1.1.1.1"})
+            self.assertEqual(resp.status_code, 429)
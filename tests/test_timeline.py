@@ -0,0 +1,111 @@
+import os
+from unittest import TestCase, mock
+from datetime import datetime
+from models import db, User, Message, TimelineEntry
+from app import app, CURR_USER_KEY
+import timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app.config['WTF_CSRF_ENABLED'] = False
+
+class TimelineTestCase(TestCase):
+    """Test the materialized home timeline."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+
+            self.client = app.test_client()
+
+            u1 = User.signup("reader", "reader@test.com", "password", None)
+            u1.id = 1111
+            u2 = User.signup("writer", "writer@test.com", "password", None)
+            u2.id = 2222
+            db.session.commit()
+
+            self.reader_id = 1111
+            self.writer_id = 2222
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_post_fans_out_to_followers(self):
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f"/users/follow/{self.writer_id}")
+
+            self.login(c, self.writer_id)
+            c.post("/messages/new", data={"text": "fanned out"})
+
+            with app.app_context():
+                msg = Message.query.one()
+                owners = {e.owner_id for e in TimelineEntry.query.filter_by(message_id=msg.id)}
+                self.assertEqual(owners, {self.reader_id, self.writer_id})
+
+            self.login(c, self.reader_id)
+            resp = c.get("/")
+            self.assertIn("fanned out", str(resp.data))
+
+    def test_follow_and_unfollow_update_timeline(self):
+        with app.app_context():
+            db.session.add(Message(text="older post", user_id=self.writer_id))
+            db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+
+            c.post(f"/users/follow/{self.writer_id}")
+            self.assertIn("older post", str(c.get("/").data))
+
+            c.post(f"/users/stop-following/{self.writer_id}")
+            self.assertNotIn("older post", str(c.get("/").data))
+
+    def test_backfill_and_check(self):
+        with app.app_context():
+            reader = db.session.get(User, self.reader_id)
+            writer = db.session.get(User, self.writer_id)
+            reader.following.append(writer)
+            db.session.add_all([Message(text="one", user_id=self.writer_id),
+                                Message(text="two", user_id=self.reader_id)])
+            db.session.commit()
+
+            missing, extra = timeline.check(self.reader_id)
+            self.assertEqual(len(missing), 2)
+            self.assertEqual(extra, set())
+
+            timeline.backfill(self.reader_id)
+            db.session.commit()
+
+            self.assertEqual(timeline.check(self.reader_id), (set(), set()))
+
+    def test_unfollow_refills_capped_timeline(self):
+        with app.app_context():
+            third = User.signup("third", "third@test.com", "password", None)
+            third.id = 3333
+            db.session.add_all([
+                Message(text="old from writer", user_id=self.writer_id,
+                        timestamp=datetime(2020, 1, 1)),
+                Message(text="new from third", user_id=3333,
+                        timestamp=datetime(2021, 1, 1)),
+            ])
+            db.session.commit()
+
+        with mock.patch.object(timeline, "TIMELINE_SIZE", 1), self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f"/users/follow/{self.writer_id}")
+            c.post("/users/follow/3333")
+            self.assertNotIn("old from writer", str(c.get("/").data))
+
+            c.post("/users/stop-following/3333")
+            self.assertIn("old from writer", str(c.get("/").data))
+
+            with app.app_context():
+                self.assertEqual(timeline.check(self.reader_id, depth=100), (set(), set()))
@@ -1,7 +1,7 @@
 import os
 from unittest import TestCase
 from sqlalchemy import exc
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes, BlockedUsers
 from app import app
 
 os.environ['DATABASE_URL'] = "postgresql:///messager-test"
@@ -98,6 +98,42 @@ class UserModelTestCase(TestCase):
             self.assertTrue(u2.is_followed_by(u1))
             self.assertFalse(u1.is_followed_by(u2))
 
+    def test_is_blocking_and_has_liked(self):
+        """Predicates answer from the join tables without loading collections."""
+        with app.app_context():
+            u1 = User.query.get(self.uid1)
+            u2 = User.query.get(self.uid2)
+            msg = Message(text="likeable", user_id=self.uid2)
+            db.session.add(msg)
+            db.session.flush()
+            db.session.add_all([BlockedUsers(user_id=self.uid1, blocked_user_id=self.uid2),
+                                Likes(user_id=self.uid1, message_id=msg.id)])
+            db.session.commit()
+
+            self.assertTrue(u1.is_blocking(u2))
+            self.assertFalse(u2.is_blocking(u1))
+            self.assertTrue(u1.has_liked(msg))
+            self.assertFalse(u2.has_liked(msg))
+            self.assertNotIn('likes', u1.__dict__)
+            self.assertNotIn('blocked_users', u1.__dict__)
+
+    def test_batched_predicates(self):
+        """following_among/liked_among return the matching subset."""
+        with app.app_context():
+            u1 = User.query.get(self.uid1)
+            u2 = User.query.get(self.uid2)
+            u1.following.append(u2)
+            msgs = [Message(text=f"m{i}", user_id=self.uid2) for i in range(3)]
+            db.session.add_all(msgs)
+            db.session.flush()
+            db.session.add(Likes(user_id=self.uid1, message_id=msgs[1].id))
+            db.session.commit()
+
+            self.assertEqual(u1.following_among([self.uid1, self.uid2, 9999]), {self.uid2})
+            self.assertEqual(u2.following_among([self.uid1]), set())
+            self.assertEqual(u1.liked_among(m.id for m in msgs), {msgs[1].id})
+            self.assertEqual(u1.liked_among([]), set())
+
     def test_valid_signup(self):
         """Tests if a new user can be created with valid credentials."""
         with app.app_context():
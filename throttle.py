@@ -0,0 +1,123 @@
+"""Login throttling.
+
+Every login attempt costs a database query and a bcrypt check, so
+credential stuffing is a cheap way to burn the app's CPU. `LoginGuard` turns
+attempts away before either happens:
+
+- a token bucket per username and per client IP (`TokenBucket`); an
+  attempt is refused when either is empty;
+- a short-lived cache of usernames known not to exist, which skips the
+  database lookup.
+
+Unknown usernames are still checked against a dummy hash, so they take as
+long as a wrong password and don't reveal which usernames exist.
+
+The IP bucket is keyed on `request.remote_addr`. Behind a load balancer,
+set TRUSTED_PROXIES so that is the client's address (from X-Forwarded-For)
+rather than the balancer's, or every client shares one bucket.
+
+Buckets and the unknown-user cache are per process, so with N workers an
+attacker gets up to N times the configured rate; the pool limit in
+passwords.py still caps the CPU they can reach.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from cache import TTLCache
+from models import User
+import metrics
+import passwords
+
+THROTTLED = metrics.counter('login_throttled_total', "Login attempts refused by rate limits.",
+                            ['key'])
+
+
+class TokenBucket:
+    """Per-key token buckets: `burst` tokens, refilled at `rate` per second.
+
+    Holds at most `maxsize` keys; the least recently used are dropped, which
+    only ever resets a bucket to full.
+    """
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Spend a token for `key`. Returns 0 if there was one, otherwise
+        the seconds until there will be."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            if tokens >= 1:
+                wait = 0
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+
+        return wait
+
+    def refund(self, key):
+        """Give back the token a refused attempt took for `key`."""
+
+        with self._lock:
+            if key in self._buckets:
+                tokens, last = self._buckets[key]
+                self._buckets[key] = (min(self.burst, tokens + 1), last)
+
+
+class LoginGuard:
+    """Rate limits and an unknown-username cache in front of authentication."""
+
+    def __init__(self, user_bucket, ip_bucket, unknown_ttl=30, maxsize=100000):
+        self.user_bucket = user_bucket
+        self.ip_bucket = ip_bucket
+        self.unknown = TTLCache(maxsize=maxsize, ttl=unknown_ttl)
+
+    def retry_after(self, username, ip):
+        """0 if this attempt may go ahead, else seconds until it may."""
+
+        # an attempt refused by one bucket doesn't spend the other's token,
+        # so hammering one account can't lock out everyone behind that IP,
+        # and vice versa
+        wait = self.user_bucket.take(username)
+        if wait:
+            THROTTLED.labels(key='username').inc()
+            return wait
+
+        wait = self.ip_bucket.take(ip)
+        if wait:
+            THROTTLED.labels(key='ip').inc()
+            self.user_bucket.refund(username)
+        return wait
+
+    def authenticate(self, username, password):
+        """Like `User.authenticate`, but remembers usernames that don't exist."""
+
+        if self.unknown.get(username):
+            return passwords.hasher.check_dummy(password)
+
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            self.unknown.set(username, True)
+            return passwords.hasher.check_dummy(password)
+
+        return user if user.check_password(password) else False
+
+    def forget(self, username):
+        """`username` exists now (signup or rename)."""
+
+        self.unknown.pop(username)
@@ -0,0 +1,199 @@
+"""Materialized home timelines for Warbler.
+
+Each user's home timeline is stored in `timeline_entries` (fan-out on write)
+instead of being computed with an `IN (...)` over everyone they follow on
+every page view. These helpers only stage changes on `db.session`; callers
+commit, just like the views do.
+"""
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, insert, delete, literal, func, tuple_, union_all
+
+from models import db, User, Message, Follows, TimelineEntry
+
+# Most recent entries kept per timeline.
+TIMELINE_SIZE = 800
+
+# Trim the receiving timelines on every Nth message instead of on every post;
+# a timeline can briefly hold a few more than TIMELINE_SIZE entries.
+TRIM_EVERY = 20
+
+ENTRY_COLUMNS = ['owner_id', 'message_id', 'author_id', 'timestamp']
+
+
+def fan_out(message):
+    """Push a newly flushed `message` into its author's and followers' timelines."""
+
+    owners = union_all(
+        select(literal(message.user_id).label('owner_id')),
+        select(Follows.user_following_id.label('owner_id'))
+        .where(Follows.user_being_followed_id == message.user_id))
+
+    owner_ids = owners.subquery()
+    rows = select(owner_ids.c.owner_id,
+                  literal(message.id),
+                  literal(message.user_id),
+                  literal(message.timestamp))
+    db.session.execute(insert(TimelineEntry).from_select(ENTRY_COLUMNS, rows))
+
+    if message.id % TRIM_EVERY == 0:
+        trim(owners)
+
+
+def add_follow(follower_id, followed_id):
+    """Copy `followed_id`'s recent messages into `follower_id`'s timeline."""
+
+    rows = (select(literal(follower_id), Message.id, Message.user_id, Message.timestamp)
+            .where(Message.user_id == followed_id)
+            .where(~select(TimelineEntry.message_id)
+                   .where(TimelineEntry.owner_id == follower_id,
+                          TimelineEntry.message_id == Message.id)
+                   .exists())
+            .order_by(Message.timestamp.desc())
+            .limit(TIMELINE_SIZE))
+    db.session.execute(insert(TimelineEntry).from_select(ENTRY_COLUMNS, rows))
+    trim([follower_id])
+
+
+def remove_follow(follower_id, followed_id):
+    """Drop `followed_id`'s messages from `follower_id`'s timeline.
+
+    The timeline is capped, so the freed slots are refilled with older
+    messages from everyone `follower_id` still follows. Call this after the
+    follow row itself is gone.
+    """
+
+    backfill(follower_id)
+
+
+def trim(owner_ids):
+    """Cut the given timelines (ids or a select of ids) back to TIMELINE_SIZE."""
+
+    rank = (func.row_number()
+            .over(partition_by=TimelineEntry.owner_id,
+                  order_by=(TimelineEntry.timestamp.desc(),
+                            TimelineEntry.message_id.desc()))
+            .label('rank'))
+    ranked = (select(TimelineEntry.owner_id, TimelineEntry.message_id, rank)
+              .where(TimelineEntry.owner_id.in_(owner_ids))
+              .subquery())
+    stale = (select(ranked.c.owner_id, ranked.c.message_id)
+             .where(ranked.c.rank > TIMELINE_SIZE))
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(tuple_(TimelineEntry.owner_id, TimelineEntry.message_id).in_(stale)))
+
+
+def home_query(user_id):
+    """Unordered query for the messages in `user_id`'s materialized timeline.
+
+    Order it by (TimelineEntry.timestamp, TimelineEntry.message_id) to get an
+    index range read.
+    """
+
+    return (Message
+            .query
+            .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+            .filter(TimelineEntry.owner_id == user_id))
+
+
+def home_messages(user_id, limit=100):
+    """Query for the newest messages in `user_id`'s materialized timeline."""
+
+    return (home_query(user_id)
+            .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.message_id.desc())
+            .limit(limit))
+
+
+def legacy_home_messages(user_id, limit=100):
+    """The old per-request timeline query, kept for backfills and checks."""
+
+    followed = select(Follows.user_being_followed_id).where(
+        Follows.user_following_id == user_id)
+
+    return (Message
+            .query
+            .filter(Message.user_id.in_(followed) | (Message.user_id == user_id))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit))
+
+
+def backfill(user_id):
+    """Rebuild `user_id`'s timeline from the source tables."""
+
+    db.session.execute(delete(TimelineEntry).where(TimelineEntry.owner_id == user_id))
+
+    recent = legacy_home_messages(user_id, TIMELINE_SIZE).subquery()
+    rows = select(literal(user_id), recent.c.id, recent.c.user_id, recent.c.timestamp)
+    db.session.execute(insert(TimelineEntry).from_select(ENTRY_COLUMNS, rows))
+
+
+def check(user_id, depth=100):
+    """Compare `user_id`'s stored timeline with the legacy query.
+
+    Returns a (missing, extra) pair of message id sets; both are empty when
+    the newest `depth` messages agree. Timelines are capped, so `depth` is
+    limited to TIMELINE_SIZE.
+    """
+
+    depth = min(depth, TIMELINE_SIZE)
+    stored = [m.id for m in home_messages(user_id, depth)]
+    expected = [m.id for m in legacy_home_messages(user_id, depth)]
+
+    return set(expected) - set(stored), set(stored) - set(expected)
+
+
+def _user_ids(user_ids):
+    """The given user ids, or every user id in id order."""
+
+    if user_ids:
+        return list(user_ids)
+    return db.session.scalars(select(User.id).order_by(User.id)).all()
+
+
+##############################################################################
+# CLI: `flask timeline backfill` / `flask timeline check`
+
+timeline_cli = AppGroup('timeline', help="Maintain materialized home timelines.")
+
+
+@timeline_cli.command('backfill')
+@click.option('--user', 'user_ids', type=int, multiple=True,
+              help="Only rebuild these users (default: everyone).")
+@click.option('--batch-size', default=500, show_default=True,
+              help="Users rebuilt per transaction.")
+def backfill_command(user_ids, batch_size):
+    """Rebuild timelines from follows and messages."""
+
+    ids = _user_ids(user_ids)
+
+    for n, user_id in enumerate(ids, 1):
+        backfill(user_id)
+        if n % batch_size == 0:
+            db.session.commit()
+
+    db.session.commit()
+    click.echo(f"Rebuilt {len(ids)} timelines.")
+
+
+@timeline_cli.command('check')
+@click.option('--user', 'user_ids', type=int, multiple=True,
+              help="Only check these users (default: everyone).")
+@click.option('--depth', default=100, show_default=True,
+              help="Number of newest messages compared per user.")
+def check_command(user_ids, depth):
+    """Compare stored timelines with the legacy query."""
+
+    bad = 0
+
+    for user_id in _user_ids(user_ids):
+        missing, extra = check(user_id, depth)
+        if missing or extra:
+            bad += 1
+            click.echo(f"user {user_id}: missing {sorted(missing)}, extra {sorted(extra)}")
+
+    click.echo(f"{bad} inconsistent timelines.")
+    if bad:
+        raise SystemExit(1)